@@ -0,0 +1,277 @@
+#! /usr/bin/env python3
+
+"""
+jigsaw-generate end-to-end benchmark
+Copyright (C) 2014-2016 Julian Gilbey <jdg@debian.org>
+This program comes with ABSOLUTELY NO WARRANTY.
+This is free software, and you are welcome to redistribute it
+under certain conditions; see the COPYING file for details.
+
+This builds every puzzle in the examples directory with jigsaw-generate,
+making both the PDF and Markdown outputs and bypassing the build cache,
+in a temporary copy of the directory.  For each puzzle it records,
+from the --profile output of the run:
+
+  - the total wall clock and CPU time
+  - the number of LaTeX passes for each output file, and the time of
+    each pass
+  - the time spent in the LaTeX and Markdown filters
+  - the size of each PDF and Markdown output file
+  - the peak memory used by jigsaw-generate and the programs it ran
+
+The results are written as JSON (by default to
+bench-examples-<commit>.json), and can be compared with a baseline
+stored from an earlier run:
+
+    python3 benchmarks/bench_examples.py -o new.json --compare old.json
+
+A puzzle is reported as a regression if it now fails, needs more LaTeX
+passes, or if its time, output size or peak memory has grown by more
+than the corresponding threshold; the exit status is then 1.  Any
+arguments after -- are passed on to jigsaw-generate.
+"""
+
+import sys
+import os
+import os.path
+import glob
+import time
+import json
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+srcdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The format of the JSON results file
+results_format = 1
+
+# The command used to run jigsaw-generate from the source tree
+generate_cmd = [sys.executable, '-c',
+                'import sys; sys.argv[0] = "jigsaw-generate"; '
+                'sys.path.insert(0, %r); '
+                'from jigsaw import generate; '
+                'generate.main(%r, "bench")' % (srcdir, srcdir)]
+
+# Options making every run do the full amount of work
+generate_options = ['--makepdf', '--makemd', '--nocache', '--nokeepaux',
+                    '--nodatacache', '--noprecompile']
+
+# Times below this (in seconds) are too short to compare reliably
+min_time = 0.01
+
+
+def run_puzzle(workdir, puzfile, extra):
+    """Build puzzfile in workdir, and return the measurements as a dict"""
+    puzbase = os.path.splitext(puzfile)[0]
+    profilefile = os.path.join(workdir, puzbase + '.profile.json')
+    before = set(os.listdir(workdir))
+
+    with open(os.path.join(workdir, puzbase + '.bench.log'), 'w') as log:
+        proc = subprocess.Popen(generate_cmd + [puzfile, '--profile',
+                                                profilefile] +
+                                generate_options + extra,
+                                cwd=workdir, stdout=log,
+                                stderr=subprocess.STDOUT)
+        # wait4() gives the peak memory of the process and of all of
+        # the processes it waited for, such as LaTeX
+        (pid, status, rusage) = os.wait4(proc.pid, 0)
+        proc.returncode = status
+
+    result = {'ok': status == 0,
+              'memory': rusage.ru_maxrss,
+              'passes': {},
+              'passtimes': {},
+              'filter': 0.0,
+              'sizes': {}}
+
+    try:
+        with open(profilefile) as f:
+            profile = json.load(f)
+    except (OSError, ValueError):
+        result['ok'] = False
+        return result
+    os.remove(profilefile)
+
+    result['wall'] = profile['wall']
+    result['cpu'] = profile['cpu']
+    for record in profile['records']:
+        if record['stage'] == 'latexpass':
+            name = os.path.basename(record['file'])
+            result['passes'][name] = max(result['passes'].get(name, 0),
+                                         record['number'])
+            result['passtimes'].setdefault(name, []).append(record['wall'])
+        elif record['stage'] in ('texfilter', 'mdfilter'):
+            result['filter'] += record['wall']
+    result['filter'] = round(result['filter'], 6)
+
+    for fn in sorted(set(os.listdir(workdir)) - before):
+        if fn.endswith(('.pdf', '.md')):
+            result['sizes'][fn] = os.path.getsize(os.path.join(workdir, fn))
+    return result
+
+
+def best(results):
+    """Return the fastest of a list of results for the same puzzle
+
+    A failed run is returned in preference to any others, so that
+    failures are not hidden.
+    """
+    for result in results:
+        if not result['ok']:
+            return result
+    return min(results, key=lambda r: r['wall'])
+
+
+def commit():
+    """Return the current git commit of the source tree, if known"""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=srcdir,
+            universal_newlines=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def check(name, what, old, new, threshold, minimum=0):
+    """Print a comparison of old and new; return True if a regression"""
+    if old is None or new is None or old < minimum:
+        return False
+    change = (new - old) / old if old else 0.0
+    if change > threshold:
+        mark = '  WORSE'
+    elif change < -threshold:
+        mark = '  better'
+    else:
+        mark = ''
+    print('  %-48s %-8s %11.4g %11.4g %+7.1f%%%s' %
+          (name, what, old, new, 100 * change, mark))
+    return change > threshold
+
+
+def compare(results, oldfile, thresholds):
+    """Compare results with those in oldfile; return True if worse"""
+    try:
+        with open(oldfile) as f:
+            old = json.load(f)
+    except (OSError, ValueError) as err:
+        sys.exit('Cannot read %s: %s' % (oldfile, err))
+
+    worse = False
+    print('\nComparison with %s (commit %s):' %
+          (oldfile, old.get('commit', 'unknown')))
+    for (name, new) in results['benchmarks'].items():
+        oldresult = old.get('benchmarks', {}).get(name)
+        if not oldresult:
+            continue
+        if not new['ok']:
+            print('  %-48s FAILED' % name)
+            worse = True
+            continue
+        if not oldresult['ok']:
+            continue
+
+        for what in ('wall', 'cpu', 'filter'):
+            worse |= check(name, what, oldresult.get(what), new.get(what),
+                           thresholds['time'], min_time)
+        worse |= check(name, 'memory', oldresult.get('memory'),
+                       new.get('memory'), thresholds['memory'])
+        for (fn, passes) in new['passes'].items():
+            oldpasses = oldresult['passes'].get(fn)
+            if oldpasses is not None and passes > oldpasses:
+                print('  %-48s passes   %11d %11d  WORSE' %
+                      (fn, oldpasses, passes))
+                worse = True
+        for (fn, size) in new['sizes'].items():
+            worse |= check(fn, 'size', oldresult['sizes'].get(fn), size,
+                           thresholds['size'])
+    return worse
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Time jigsaw-generate on each of the examples')
+    parser.add_argument('-o', '--output',
+                        help=('file to write the results to (default '
+                              'bench-examples-<commit>.json)'))
+    parser.add_argument('--compare', metavar='FILE',
+                        help='baseline results to compare with')
+    parser.add_argument('--threshold', type=float, default=10,
+                        help=('percentage increase in time reported as a '
+                              'regression (default 10)'))
+    parser.add_argument('--size-threshold', type=float, default=5,
+                        help=('percentage increase in output size reported '
+                              'as a regression (default 5)'))
+    parser.add_argument('--memory-threshold', type=float, default=10,
+                        help=('percentage increase in peak memory reported '
+                              'as a regression (default 10)'))
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='number of times to build each puzzle')
+    parser.add_argument('--examples', default=os.path.join(srcdir,
+                                                           'examples'),
+                        help='directory of puzzles to build')
+    parser.add_argument('generateargs', nargs=argparse.REMAINDER,
+                        help='options to pass on to jigsaw-generate')
+    args = parser.parse_args()
+    extra = args.generateargs
+    if extra and extra[0] == '--':
+        extra = extra[1:]
+
+    results = {'format': results_format,
+               'commit': commit(),
+               'python': platform.python_version(),
+               'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+               'options': extra,
+               'benchmarks': {}}
+
+    puzfiles = sorted(os.path.basename(fn) for fn in
+                      glob.glob(os.path.join(args.examples, '*.yaml')))
+    if not puzfiles:
+        sys.exit('No puzzle files found in %s' % args.examples)
+
+    print('%-42s %8s %8s %8s %7s %10s' %
+          ('puzzle', 'wall (s)', 'cpu (s)', 'filt (s)', 'passes',
+           'memory (k)'))
+    tmpdir = tempfile.mkdtemp(prefix='jigsaw-bench-')
+    try:
+        workdir = os.path.join(tmpdir, 'examples')
+        runs = []
+        for i in range(args.repeat):
+            shutil.rmtree(workdir, ignore_errors=True)
+            shutil.copytree(args.examples, workdir)
+            runs.append(dict((puzfile, run_puzzle(workdir, puzfile, extra))
+                             for puzfile in puzfiles))
+
+        for puzfile in puzfiles:
+            result = best([run[puzfile] for run in runs])
+            results['benchmarks'][puzfile] = result
+            if result['ok']:
+                print('%-42s %8.3f %8.3f %8.3f %7d %10d' %
+                      (puzfile, result['wall'], result['cpu'],
+                       result['filter'], sum(result['passes'].values()),
+                       result['memory']))
+            else:
+                print('%-42s FAILED (see %s)' %
+                      (puzfile, os.path.join(
+                          workdir, os.path.splitext(puzfile)[0] + '.log')))
+    finally:
+        if not any(not r['ok'] for r in results['benchmarks'].values()):
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    output = args.output or 'bench-examples-%s.json' % results['commit']
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=1)
+        f.write('\n')
+    print('\nResults written to %s' % output)
+
+    thresholds = {'time': args.threshold / 100,
+                  'size': args.size_threshold / 100,
+                  'memory': args.memory_threshold / 100}
+    if args.compare and compare(results, args.compare, thresholds):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#! /usr/bin/env python3
+
+"""
+jigsaw-generate img2tex benchmark
+Copyright (C) 2014-2016 Julian Gilbey <jdg@debian.org>
+This program comes with ABSOLUTELY NO WARRANTY.
+This is free software, and you are welcome to redistribute it
+under certain conditions; see the COPYING file for details.
+
+This times the conversion of Markdown images to LaTeX by img2tex() on
+texts containing more and more images, and compares it with the
+earlier approach of replacing the images one at a time.  The time per
+image should stay roughly constant for img2tex(), showing that it
+scales linearly with the number of images.
+
+Run it from the top of the source tree:
+
+    python3 benchmarks/bench_img2tex.py
+"""
+
+import sys
+import os.path
+import timeit
+
+srcdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, srcdir)
+
+from jigsaw import generate
+
+counts = [1, 10, 100, 1000, 10000]
+
+# The earlier approach is only timed up to this many images, as it
+# becomes very slow
+loop_max = 1000
+
+
+def img2tex_loop(text):
+    """The earlier img2tex, which replaced one image per pass
+
+    (The replacements are given as functions here, as the backslashes
+    in them would otherwise be taken as escapes.)
+    """
+    img_re = generate.img_re
+    images = img_re.search(text)
+    while images:
+        caption, img = images.groups()
+        if caption:
+            text = img_re.sub(lambda m: r'\imagecap{%s}{%s}' % (img, caption),
+                              text, count=1)
+        else:
+            text = img_re.sub(lambda m: r'\image{%s}' % img, text, count=1)
+        images = img_re.search(text)
+    return text
+
+
+def make_text(n):
+    """Return a text with n images, alternately with and without captions"""
+    parts = []
+    for i in range(n):
+        if i % 2:
+            parts.append('step %d ![](fig%d.png)' % (i, i))
+        else:
+            parts.append('step %d ![Figure %d](fig%d.png)' % (i, i, i))
+    return ' '.join(parts)
+
+
+def best(func, text):
+    """Return the best time in seconds for a call of func(text)"""
+    timer = timeit.Timer(lambda: func(text))
+    number, _ = timer.autorange()
+    return min(timer.repeat(3, number)) / number
+
+
+def uncached(text):
+    generate.image_cache.clear()
+    return generate.img2tex(text)
+
+
+def main():
+    print('%8s  %14s  %14s' % ('images', 'img2tex', 'one at a time'))
+    print('%8s  %14s  %14s' % ('', 'us per image', 'us per image'))
+    for n in counts:
+        text = make_text(n)
+        if n <= loop_max and uncached(text) != img2tex_loop(text):
+            sys.exit('img2tex gives a different result for %d images' % n)
+        single = best(uncached, text) / n * 1e6
+        if n <= loop_max:
+            loop = '%14.3f' % (best(img2tex_loop, text) / n * 1e6)
+        else:
+            loop = '%14s' % '-'
+        print('%8d  %14.3f  %s' % (n, single, loop))
+
+
+if __name__ == '__main__':
+    main()
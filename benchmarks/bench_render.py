@@ -0,0 +1,267 @@
+#! /usr/bin/env python3
+
+"""
+jigsaw-generate rendering benchmark
+Copyright (C) 2014-2016 Julian Gilbey <jdg@debian.org>
+This program comes with ABSOLUTELY NO WARRANTY.
+This is free software, and you are welcome to redistribute it
+under certain conditions; see the COPYING file for details.
+
+This times the Python side of jigsaw-generate on synthetic puzzles of
+increasing size, without running LaTeX or any filters:
+
+  - card sorts of 100 to 100000 cards, some hidden and some with
+    labels and images
+  - domino chains of 100 to 10000 pairs
+  - the hexagon, smallhexagon, triangle and parquet jigsaws, with
+    images and hidden entries, filled with texts of increasing length
+
+Each puzzle is rendered in memory with generate.render(), and the
+time spent in each of the make_* functions is taken from the
+timing records used by --profile.  (make_table() only prepares the
+table; its rows are written, and timed, as part of the generate_*
+function.)  make_entry() and dosub() are also timed on their own over
+every card of the card sorts.
+
+The results are written as JSON (by default to
+bench-render-<commit>.json), and can be compared with those from
+another commit:
+
+    python3 benchmarks/bench_render.py -o new.json --compare old.json
+
+Benchmarks which have become slower by more than the threshold
+(default 10%) are reported, and the exit status is then 1.
+"""
+
+import sys
+import os
+import os.path
+import time
+import json
+import argparse
+import platform
+import subprocess
+
+srcdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, srcdir)
+
+from jigsaw import generate
+from jigsaw import timing
+
+# The format of the JSON results file
+results_format = 1
+
+templatedirs = [os.path.join(srcdir, 'templates')]
+filterdirs = [os.path.join(srcdir, 'filters')]
+
+cardsort_sizes = [100, 1000, 10000, 100000]
+domino_sizes = [100, 1000, 10000]
+jigsaw_types = ['hexagon', 'smallhexagon', 'triangle', 'parquet']
+jigsaw_lengths = [1, 10, 100]
+
+# The Python functions whose times are reported for each puzzle
+stages = ['build', 'generate_jigsaw', 'generate_cardsort', 'make_table',
+          'make_triangles', 'make_squares', 'make_cardsort_cards',
+          'make_domino_cards']
+
+
+def entry_text(n, words=1):
+    """Return a synthetic entry text with the given number of words"""
+    return ' '.join('$x_{%d}^{%d}$' % (n, i) for i in range(words))
+
+
+def cardsort_data(size):
+    """Return a card sort deck of size cards"""
+    cards = []
+    for i in range(size):
+        if i % 50 == 49:
+            cards.append({'newlabel': 'Set %d' % (i // 50)})
+        if i % 7 == 0:
+            cards.append({'text': 'Card %d' % i, 'hidden': True})
+        elif i % 11 == 0:
+            cards.append({'text': 'Card %d ![Figure %d](fig%d.png)' %
+                          (i, i, i), 'label': 'L%d' % i})
+        elif i % 13 == 0:
+            cards.append({'puzzletext': '?', 'solutiontext': 'Card %d' % i})
+        else:
+            cards.append('Card %d: %s' % (i, entry_text(i, 3)))
+    return {'type': 'cardsort', 'title': 'Cards %d' % size, 'cards': cards}
+
+
+def domino_data(size):
+    """Return a domino chain of size pairs"""
+    pairs = [['Q%d %s' % (i, entry_text(i, 2)), 'A%d' % i]
+             for i in range(size)]
+    return {'type': 'dominoes', 'title': 'Dominoes %d' % size,
+            'rows': 5, 'columns': 2, 'loop': False, 'pairs': pairs}
+
+
+def jigsaw_data(puztype, words):
+    """Return a jigsaw of puztype whose entries have the given length"""
+    layout = generate.loadlayout(templatedirs, puztype)
+    numpairs = layout.get('pairs', 0)
+    numedges = layout.get('edges', 0)
+    pairs = []
+    for i in range(numpairs):
+        if i % 5 == 0:
+            question = {'text': 'Q%d %s' % (i, entry_text(i, words)),
+                        'hidden': True}
+        elif i % 5 == 1:
+            question = 'Q%d ![](fig%d.png) %s' % (i, i, entry_text(i, words))
+        else:
+            question = 'Q%d %s' % (i, entry_text(i, words))
+        pairs.append([question, 'A%d %s' % (i, entry_text(i, words))])
+    edges = ['E%d' % i for i in range(numedges)]
+    return {'type': puztype, 'title': '%s %d' % (puztype, words),
+            'pairs': pairs, 'edges': edges}
+
+
+def puzzles(quick):
+    """Yield (name, data) for each synthetic puzzle"""
+    for size in cardsort_sizes[:-1] if quick else cardsort_sizes:
+        yield ('cardsort-%d' % size, cardsort_data(size))
+    for size in domino_sizes[:-1] if quick else domino_sizes:
+        yield ('dominoes-%d' % size, domino_data(size))
+    for puztype in jigsaw_types:
+        for words in jigsaw_lengths:
+            yield ('%s-%d' % (puztype, words), jigsaw_data(puztype, words))
+
+
+def render(data):
+    """Render data in memory, returning the time in each stage"""
+    timing.enable()
+    generate.render(data, templatedirs=templatedirs, filterdirs=filterdirs)
+    return dict((total['stage'], total['wall'])
+                for total in timing.summary())
+
+
+def time_entries(data):
+    """Return the times of make_entry() and dosub() over a deck"""
+    cards = [c for c in data['cards'] if not generate.check_special(c)]
+    ctx = generate.RunContext()
+    start = time.perf_counter()
+    for c in cards:
+        ctx.make_entry(c, 5, 'tikz', '', 3)
+        ctx.make_entry(c, 5, 'tikz', '', 3, solution=True)
+        ctx.make_entry(c, 0, 'md', '', blank='&nbsp;')
+        ctx.make_entry(c, 4, 'table', '', 4, solution=True)
+    entrytime = time.perf_counter() - start
+
+    text = ('\\card{<: rownum :>}{<: colnum :>}{<: cardnum :>}'
+            '{<: text :>}{<: label :>} <: title :>')
+    subs = {'rownum': 1, 'colnum': 2, 'cardnum': '3', 'label': '',
+            'title': 'Title'}
+    start = time.perf_counter()
+    for c in cards:
+        subs['text'] = c if isinstance(c, str) else str(c.get('text'))
+        generate.dosub(text, subs)
+    subtime = time.perf_counter() - start
+    return (entrytime, subtime)
+
+
+def best(func, repeat):
+    """Return the result of the fastest of repeat calls to func
+
+    The result of func is a dict of times, or a tuple of times; the
+    fastest call is the one with the smallest first time.
+    """
+    results = [func() for i in range(repeat)]
+    if isinstance(results[0], dict):
+        return min(results, key=lambda r: r.get('build', 0))
+    return min(results)
+
+
+def commit():
+    """Return the current git commit of the source tree, if known"""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=srcdir,
+            universal_newlines=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare(results, oldfile, threshold):
+    """Compare results with those in oldfile; return True if slower"""
+    try:
+        with open(oldfile) as f:
+            old = json.load(f)
+    except (OSError, ValueError) as err:
+        sys.exit('Cannot read %s: %s' % (oldfile, err))
+
+    slower = False
+    print('\nComparison with %s (commit %s):' %
+          (oldfile, old.get('commit', 'unknown')))
+    for (name, times) in results['benchmarks'].items():
+        oldtimes = old.get('benchmarks', {}).get(name)
+        if not oldtimes:
+            continue
+        for (stage, t) in times.items():
+            oldt = oldtimes.get(stage)
+            if not oldt or oldt < 0.001:
+                continue
+            change = (t - oldt) / oldt
+            if change > threshold:
+                mark = '  SLOWER'
+                slower = True
+            elif change < -threshold:
+                mark = '  faster'
+            else:
+                mark = ''
+            print('  %-22s %-20s %9.4f %9.4f %+7.1f%%%s' %
+                  (name, stage, oldt, t, 100 * change, mark))
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Time the rendering of synthetic puzzles')
+    parser.add_argument('-o', '--output',
+                        help=('file to write the results to (default '
+                              'bench-render-<commit>.json)'))
+    parser.add_argument('--compare', metavar='FILE',
+                        help='earlier results to compare with')
+    parser.add_argument('--threshold', type=float, default=10,
+                        help=('percentage slowdown reported as a '
+                              'regression (default 10)'))
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of times to time each puzzle')
+    parser.add_argument('--quick', action='store_true',
+                        help='leave out the largest puzzles')
+    args = parser.parse_args()
+
+    results = {'format': results_format,
+               'commit': commit(),
+               'python': platform.python_version(),
+               'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+               'benchmarks': {}}
+
+    print('%-22s %10s  %s' % ('puzzle', 'build (s)', 'stages (s)'))
+    for (name, data) in puzzles(args.quick):
+        times = best(lambda: render(data), args.repeat)
+        benchmark = dict((stage, times[stage]) for stage in stages
+                         if stage in times)
+        if data['type'] == 'cardsort':
+            entrytime, subtime = best(lambda: time_entries(data), args.repeat)
+            benchmark['make_entry'] = round(entrytime, 6)
+            benchmark['dosub'] = round(subtime, 6)
+        results['benchmarks'][name] = benchmark
+        print('%-22s %10.4f  %s' %
+              (name, benchmark['build'],
+               ', '.join('%s %.4f' % (stage, t)
+                         for (stage, t) in benchmark.items()
+                         if stage != 'build')))
+
+    output = args.output or 'bench-render-%s.json' % results['commit']
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=1)
+        f.write('\n')
+    print('\nResults written to %s' % output)
+
+    if args.compare and compare(results, args.compare,
+                                args.threshold / 100):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,365 @@
+"""
+jigsaw-generate build cache
+Copyright (C) 2014-2016 Julian Gilbey <jdg@debian.org>
+This program comes with ABSOLUTELY NO WARRANTY.
+This is free software, and you are welcome to redistribute it
+under certain conditions; see the COPYING file for details.
+
+This module keeps a content-addressed cache of the PDF files produced
+by LaTeX.  Each PDF is stored under a key which is a hash of
+everything which determines its content: the final LaTeX source, the
+LaTeX program (and its version), the LaTeX filter and every image or
+other file referenced by the source.  If the same key is requested again, the
+cached PDF is copied into place rather than running LaTeX again.
+
+The cache is bounded in size; when it grows beyond this, the least
+recently used PDFs are deleted.
+
+This module also keeps the LaTeX auxiliary files for each output
+file between runs, so that a rebuild of an edited puzzle can start
+from the previous auxiliary files and usually converge in one pass,
+even though they are cleaned out of the output directory.
+"""
+
+import sys
+import os
+import os.path
+import re
+import json
+import hashlib
+import shutil
+import subprocess
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from . import appdirs
+
+# Default maximum size of the cache, in megabytes
+default_cachesize = 500
+
+# Extensions tried by \includegraphics when none is given
+image_extensions = ['', '.pdf', '.png', '.jpg', '.jpeg', '.eps']
+
+# Extensions tried by \input and \include when none is given
+input_extensions = ['.tex', '']
+
+image_re = re.compile(r'\\(?:image(?:cap)?|includegraphics\s*(?:\[[^\]]*\])?)'
+                      r'\s*\{([^}]*)\}')
+input_re = re.compile(r'\\(?:input|include)\s*\{([^}]*)\}')
+
+# Statistics for this run; these are added to the stored statistics
+# by savestats()
+stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+stats_lock = threading.Lock()
+
+# LaTeX program versions, so that we only ask each program once
+latex_versions = {}
+
+
+def cachedir():
+    """Return the directory in which the cached PDF files live"""
+    return os.path.join(appdirs.user_cache_dir('jigsaw-generator'), 'pdf')
+
+
+def latexversion(latexprog):
+    """Return the version banner of latexprog, or '' if unavailable"""
+    if latexprog not in latex_versions:
+        try:
+            output = subprocess.check_output([latexprog, '--version'],
+                                             universal_newlines=True,
+                                             stderr=subprocess.DEVNULL)
+            latex_versions[latexprog] = output.split('\n')[0]
+        except (OSError, subprocess.CalledProcessError):
+            latex_versions[latexprog] = ''
+    return latex_versions[latexprog]
+
+
+def hashfile(h, fn):
+    """Add the contents of the file fn to the hash h"""
+    with open(fn, 'rb') as f:
+        for block in iter(lambda: f.read(65536), b''):
+            h.update(block)
+
+
+def hashreferenced(h, names, extensions, kind):
+    """Add the files names (tried with each of extensions) to the hash h
+
+    Returns the list of the files found.
+    """
+
+    found = []
+    for name in names:
+        h.update(b'\0' + kind + b'\0' + name.encode() + b'\0')
+        for ext in extensions:
+            if os.path.isfile(name + ext):
+                h.update(ext.encode() + b'\0')
+                hashfile(h, name + ext)
+                found.append(name + ext)
+                break
+        else:
+            h.update(b'missing')
+    return found
+
+
+def cachekey(fn, latexprog, filterprog=None):
+    """Return the cache key for the LaTeX file fn
+
+    The key depends on the contents of fn (which should already have
+    been filtered), the LaTeX program and its version, the filter
+    program, if any, every image referenced by fn via \\image,
+    \\imagecap or \\includegraphics, and every file it reads via
+    \\input or \\include, along with the images and files which
+    these read in turn.  File names are relative to the current
+    directory; files which are not found (such as those from the TeX
+    installation) only contribute their names.
+    """
+
+    h = hashlib.sha256()
+    with open(fn, 'rb') as f:
+        tex = f.read()
+    h.update(tex)
+    h.update(b'\0latex\0' + latexprog.encode() + b'\0' +
+             latexversion(latexprog).encode())
+    if filterprog:
+        h.update(b'\0filter\0' + filterprog.encode() + b'\0')
+        hashfile(h, filterprog)
+
+    text = tex.decode(errors='replace')
+    hashreferenced(h, sorted(set(image_re.findall(text))),
+                   image_extensions, b'image')
+    pending = sorted(set(input_re.findall(text)))
+    seen = set(pending)
+    while pending:
+        found = hashreferenced(h, pending, input_extensions, b'input')
+        pending = []
+        for name in found:
+            with open(name, 'rb') as f:
+                text = f.read().decode(errors='replace')
+            hashreferenced(h, sorted(set(image_re.findall(text))),
+                           image_extensions, b'image')
+            for ref in sorted(set(input_re.findall(text))):
+                if ref not in seen:
+                    seen.add(ref)
+                    pending.append(ref)
+
+    return h.hexdigest()
+
+
+def cachefile(key):
+    return os.path.join(cachedir(), key + '.pdf')
+
+
+def fetch(key, pdffile):
+    """Copy the cached PDF with this key to pdffile if it exists
+
+    Returns True if the PDF was found in the cache, False otherwise.
+    """
+
+    cached = cachefile(key)
+    try:
+        shutil.copyfile(cached, pdffile)
+        # Mark this entry as recently used
+        os.utime(cached)
+    except OSError:
+        with stats_lock:
+            stats['misses'] += 1
+        return False
+
+    with stats_lock:
+        stats['hits'] += 1
+    return True
+
+
+def store(key, pdffile, maxsize=default_cachesize):
+    """Store pdffile in the cache with this key
+
+    maxsize is the maximum size of the cache in megabytes; the least
+    recently used entries are deleted to keep within this limit.
+    """
+
+    cdir = cachedir()
+    try:
+        os.makedirs(cdir, exist_ok=True)
+        # Copy to a temporary name first, so that a concurrent run
+        # never sees a partially written PDF
+        fd, tmpname = tempfile.mkstemp(dir=cdir, suffix='.tmp')
+        os.close(fd)
+        shutil.copyfile(pdffile, tmpname)
+        os.replace(tmpname, cachefile(key))
+    except OSError as err:
+        print('Warning: could not store %s in the build cache: %s' %
+              (pdffile, err), file=sys.stderr)
+        return
+
+    with stats_lock:
+        stats['stores'] += 1
+    evict(maxsize)
+
+
+def entries():
+    """Return a list of (mtime, size, path) for all cached PDFs"""
+    cdir = cachedir()
+    result = []
+    try:
+        names = os.listdir(cdir)
+    except OSError:
+        return result
+    for name in names:
+        if not name.endswith('.pdf'):
+            continue
+        path = os.path.join(cdir, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        result.append((st.st_mtime, st.st_size, path))
+    return result
+
+
+def evict(maxsize=default_cachesize):
+    """Delete least recently used PDFs until the cache fits in maxsize MB"""
+    limit = maxsize * 1024 * 1024
+    cached = entries()
+    total = sum(size for (mtime, size, path) in cached)
+    if total <= limit:
+        return
+    cached.sort()
+    for (mtime, size, path) in cached:
+        if total <= limit:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        with stats_lock:
+            stats['evictions'] += 1
+
+
+def statsfile():
+    return os.path.join(cachedir(), 'stats.json')
+
+
+def loadstats():
+    """Return the stored cache statistics"""
+    stored = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+    try:
+        with open(statsfile()) as f:
+            stored.update(json.load(f))
+    except (OSError, ValueError):
+        pass
+    return stored
+
+
+def savestats():
+    """Add the statistics for this run to the stored statistics
+
+    Several runs may save their statistics at once, so the stored
+    statistics are read and rewritten while holding a lock on a
+    separate lock file (where the platform supports this), and the
+    new file is written under a temporary name and then renamed.
+    """
+
+    with stats_lock:
+        if not any(stats.values()):
+            return
+        runstats = dict(stats)
+        for k in stats:
+            stats[k] = 0
+
+    cdir = cachedir()
+    tmpname = None
+    try:
+        os.makedirs(cdir, exist_ok=True)
+        with open(statsfile() + '.lock', 'a') as lockfile:
+            if fcntl is not None:
+                fcntl.flock(lockfile, fcntl.LOCK_EX)
+            stored = loadstats()
+            for k in runstats:
+                stored[k] = stored.get(k, 0) + runstats[k]
+            fd, tmpname = tempfile.mkstemp(dir=cdir, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(stored, f)
+            os.replace(tmpname, statsfile())
+    except OSError:
+        if tmpname:
+            try:
+                os.remove(tmpname)
+            except OSError:
+                pass
+
+
+def report(maxsize=default_cachesize, file=sys.stdout):
+    """Print a report on the state of the cache"""
+    cached = entries()
+    total = sum(size for (mtime, size, path) in cached)
+    stored = loadstats()
+    lookups = stored['hits'] + stored['misses']
+    print('Build cache: %s' % cachedir(), file=file)
+    print('  entries:   %d' % len(cached), file=file)
+    print('  size:      %.1f MB (limit %s MB)' %
+          (total / (1024 * 1024), maxsize), file=file)
+    print('  hits:      %d' % stored['hits'], file=file)
+    print('  misses:    %d' % stored['misses'], file=file)
+    if lookups:
+        print('  hit rate:  %.1f%%' % (100 * stored['hits'] / lookups),
+              file=file)
+    print('  stored:    %d' % stored['stores'], file=file)
+    print('  evicted:   %d' % stored['evictions'], file=file)
+
+
+def auxdir(fn):
+    """Return the directory in which the auxiliary files for fn are kept
+
+    Each output file has its own directory, named after a hash of its
+    absolute path.
+    """
+    h = hashlib.sha256(os.path.abspath(fn).encode()).hexdigest()[:32]
+    return os.path.join(appdirs.user_cache_dir('jigsaw-generator'), 'aux', h)
+
+
+def restoreaux(fn, exts):
+    """Copy the kept auxiliary files for fn into place
+
+    Files which already exist alongside fn (because the previous run
+    was not cleaned) are left alone.
+    """
+
+    basename = os.path.splitext(fn)[0]
+    adir = auxdir(fn)
+    for ext in exts:
+        target = basename + '.' + ext
+        if os.path.exists(target):
+            continue
+        try:
+            shutil.copyfile(os.path.join(adir, 'aux.' + ext), target)
+        except OSError:
+            pass
+
+
+def saveaux(fn, exts):
+    """Keep copies of the auxiliary files for fn for the next run"""
+
+    basename = os.path.splitext(fn)[0]
+    adir = auxdir(fn)
+    try:
+        os.makedirs(adir, exist_ok=True)
+    except OSError:
+        return
+    for ext in exts:
+        kept = os.path.join(adir, 'aux.' + ext)
+        try:
+            shutil.copyfile(basename + '.' + ext, kept)
+        except FileNotFoundError:
+            # LaTeX did not write this one, so do not restore a stale copy
+            try:
+                os.remove(kept)
+            except OSError:
+                pass
+        except OSError:
+            pass
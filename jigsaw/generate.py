@@ -17,15 +17,38 @@ import re
 import argparse
 import subprocess
 import configparser
+import concurrent.futures
+import threading
+import hashlib
+import json
+import glob
+import time
+import tempfile
+import io
+import contextlib
+import array
 from collections import OrderedDict
 from . import appdirs
+from . import buildcache
+from . import pdftools
+from . import pieces
+from . import stream
+from . import texformat
+from . import timing
 
 import yaml
 from yaml import load, dump
+# Puzzle and layout files are only ever plain data, so we use the
+# safe loader, preferring the much faster C version
 try:
-    from yaml import CLoader as Loader, CDumper as Dumper
+    from yaml import CSafeLoader as Loader, CSafeDumper as Dumper
+    have_cloader = True
 except ImportError:
-    from yaml import Loader, Dumper
+    from yaml import SafeLoader as Loader, SafeDumper as Dumper
+    have_cloader = False
+
+# Whether the warning about the missing C loader has been given
+cloader_warned = False
 
 debug_pdb = 1
 debug_getopt = 2
@@ -53,8 +76,20 @@ sizes = [r'\tiny',
          ]
 normalsize = 4
 
-# Is any entry marked as hidden?
-exists_hidden = False
+class JigsawError(Exception):
+    """Base class for errors in generating a puzzle"""
+
+class PuzzleDataError(JigsawError):
+    """The puzzle data is missing, unreadable or invalid"""
+
+class LayoutError(JigsawError):
+    """The puzzle type or its layout file is unrecognised or invalid"""
+
+class TemplateError(JigsawError):
+    """A template file is missing or does not have the required form"""
+
+class LaTeXError(JigsawError):
+    """LaTeX failed to produce a PDF file"""
 
 def getopt(layout, data, options, opt, default=None):
     """Determine the value of opt from various possible sources
@@ -83,8 +118,13 @@ def getopt(layout, data, options, opt, default=None):
         if debug & debug_getopt:
             print('option %s set to "%s" by config' %
                   (opt, options['config'][opt]), file=sys.stderr)
-        if opt in ('clean', 'makepdf', 'makemd'):
+        if opt in ('clean', 'makepdf', 'makemd', 'cache', 'precompile',
+                   'keepaux', 'datacache', 'stream', 'combine',
+                   'splitbooklet', 'externalize', 'verbose'):
             return options['config'].getboolean(opt)
+        elif opt in ('jobs', 'cachesize', 'maxpasses', 'shardpages',
+                     'variants'):
+            return options['config'].getint(opt)
         else:
             return options['config'][opt]
     if debug & debug_getopt:
@@ -96,36 +136,458 @@ def getopt(layout, data, options, opt, default=None):
                   file=sys.stderr)
     return default
 
-def dosub(text, subs):
-    """Substitute <: var :> strings in text using the dict subs"""
-    def subtext(matchobj):
-        if matchobj.group(1) in subs:
-            return str(subs[matchobj.group(1)])
-        else:
-            print('Unrecognised substitution: %s' % matchobj.group(0),
+sub_re = re.compile(r'<:\s*(\S*?)\s*:>')
+
+class Template:
+    """A template compiled for repeated substitution
+
+    The text is split once into literal pieces and <: var :> strings,
+    so that substituting into it is just a matter of joining the
+    pieces together.  A variable with no substitution is reported and
+    replaced by nothing, which is what dosub() has always done; for a
+    template used many times, bind() does this once instead.
+    """
+
+    def __init__(self, text=''):
+        # pieces alternates literal text and variable names, beginning
+        # and ending with literal text; markers are the original
+        # <: var :> strings, for error messages
+        self.pieces = ['']
+        self.markers = []
+        pos = 0
+        for matchobj in sub_re.finditer(text):
+            self.pieces[-1] += text[pos:matchobj.start()]
+            pos = matchobj.end()
+            self.pieces += [matchobj.group(1), '']
+            self.markers.append(matchobj.group(0))
+        self.pieces[-1] += text[pos:]
+
+    def bind(self, names):
+        """Return a copy of the template for the variables names
+
+        Any other variables in the template are reported now and
+        replaced by nothing in the copy.
+        """
+        bound = Template()
+        for (i, piece) in enumerate(self.pieces):
+            if i % 2 == 0:
+                bound.pieces[-1] += piece
+            elif piece in names:
+                bound.pieces += [piece, '']
+                bound.markers.append(self.markers[i // 2])
+            else:
+                print('Unrecognised substitution: %s' % self.markers[i // 2],
+                      file=sys.stderr)
+        return bound
+
+    def value(self, subs, i):
+        """Return the value of the variable at pieces[i]
+
+        Values which are functions are handled as described for
+        writesub().
+        """
+        try:
+            value = subs[self.pieces[i]]
+        except KeyError:
+            print('Unrecognised substitution: %s' % self.markers[i // 2],
                   file=sys.stderr)
-    return re.sub(r'<:\s*(\S*?)\s*:>', subtext, text)
+            return ''
+        if callable(value):
+            buf = io.StringIO()
+            value(buf)
+            return buf.getvalue()
+        return str(value)
+
+    def render(self, subs):
+        """Return the text with the variables substituted from subs"""
+        if len(self.pieces) == 1:
+            return self.pieces[0]
+        parts = self.pieces[:]
+        for i in range(1, len(parts), 2):
+            parts[i] = self.value(subs, i)
+        return ''.join(parts)
+
+    def write(self, out, subs):
+        """Write the substituted text to out; see writesub()"""
+        for i in range(0, len(self.pieces) - 1, 2):
+            out.write(self.pieces[i])
+            value = subs.get(self.pieces[i+1])
+            if callable(value):
+                value(out)
+            else:
+                out.write(self.value(subs, i+1))
+        out.write(self.pieces[-1])
+
+class LRUCache:
+    """A cache keeping only the maxsize most recently used items
+
+    This is used for the caches which last for the whole process, so
+    that they do not grow without limit in a long-running process,
+    such as one watching for changes or using render().  It may be
+    used from several threads at once.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key, default=None):
+        """Return the item for key, or default if there is none"""
+        with self.lock:
+            try:
+                value = self.items[key]
+            except KeyError:
+                return default
+            self.items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        """Store value for key, discarding the least recently used item"""
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            if len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+# Compiled templates: text -> Template
+template_cache = LRUCache(256)
+
+def compiletemplate(text):
+    """Return text compiled as a Template, reusing an earlier compile"""
+    template = template_cache.get(text)
+    if template is None:
+        template = Template(text)
+        template_cache.put(text, template)
+    return template
+
+def compilesections(sections, subs, itemnames):
+    """Compile the sections of a card template, checking their variables
+
+    sections maps the section names, such as 'begin_page' and 'item',
+    to their text.  The item section is bound to the variables
+    itemnames and the other sections to those in subs (see
+    Template.bind()), so that any unrecognised variables are reported
+    once rather than for every card or page.
+    """
+    return dict((name, compiletemplate(text).bind(
+                    itemnames if name == 'item' else subs))
+                for (name, text) in sections.items())
+
+def dosub(text, subs):
+    """Substitute <: var :> strings in text using the dict subs
+
+    A value in subs may be a function which writes the text to be
+    substituted to the file-like object it is called with; see
+    writesub().  The text is compiled once (see Template), so the
+    same template can be substituted into cheaply many times.
+    """
+    if '<:' not in text:
+        return text
+    return compiletemplate(text).render(subs)
 
-def opentemplate(templatedirs, name):
-    """Searches for and then opens a template file.
+def writesub(out, text, subs):
+    """Write text to out, substituting <: var :> strings using subs
+
+    This is the same as out.write(dosub(text, subs)), except that a
+    value in subs which is a function is called with out to write its
+    text directly, so that long substitutions such as the rows of a
+    table never have to be held in memory as a single string.
+    """
+    compiletemplate(text).write(out, subs)
+
+class TemplateRegistry:
+    """An index of the template files in a list of directories
+
+    The directories (typically the current directory, then the user
+    config directory, then the package data directory) are listed
+    once, rather than probing each of them for every template needed.
+    If a template is not in the index, the directories are listed
+    again in case it has been created since; refresh() does the same
+    if any of the directories has changed.
+
+    The contents of template files are also kept in memory, and are
+    only read again if the file's modification time or size changes.
+    The attributes hits and misses count how often the contents were
+    found in memory or had to be read.
+    """
+
+    def __init__(self, templatedirs):
+        self.templatedirs = list(templatedirs)
+        self.lock = threading.Lock()
+        self.index = {}
+        self.dirstates = []
+        self.contents = {}
+        self.hits = 0
+        self.misses = 0
+        self.scan()
+
+    def dirstate(self, templatedir):
+        try:
+            st = os.stat(templatedir)
+            return (st.st_mtime, st.st_ino)
+        except OSError:
+            return None
+
+    def scan(self):
+        """List the template directories and rebuild the index"""
+        index = {}
+        dirstates = []
+        for templatedir in self.templatedirs:
+            dirstates.append(self.dirstate(templatedir))
+            try:
+                names = os.listdir(templatedir)
+            except OSError:
+                continue
+            for name in names:
+                if name not in index:
+                    index[name] = os.path.join(templatedir, name)
+        with self.lock:
+            self.index = index
+            self.dirstates = dirstates
+
+    def refresh(self):
+        """Rescan the directories if any of them has changed"""
+        if [self.dirstate(d) for d in self.templatedirs] != self.dirstates:
+            self.scan()
+
+    def find(self, name):
+        """Return the path of the template file name, or None"""
+        path = self.index.get(name)
+        if path is None or not os.path.isfile(path):
+            self.scan()
+            path = self.index.get(name)
+            if path is not None and not os.path.isfile(path):
+                path = None
+        return path
+
+    def read(self, name):
+        """Return the contents of the template file name
+
+        Raises TemplateError if it cannot be found or read.
+        """
+        # The stat both validates the cached contents and checks that
+        # the indexed file still exists
+        path = self.index.get(name)
+        try:
+            st = os.stat(path) if path else None
+        except OSError:
+            st = None
+        if st is None:
+            path = self.find(name)
+            st = os.stat(path) if path else None
+        if path:
+            with self.lock:
+                cached = self.contents.get(path)
+                if cached and cached[:2] == (st.st_mtime, st.st_size):
+                    self.hits += 1
+                    return cached[2]
+            try:
+                with open(path) as f:
+                    text = f.read()
+            except OSError:
+                pass
+            else:
+                with self.lock:
+                    self.misses += 1
+                    self.contents[path] = (st.st_mtime, st.st_size, text)
+                return text
+        raise TemplateError('Could not find template file %s, giving up.' %
+                            name)
+
+# Template registries: tuple of template directories -> TemplateRegistry
+registries = {}
+registries_lock = threading.Lock()
+
+def templateregistry(templatedirs):
+    """Return the TemplateRegistry for the directories templatedirs"""
+    key = tuple(templatedirs)
+    with registries_lock:
+        if key not in registries:
+            registries[key] = TemplateRegistry(key)
+        return registries[key]
+
+def findtemplate(templatedirs, name):
+    """Searches for a template file, returning its path or None.
 
     Search in the directories given in the first argument, which must
     be an iterable.  Typically, this will be the current directory, then
     the user config directory, then the package data directory.
     """
-    
-    for templatedir in templatedirs:
-        try:
-            f = open(os.path.join(templatedir, name))
-            break
-        except:
-            f = None
+
+    return templateregistry(templatedirs).find(name)
+
+@timing.timed()
+def readtemplate(templatedirs, name):
+    """Searches for a template file and returns its contents.
+
+    The search is performed by findtemplate.
+    """
+
+    return templateregistry(templatedirs).read(name)
+
+# Parsed layout files: path -> (mtime, layout)
+layout_cache = LRUCache(64)
+
+# The version of the compiled layout format; changing this
+# invalidates all of the compiled layouts on disk
+layout_format = 1
+
+# Jigsaw piece shapes and their numbers of sides
+layout_shapes = [('triangle', 3), ('square', 4)]
+
+layout_ref_re = re.compile(r'^([QAE])(\d+)$')
+
+def compilelayout(layout, puztype):
+    """Check a parsed layout and add the index arrays used for jigsaws
+
+    For each piece shape, the entries of the SolutionCards list, such
+    as 'Q19', are converted into pairs [source, index], where source
+    is 0 for a question, 1 for an answer or 2 for an edge and index
+    counts from 0; these are stored as triangleSolutionRefs and
+    squareSolutionRefs.  Raises LayoutError if the layout is invalid.
+    """
+
+    if not isinstance(layout, dict):
+        raise LayoutError('Puzzle layout file %s-layout.yaml does not '
+                          'contain a layout' % puztype)
+    if 'category' not in layout:
+        raise LayoutError('No category in puzzle layout file '
+                          '%s-layout.yaml' % puztype)
+
+    for (shape, sides) in layout_shapes:
+        cardskey = shape + 'SolutionCards'
+        if cardskey not in layout:
             continue
+        cards = layout[cardskey]
+        if not isinstance(cards, list):
+            raise LayoutError('%s in %s-layout.yaml is not a list' %
+                              (cardskey, puztype))
+
+        refs = []
+        for card in cards:
+            if not isinstance(card, list) or len(card) != sides:
+                raise LayoutError('Entry in layout file %s-layout.yaml (%s) '
+                                  'does not have %s sides:\n%s' %
+                                  (puztype, cardskey, sides, card))
+            cardrefs = []
+            for entry in card:
+                match = layout_ref_re.match(str(entry))
+                if not match or int(match.group(2)) == 0:
+                    raise LayoutError('Unrecognised entry in layout file '
+                                      '%s-layout.yaml (%s):\n%s' %
+                                      (puztype, cardskey, card))
+                source = 'QAE'.index(match.group(1))
+                index = int(match.group(2)) - 1
+                limit = layout.get('edges' if source == 2 else 'pairs')
+                if limit and index >= limit:
+                    raise LayoutError('Entry %s in layout file '
+                                      '%s-layout.yaml (%s) is out of range' %
+                                      (entry, puztype, cardskey))
+                cardrefs.append([source, index])
+            refs.append(cardrefs)
+        layout[shape + 'SolutionRefs'] = refs
+
+        # The solution orientations are a list of angles, one per
+        # card; the puzzle orientations a list of pairs of angles
+        for (orientkey, width) in [(shape + 'SolutionOrientation', 1),
+                                   (shape + 'PuzzleOrientation', 2)]:
+            orients = layout.get(orientkey)
+            if (not isinstance(orients, list) or len(orients) != len(cards)
+                or not all((isinstance(o, int) if width == 1 else
+                            isinstance(o, list) and len(o) == 2 and
+                            all(isinstance(x, int) for x in o))
+                           for o in orients)):
+                raise LayoutError('%s in layout file %s-layout.yaml must '
+                                  'have an entry for each of the %s cards' %
+                                  (orientkey, puztype, len(cards)))
+
+    return layout
+
+def layoutcachefile(text):
+    """Return the path of the compiled form of the layout file text"""
+    h = hashlib.sha256(b'%d\0' % layout_format)
+    h.update(text)
+    return os.path.join(appdirs.user_cache_dir('jigsaw-generator'),
+                        'layouts', h.hexdigest() + '.json')
+
+def savejson(cachefile, obj):
+    """Store obj on disk as JSON, if it can be stored faithfully"""
+    try:
+        text = json.dumps(obj)
+        if json.loads(text) != obj:
+            return
+    except (TypeError, ValueError):
+        return
+    try:
+        os.makedirs(os.path.dirname(cachefile), exist_ok=True)
+        # Write to a temporary name first, so that a concurrent run
+        # never sees a partially written file
+        fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(cachefile),
+                                       suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        os.replace(tmpname, cachefile)
+    except OSError:
+        pass
+
+@timing.timed()
+def loadlayout(templatedirs, puztype):
+    """Find and load the layout file for the puzzle type puztype
+
+    Layout files are parsed and checked once, and the compiled form
+    (see compilelayout()) is kept as JSON in the user cache
+    directory, named after a hash of the layout file's contents, so
+    later runs do not need to parse the YAML again.  Loaded layouts
+    are also kept in memory, so that when many puzzles are generated
+    by one process, each layout file is only loaded once; a layout is
+    reloaded if its file has been modified since.
+    """
 
-    if f:
-        return f
-    else:
-        sys.exit('Could not find template file %s, giving up.' % name)
+    path = findtemplate(templatedirs, puztype + '-layout.yaml')
+    if not path:
+        raise LayoutError('Unrecognised jigsaw type %s' % puztype)
+
+    try:
+        mtime = os.stat(path).st_mtime
+        cached = layout_cache.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        with open(path, 'rb') as layoutf:
+            text = layoutf.read()
+    except OSError:
+        raise LayoutError('Cannot read puzzle layout file %s' % path)
+
+    cachefile = layoutcachefile(text)
+    try:
+        with open(cachefile) as f:
+            layout = json.load(f)
+    except (OSError, ValueError):
+        layout = None
+
+    if not isinstance(layout, dict):
+        try:
+            layout = load(text, Loader=Loader)
+        except yaml.YAMLError as exc:
+            if hasattr(exc, 'problem_mark'):
+                mark = exc.problem_mark
+                raise LayoutError('Error parsing puzzle layout file %s.yaml\n'
+                                  'Error position: line %s, column %s' %
+                                  (puztype, mark.line+1, mark.column+1))
+            raise LayoutError('Error parsing puzzle layout file %s.yaml' %
+                              puztype)
+        compilelayout(layout, puztype)
+        savejson(cachefile, layout)
+
+    layout_cache.put(path, (mtime, layout))
+    return layout
 
 def check_special(c):
     """Check whether a card or domino is special
@@ -148,108 +610,78 @@ def check_special(c):
     'text' is not permitted in such a card, and neither is domino data.
 
     This function also performs some basic checks to ensure that the
-    card or domino entries are well-formed.
+    card or domino entries are well-formed; the returned dict is a
+    corrected copy of the entry, which is itself never modified.
     """
 
-    if isinstance(c, dict):
-        special = False
-        if 'newpage' in c:
-            special = True
-            if c['newpage'] != True:
-                print('Invalid value for newpage, only newpage: true '
-                      'permitted\nCard/Domino value: %s\nTreating as'
-                      'newpage: true anyway' % c['newpage'],
-                      file=sys.stderr)
-                c['newpage'] = True
-        if 'newlabel' in c:
-            special = True
-            if not isinstance(c['newlabel'], str):
-                print('Invalid value for newlabel entry: it must be a string.\n'
-                      'Entry value: %s' % c['newlabel'],
-                      file=sys.stderr)
-                del c['newlabel']
-        if 'newlabelsize' in c:
-            special = True
-            if not isinstance(c['newlabelsize'], int):
-                c['newlabelsize'] = int(c['newlabelsize'])
-        if special:
-            if 'text' in c:
-                print('Cannot have a special entry (newpage, newlabel, '
-                      'newlabelsize) and text\n'
-                      'on same card!  Ignoring special requests.',
-                      file=sys.stderr)
-                return None
-            else:
-                return c
-    else:
+    if not isinstance(c, dict):
+        return None
+    if not ('newpage' in c or 'newlabel' in c or 'newlabelsize' in c):
+        return None
+    if 'text' in c:
+        print('Cannot have a special entry (newpage, newlabel, '
+              'newlabelsize) and text\n'
+              'on same card!  Ignoring special requests.',
+              file=sys.stderr)
         return None
 
-def make_entry(entry, defaultsize, style,
-               defaultlabel='', defaultlabelsize=0, blank='(BLANK)',
-               solution=False):
-    """Convert a YAML entry into a LaTeX or Markdown formatted entry
-
-    Returns the pair (text, label).
-
-    The text is the content to be used for the LaTeX or Markdown.  The
-    label is only of interest for card sorts and similar activities;
-    it is ignored for jigsaws.
-
-    The YAML entry will either be a simple text entry, or it will be a
-    dictionary with required key "text" and optional entries "size",
-    "hidden" and "label".  (The "text" key can optionally be replaced
-    by "puzzletext" and "solutiontext" keys; see below.)
-
-    If there is a "size" key, this will be added to the defaultsize.
-
-    If there is a "label" key, this will override the current default
-    label; similarly for the "labelsize" key.
-
-    An entry can also include keys which are specific for the puzzle
-    and solution:
-      "puzzletext", "puzzlesize": these are the equivalent of the
-        "text" and "size" keys for the puzzle
-      "solutiontext", "solutionsize": these are the equivalent of the
-        "text" and "size" keys for the solution
-
-    The "puzzletext" and "solutiontext" override the "text" key if
-    present, while the "puzzlesize" and "solutionsize" keys override
-    the "size" key if present.  The puzzle* keys are used by default,
-    unless solution=True, in which case the solution* keys are used.
-
-    This could be used, for example, to have "?" in the puzzle and the
-    correct solution in the solution.
-
-    If a solutiontext key is present, then "hidden" is regarded as
-    being true, unless hidden: false is explicitly specified.
-
-    If solution is False (the default, so we're creating the puzzle):
-      - if there is a "puzzletext" parameter, that will be used
-      - if not, then if "hidden" is true, the text will be hidden
-      - else, "text" will be used
-
-    If solution is True:
-      - if there is a "solutiontext" parameter, that will be used, and
-        the text will be highlighted unless "hidden" is explicitly
-        false
-      - if not, then "text" will be used; if "hidden" is true, the
-        text will be marked
-
-    The "style" parameter can be:
-      "table": outputs text with no size marker; highlighted hidden
-               text will be prepended with "(*)"
-      "tikz":  outputs {regular}{size text} or {hidden}{size text},
-               where {hidden} highlights the text
-      "md":    outputs text for Markdown: highlighted hidden text will
-               be prepended with "(*)"; blank text will be replaced by
-               "(BLANK)" or the setting of the blank parameter, and
-               all entries will be surrounded on either side by a
-               blank space.  There is no size marker.
+    special = dict(c)
+    if 'newpage' in special and special['newpage'] != True:
+        print('Invalid value for newpage, only newpage: true '
+              'permitted\nCard/Domino value: %s\nTreating as'
+              'newpage: true anyway' % special['newpage'],
+              file=sys.stderr)
+        special['newpage'] = True
+    if 'newlabel' in special and not isinstance(special['newlabel'], str):
+        print('Invalid value for newlabel entry: it must be a string.\n'
+              'Entry value: %s' % special['newlabel'],
+              file=sys.stderr)
+        del special['newlabel']
+    if ('newlabelsize' in special and
+            not isinstance(special['newlabelsize'], int)):
+        special['newlabelsize'] = int(special['newlabelsize'])
+    return special
+
+class Entry:
+    """A YAML entry, normalised once for all of its renderings
+
+    The entry is checked and its size offsets parsed when the Entry is
+    created, giving the text to be shown in the puzzle and in the
+    solution.  The LaTeX conversion of each text (see img2tex()) is
+    made the first time it is needed and remembered, and is shared by
+    the puzzle and solution when they have the same text, so that each
+    rendering requested by RunContext.make_entry() only has to format
+    the result.
+    The original YAML entry is not modified.
     """
 
-    label = make_entry_label(entry, style, defaultlabel, defaultlabelsize)
+    __slots__ = ('source', 'hidden', 'label', 'labeltex', 'labelsize',
+                 'puzzle', 'solution', 'puzzletex', 'solutiontex')
+
+    def __init__(self, entry):
+        self.source = entry
+        self.hidden = False
+        self.label = self.labeltex = self.labelsize = None
+        self.puzzletex = self.solutiontex = None
+
+        # The puzzle and solution are each a tuple (text, size offset,
+        # mark hidden, show label); a text of None gives an empty
+        # entry with no size marker
+        if not isinstance(entry, dict):
+            # just a plain entry, not a dict
+            self.puzzle = self.solution = (str(entry).rstrip(), None,
+                                           False, True)
+            return
+        if len(entry) == 1 and 'text' in entry:
+            # the commonest case, with nothing more to check
+            self.puzzle = self.solution = (str(entry['text']).rstrip(), None,
+                                           False, True)
+            return
+
+        if 'label' in entry:
+            self.label = str(entry['label']).rstrip()
+        self.labelsize = entry.get('labelsize')
 
-    if isinstance(entry, dict):
         if 'text' not in entry and ('puzzletext' not in entry
                                     or 'solutiontext' not in entry):
             if 'puzzletext' in entry or 'solutiontext' in entry: 
@@ -262,9 +694,10 @@ def make_entry(entry, defaultsize, style,
                       file=sys.stderr)
             for f in entry:
                 print('  %s: %s\n' % (f, entry[f]), file=sys.stderr)
-            return (make_entry_util('', '', False, style, blank), label)
+            self.puzzle = self.solution = (None, None, False, True)
+            return
 
-        size = make_entry_size(entry, 'size', defaultsize, None,
+        size = make_entry_size(entry, 'size',
                                entry['text'] if 'text' in entry
                                else entry['puzzletext'])
 
@@ -272,140 +705,292 @@ def make_entry(entry, defaultsize, style,
         # regard 'hidden' as true, unless it is explicitly set to
         # false; doing this saves us from having to rewrite the logic
         # of the next paragraph twice.
-        if 'solutiontext' in entry:
-            if 'hidden' not in entry:
-                entry['hidden'] = True
+        hide = self.hidden = bool(entry.get('hidden',
+                                            'solutiontext' in entry))
 
-        if 'hidden' in entry and entry['hidden']:
-            global exists_hidden
-            exists_hidden = True
-            hide = True
+        if 'solutiontext' in entry:
+            solnsize = make_entry_size(entry, 'solutionsize',
+                                       entry['solutiontext'])
+            self.solution = (str(entry['solutiontext']).rstrip(),
+                             size if solnsize is None else solnsize,
+                             hide, True)
         else:
-            hide = False
-
-        if solution: 
-            if 'solutiontext' in entry:
-                solnsize = make_entry_size(entry, 'solutionsize',
-                                           defaultsize, size,
-                                           entry['solutiontext'])
-                return (make_entry_util(entry['solutiontext'],
-                                        sizes[solnsize],
-                                        hide, style, blank), label)
-            else:
-                # We know by now that we have 'text' if we don't have
-                # 'solutiontext'
-                return (make_entry_util(entry['text'], sizes[size],
-                                        hide, style, blank), label)
+            # We know by now that we have 'text' if we don't have
+            # 'solutiontext'
+            self.solution = (str(entry['text']).rstrip(), size, hide, True)
+
+        if 'puzzletext' in entry:
+            puzsize = make_entry_size(entry, 'puzzlesize',
+                                      entry['puzzletext'])
+            self.puzzle = (str(entry['puzzletext']).rstrip(),
+                           size if puzsize is None else puzsize,
+                           False, True)
+        elif hide:
+            self.puzzle = (None, None, False, False)
+        else:
+            self.puzzle = (str(entry['text']).rstrip(), size, False, True)
+
+        if self.puzzle == self.solution:
+            self.solution = self.puzzle
+
+    def tex(self, solution):
+        """Return the LaTeX conversion of the puzzle or solution text"""
+        if solution and self.solution[0] != self.puzzle[0]:
+            if self.solutiontex is None:
+                self.solutiontex = img2tex(self.solution[0] or '')
+            return self.solutiontex
+        if self.puzzletex is None:
+            self.puzzletex = img2tex(self.puzzle[0] or '')
+        return self.puzzletex
+
+    def render(self, defaultsize, style, defaultlabel='', defaultlabelsize=0,
+               blank='(BLANK)', solution=False):
+        """Return the (text, label) pair for RunContext.make_entry()"""
+        text, offset, mark_hidden, showlabel = (self.solution if solution
+                                                else self.puzzle)
+        if not showlabel:
+            label = ''
+        elif self.label is not None:
+            label = self.label
         else:
-            if 'puzzletext' in entry:
-                puzsize = make_entry_size(entry, 'puzzlesize',
-                                          defaultsize, size,
-                                          entry['puzzletext'])
-                return (make_entry_util(entry['puzzletext'],
-                                        sizes[puzsize],
-                                        False, style, blank), label)
-            elif hide:
-                return (make_entry_util('', '', False, style, blank), '')
+            label = defaultlabel.rstrip()
+
+        if style == 'md':
+            if mark_hidden:
+                return ('(*) %s' % text, label)
+            return (text or blank, label)
+
+        if label:
+            if label is self.label:
+                if self.labeltex is None:
+                    self.labeltex = img2tex(label)
+                label = self.labeltex
             else:
-                return (make_entry_util(entry['text'], sizes[size],
-                                        False, style, blank), label)
-    else:
-        # just a plain entry, not a dict
-        return (make_entry_util(entry, sizes[defaultsize], False,
-                                style, blank), label)
-
-def make_entry_size(entry, sizekey, defaultsize, entrysize, text):
-    """Return size corresponding to sizekey.
+                label = img2tex(label)
 
-    defaultsize is the global defaultsize for this puzzle.
+        if style == 'table':
+            if mark_hidden:
+                return ('(*) %s' % self.tex(solution), label)
+            return (self.tex(solution), label)
+        elif style == 'tikz':
+            if text is None:
+                size = ''
+            elif offset is None:
+                size = sizes[defaultsize]
+            else:
+                size = sizes[min(max(defaultsize + offset, 0),
+                                 len(sizes) - 1)]
+            if label:
+                labelsize = (self.labelsize if self.labelsize is not None
+                             else defaultlabelsize)
+                label = '%s %s' % (sizes[labelsize], label)
+            return ('{%s}{%s %s}' % ('hidden' if mark_hidden else 'regular',
+                                     size, self.tex(solution)), label)
+
+# The largest number of entries a RunContext keeps when the cards or
+# pairs are streamed
+entry_cache_stream_size = 4096
+
+class RunContext:
+    """The state of a single run of build()
+
+    Everything which changes while a puzzle is being generated is kept
+    here rather than in module variables, so that several puzzles can
+    be generated at the same time in different threads.  The puzzle
+    data itself is never modified.  The attributes are:
+      random         the random.Random used for shuffling and flipping
+                     (see seedrandom())
+      seed           the seed for random, or None to use the title
+      entries        the Entry for each YAML entry of the puzzle (see
+                     getentry())
+      entrylimit     the largest number of entries to keep, or None
+                     for no limit
+      exists_hidden  whether make_entry() has made a hidden entry
+    """
 
-    The default if the sizekey is not found in entry or there is a
-    problem with it is entrysize if this is set or defaultsize
-    if not.
+    def __init__(self, entrylimit=None, seed=None):
+        self.random = random.Random()
+        self.seed = seed
+        self.entries = {}
+        self.entrylimit = entrylimit
+        self.exists_hidden = False
+
+    def seedrandom(self, title):
+        """Seed the random number generator for the puzzle title
+
+        The title is used unless a seed was given, so that the same
+        puzzle is always shuffled in the same way.
+        """
+        self.random.seed(title if self.seed is None else self.seed)
+
+    def getentry(self, entry):
+        """Return the Entry for a YAML entry, creating it if needed
+
+        Dict entries are looked up by identity (each Entry keeps its
+        entry, so that the identity cannot be reused while it is
+        kept), other entries by value.  When the cards or pairs are
+        streamed, they are read afresh on each pass over them, so
+        entrylimit stops the whole deck being kept.
+        """
+        if isinstance(entry, dict):
+            key = id(entry)
+        elif isinstance(entry, str):
+            key = entry
+        else:
+            key = (type(entry), entry)
+        e = self.entries.get(key)
+        if e is None:
+            if self.entrylimit and len(self.entries) >= self.entrylimit:
+                self.entries.clear()
+            e = self.entries[key] = Entry(entry)
+        return e
+
+    def make_entry(self, entry, defaultsize, style,
+                   defaultlabel='', defaultlabelsize=0, blank='(BLANK)',
+                   solution=False):
+        """Convert a YAML entry into a LaTeX or Markdown formatted entry
+
+        Returns the pair (text, label).
+
+        The text is the content to be used for the LaTeX or Markdown.  The
+        label is only of interest for card sorts and similar activities;
+        it is ignored for jigsaws.
+
+        The YAML entry will either be a simple text entry, or it will be a
+        dictionary with required key "text" and optional entries "size",
+        "hidden" and "label".  (The "text" key can optionally be replaced
+        by "puzzletext" and "solutiontext" keys; see below.)
+
+        If there is a "size" key, this will be added to the defaultsize.
+
+        If there is a "label" key, this will override the current default
+        label; similarly for the "labelsize" key.
+
+        An entry can also include keys which are specific for the puzzle
+        and solution:
+          "puzzletext", "puzzlesize": these are the equivalent of the
+            "text" and "size" keys for the puzzle
+          "solutiontext", "solutionsize": these are the equivalent of the
+            "text" and "size" keys for the solution
+
+        The "puzzletext" and "solutiontext" override the "text" key if
+        present, while the "puzzlesize" and "solutionsize" keys override
+        the "size" key if present.  The puzzle* keys are used by default,
+        unless solution=True, in which case the solution* keys are used.
+
+        This could be used, for example, to have "?" in the puzzle and the
+        correct solution in the solution.
+
+        If a solutiontext key is present, then "hidden" is regarded as
+        being true, unless hidden: false is explicitly specified.
+
+        If solution is False (the default, so we're creating the puzzle):
+          - if there is a "puzzletext" parameter, that will be used
+          - if not, then if "hidden" is true, the text will be hidden
+          - else, "text" will be used
+
+        If solution is True:
+          - if there is a "solutiontext" parameter, that will be used, and
+            the text will be highlighted unless "hidden" is explicitly
+            false
+          - if not, then "text" will be used; if "hidden" is true, the
+            text will be marked
+
+        The "style" parameter can be:
+          "table": outputs text with no size marker; highlighted hidden
+                   text will be prepended with "(*)"
+          "tikz":  outputs {regular}{size text} or {hidden}{size text},
+                   where {hidden} highlights the text
+          "md":    outputs text for Markdown: highlighted hidden text will
+                   be prepended with "(*)"; blank text will be replaced by
+                   "(BLANK)" or the setting of the blank parameter, and
+                   all entries will be surrounded on either side by a
+                   blank space.  There is no size marker.
+        """
+
+        e = self.getentry(entry)
+        if e.hidden:
+            self.exists_hidden = True
+        return e.render(defaultsize, style, defaultlabel, defaultlabelsize,
+                        blank, solution)
+
+    def is_hidden(self, entry):
+        """Return True if make_entry() would treat entry as hidden
+
+        This allows us to know whether there are any hidden entries
+        before any of the entries have been made.
+        """
+        return self.getentry(entry).hidden
+
+def make_entry_size(entry, sizekey, text):
+    """Return the size offset given by sizekey in entry, or None
+
+    None is returned if the sizekey is not found in entry or there is
+    a problem with it; the size should then default to the entry size
+    if this is set or the puzzle's default size if not.
 
     If there's an error, use text in the error message."""
 
     if sizekey in entry:
         try:
-            size = defaultsize + int(entry[sizekey])
-            if size < 0:
-                size = 0
-            if size >= len(sizes):
-                size = len(sizes) - 1
+            return int(entry[sizekey])
         except:
             print('Unrecognised size entry for text %s:\n'
                   'size = %s\n'
                   'Defaulting to default size\n' %
                   (text, entry[sizekey]), file=sys.stderr)
-            size = entrysize if entrysize != None else defaultsize
-    else:
-        size = entrysize if entrysize != None else defaultsize
-    return size
+    return None
 
-def make_entry_util(text, size, mark_hidden, style, blank):
-    """Create the output once the text, size, hide and style are determined
+def make_notes(data, layout, hidden, dsubs, dsubsmd):
+    """Add the puzzle note and hidden entry notes to dsubs and dsubsmd
 
-    This should be called with mark_hidden being True or False; hidden
-    text should be replaced by '' before this function is called.
+    hidden says whether there are any hidden entries in the puzzle.
     """
 
-    text = text.rstrip()
-    if mark_hidden:
-        if style == 'table':
-            return '(*) %s' % img2tex(text)
-        elif style == 'tikz':
-            return '{hidden}{%s %s}' % (size, img2tex(text))
-        elif style == 'md':
-            return '(*) %s' % text
+    if hidden:
+        hiddennote = getopt(layout, data, {}, 'hiddennote',
+          'Entries that are hidden in the puzzle are highlighted in yellow.')
+        hiddennotemd = getopt(layout, data, {}, 'hiddennotemd',
+          'Entries that are hidden in the puzzle are indicated with (*).')
+        hiddennotetable = getopt(layout, data, {}, 'hiddennotetable',
+                                 hiddennotemd)
+        dsubs['hiddennotesolution'] = hiddennote
+        dsubs['hiddennotetable'] = hiddennotetable
+        dsubsmd['hiddennotemd'] = hiddennotemd
     else:
-        if style == 'table':
-            return img2tex(text)
-        elif style == 'tikz':
-            return '{regular}{%s %s}' % (size, img2tex(text))
-        elif style == 'md':
-            return '%s' % (text if text else blank)
-
-def make_entry_label(entry, style, defaultlabel, defaultlabelsize):
-    if isinstance(entry, dict):
-        if 'label' in entry:
-            labeltext = entry['label'].rstrip()
-        else:
-            labeltext = defaultlabel.rstrip()
+        dsubs['hiddennotesolution'] = ''
+        dsubs['hiddennotetable'] = ''
+        dsubsmd['hiddennotemd'] = ''
 
-        if 'labelsize' in entry:
-            labelsize = entry['labelsize']
-        else:
-            labelsize = defaultlabelsize
-    else:
-        labeltext = defaultlabel.rstrip()
-        labelsize = defaultlabelsize
-
-    if style == 'table':
-        return img2tex(labeltext)
-    elif style == 'tikz':
-        if labeltext:
-            return '%s %s' % (sizes[labelsize], img2tex(labeltext))
-        else:
-            return ''
-    elif style == 'md':
-        return labeltext
+    dsubs['puzzlenote'] = getopt(layout, data, {}, 'note', '')
+    dsubsmd['puzzlenote'] = getopt(layout, data, {}, 'note', '')
 
 img_re = re.compile(r'!\[([^\]]*)\]\(([^\)]*)\)')
 
-def img2tex(text):
-    text = str(text)  # just in case the text is purely numeric
-    images = img_re.search(text)
-    while images:
-        caption, img = images.groups()
-        if caption:
-            text = img_re.sub(r'\imagecap{%s}{%s}' % (img, caption),
-                              text, count=1)
-        else:
-            text = img_re.sub(r'\image{%s}' % img, text, count=1)
+# Converted texts which contained images: text -> LaTeX.  This is
+# shared by all of the entries, labels and tables of a run.
+image_cache = LRUCache(4096)
+
+def img2tex_sub(match):
+    caption, img = match.groups()
+    if caption:
+        return r'\imagecap{%s}{%s}' % (img, caption)
+    else:
+        return r'\image{%s}' % img
 
-        images = img_re.search(text)
+def img2tex(text):
+    """Convert the Markdown images ![caption](file) in text to LaTeX
 
-    return text
+    All of the images are replaced in a single pass over the text.
+    """
+    text = str(text)  # just in case the text is purely numeric
+    if '![' not in text:
+        return text
+    tex = image_cache.get(text)
+    if tex is None:
+        tex = img_re.sub(img2tex_sub, text)
+        image_cache.put(text, tex)
+    return tex
 
 def cardnum(n):
     """Underline 6 and 9; return everything else as a string"""
@@ -414,49 +999,71 @@ def cardnum(n):
     else:
         return str(n)
 
-def make_table(pairs, edges, cards, dsubs, dsubsmd):
-    """Create table substitutions for the pairs and edges"""
-    dsubs['tablepairs'] = ''
-    dsubs['tableedges'] = ''
-    dsubs['tablecards'] = ''
-    dsubsmd['pairs'] = ''
-    dsubsmd['edges'] = ''
-    dsubsmd['cards'] = ''
-
-    for p in pairs:
-        dsubs['tablepairs'] += ((r'%s&%s\\ \hline' '\n') %
-            (make_entry(p[0], normalsize, 'table', solution=True)[0],
-             make_entry(p[1], normalsize, 'table', solution=True)[0]))
-        row = '|'
-        for entry in p:
-            row += ' ' + make_entry(entry, 0, 'md', solution=True)[0] + ' |'
-        dsubsmd['pairs'] += row + '\n'
-        
-    for e in edges:
-        dsubs['tableedges'] += ((r'\strut %s\\ \hline' '\n') %
-                                make_entry(e, normalsize, 'table',
-                                           solution=True)[0])
-        dsubsmd['edges'] += ('| ' + make_entry(e, 0, 'md', solution=True)[0] +
-                             ' |\n')
-
-    # The next bit is only used for the PDF version of the table output,
+@timing.timed()
+def make_table(ctx, pairs, edges, cards, dsubs, dsubsmd):
+    """Create table substitutions for the pairs and edges
+
+    The substitutions are functions which write the rows of the table
+    when the template is written (see writesub()), so that the table
+    for a large deck is never held in memory in one piece.
+    """
+
+    def tablepairs(out):
+        for p in pairs:
+            out.write((r'%s&%s\\ \hline' '\n') %
+                (ctx.make_entry(p[0], normalsize, 'table', solution=True)[0],
+                 ctx.make_entry(p[1], normalsize, 'table', solution=True)[0]))
+
+    def tablepairsmd(out):
+        for p in pairs:
+            row = '|'
+            for entry in p:
+                row += (' ' +
+                        ctx.make_entry(entry, 0, 'md', solution=True)[0] +
+                        ' |')
+            out.write(row + '\n')
+
+    def tableedges(out):
+        for e in edges:
+            out.write((r'\strut %s\\ \hline' '\n') %
+                      ctx.make_entry(e, normalsize, 'table', solution=True)[0])
+
+    def tableedgesmd(out):
+        for e in edges:
+            out.write('| ' + ctx.make_entry(e, 0, 'md', solution=True)[0] +
+                      ' |\n')
+
+    # The cards are only used for the PDF version of the table output,
     # so we don't make too much effort over label handling
-    defaultlabel = dsubs['label'] if 'label' in dsubs else ''
-    for c in cards:
-        s = check_special(c)
-        if s:
-            if 'newlabel' in c:
-                defaultlabel = c['newlabel']
-            continue
-        cont, label = make_entry(c, normalsize, 'table',
-                                 defaultlabel, normalsize, solution=True)
-        dsubs['tablecards'] += ((r'%s%s\\ \hline' '\n') %
-                                (('[' + label + '] ' if label else ''), cont))
-        cont, label = make_entry(c, 0, 'md', defaultlabel, solution=True)
-        dsubsmd['cards'] += ('| %s%s |\n' %
-                             (('[' + label + '] ' if label else ''), cont))
-
-def make_triangles(data, layout, pairs, edges, dsubs, dsubsmd):
+    def tablecards(out, style='table'):
+        defaultlabel = dsubs['label'] if 'label' in dsubs else ''
+        for c in cards:
+            s = check_special(c)
+            if s:
+                if 'newlabel' in s:
+                    defaultlabel = s['newlabel']
+                continue
+            if style == 'table':
+                cont, label = ctx.make_entry(c, normalsize, 'table',
+                                         defaultlabel, normalsize,
+                                         solution=True)
+                out.write((r'%s%s\\ \hline' '\n') %
+                          (('[' + label + '] ' if label else ''), cont))
+            else:
+                cont, label = ctx.make_entry(c, 0, 'md', defaultlabel,
+                                         solution=True)
+                out.write('| %s%s |\n' %
+                          (('[' + label + '] ' if label else ''), cont))
+
+    dsubs['tablepairs'] = tablepairs
+    dsubs['tableedges'] = tableedges
+    dsubs['tablecards'] = tablecards
+    dsubsmd['pairs'] = tablepairsmd
+    dsubsmd['edges'] = tableedgesmd
+    dsubsmd['cards'] = lambda out: tablecards(out, 'md')
+
+@timing.timed()
+def make_triangles(ctx, data, layout, pairs, edges, dsubs, dsubsmd):
     """Handle triangular-shaped jigsaw pieces, putting in the Qs and As
 
     Read the puzzle layout and the puzzle data, and fill in questions
@@ -474,22 +1081,13 @@ def make_triangles(data, layout, pairs, edges, dsubs, dsubsmd):
     # data into our lists.  We don't format them yet, as the
     # formatting may be different for the puzzle and solution
 
+    # The entries have already been converted to (source, index) pairs
+    # by compilelayout(), source being 0 for Q, 1 for A and 2 for E
     trianglesolcard = []
-    for card in layout['triangleSolutionCards']:
-        newcard = []
-        for entry in card:
-            entrynum = int(entry[1:]) - 1  # -1 to convert to 0-based arrays
-            if entry[0] == 'Q':
-                newcard.append(pairs[entrynum][0])
-            elif entry[0] == 'A':
-                newcard.append(pairs[entrynum][1])
-            elif entry[0] == 'E':
-                newcard.append(edges[entrynum])
-            else:
-                printf('Unrecognised entry in layout file '
-                       '(triangleSolutionCards):\n%s' % card,
-                       file=sys.stderr)
-        trianglesolcard.append(newcard)
+    for card in layout['triangleSolutionRefs']:
+        trianglesolcard.append([pairs[index][source] if source < 2
+                                else edges[index]
+                                for (source, index) in card])
 
     # List: direction of base side
     trianglesolorient = layout['triangleSolutionOrientation']
@@ -498,7 +1096,7 @@ def make_triangles(data, layout, pairs, edges, dsubs, dsubsmd):
     trianglepuzorient = layout['trianglePuzzleOrientation']
 
     triangleorder = list(range(num_triangle_cards))
-    random.shuffle(triangleorder)
+    ctx.random.shuffle(triangleorder)
 
     trianglepuzcard = [[]] * num_triangle_cards
 
@@ -506,7 +1104,7 @@ def make_triangles(data, layout, pairs, edges, dsubs, dsubsmd):
     # rotated by a random amount
     for (i, solcard) in enumerate(trianglesolcard):
         j = triangleorder[i]
-        rot = random.randint(0, 2) # anticlockwise rotation
+        rot = ctx.random.randint(0, 2) # anticlockwise rotation
         trianglepuzcard[j] = [solcard[(3 - rot) % 3],
                               solcard[(4 - rot) % 3],
                               solcard[(5 - rot) % 3],
@@ -522,16 +1120,19 @@ def make_triangles(data, layout, pairs, edges, dsubs, dsubsmd):
         solcard.extend([cardnum(j + 1), (angle + 180) % 360 - 180])
 
         dsubs['trisolcard' + str(i + 1)] = (('{%s}' * 5) %
-            (make_entry(solcard[0], solution_size, 'tikz', solution=True)[0],
-             make_entry(solcard[1], solution_size, 'tikz', solution=True)[0],
-             make_entry(solcard[2], solution_size, 'tikz', solution=True)[0],
+            (ctx.make_entry(solcard[0], solution_size, 'tikz',
+                            solution=True)[0],
+             ctx.make_entry(solcard[1], solution_size, 'tikz',
+                            solution=True)[0],
+             ctx.make_entry(solcard[2], solution_size, 'tikz',
+                            solution=True)[0],
              ('%s %s' % (sizes[max(solution_size-3, 0)], solcard[3]))
              if numbering_cards else '',
              solcard[4]))
         dsubs['tripuzcard' + str(j + 1)] = (('{%s}' * 5) %
-            (make_entry(puzcard[0], puzzle_size, 'tikz')[0],
-             make_entry(puzcard[1], puzzle_size, 'tikz')[0],
-             make_entry(puzcard[2], puzzle_size, 'tikz')[0],
+            (ctx.make_entry(puzcard[0], puzzle_size, 'tikz')[0],
+             ctx.make_entry(puzcard[1], puzzle_size, 'tikz')[0],
+             ctx.make_entry(puzcard[2], puzzle_size, 'tikz')[0],
              ('%s %s' % (sizes[max(puzzle_size-3, 0)], puzcard[3]))
              if numbering_cards else '',
              puzcard[4]))
@@ -547,7 +1148,7 @@ def make_triangles(data, layout, pairs, edges, dsubs, dsubsmd):
     for t in trianglepuzcard:
         row = '|'
         for entry in t[0:3]:
-            row += ' ' + make_entry(entry, 0, 'md')[0] + ' |'
+            row += ' ' + ctx.make_entry(entry, 0, 'md')[0] + ' |'
         dsubsmd['puzcards3'] += row + '\n'
         dsubsmd['puzcards4'] += row + ' &nbsp; |\n'
 
@@ -560,7 +1161,8 @@ def make_triangles(data, layout, pairs, edges, dsubs, dsubsmd):
     #     print('Puz card %s: (%s, %s, %s), num angle %s' %
     #            (i, card[0], card[1], card[2], card[3]))
 
-def make_squares(data, layout, pairs, edges, dsubs, dsubsmd):
+@timing.timed()
+def make_squares(ctx, data, layout, pairs, edges, dsubs, dsubsmd):
     """Handle square-shaped jigsaw pieces, putting in the Qs and As
 
     Read the puzzle layout and the puzzle data, and fill in questions
@@ -581,22 +1183,13 @@ def make_squares(data, layout, pairs, edges, dsubs, dsubsmd):
     # data into our lists.  We don't format them yet, as the
     # formatting may be different for the puzzle and solution
 
+    # The entries have already been converted to (source, index) pairs
+    # by compilelayout(), source being 0 for Q, 1 for A and 2 for E
     squaresolcard = []
-    for card in layout['squareSolutionCards']:
-        newcard = []
-        for entry in card:
-            entrynum = int(entry[1:]) - 1  # -1 to convert to 0-based arrays
-            if entry[0] == 'Q':
-                newcard.append(pairs[entrynum][0])
-            elif entry[0] == 'A':
-                newcard.append(pairs[entrynum][1])
-            elif entry[0] == 'E':
-                newcard.append(edges[entrynum])
-            else:
-                printf('Unrecognised entry in layout file '
-                       '(squareSolutionCards):\n%s' % card,
-                       file=sys.stderr)
-        squaresolcard.append(newcard)
+    for card in layout['squareSolutionRefs']:
+        squaresolcard.append([pairs[index][source] if source < 2
+                              else edges[index]
+                              for (source, index) in card])
 
     # List: direction of base side
     squaresolorient = layout['squareSolutionOrientation']
@@ -605,7 +1198,7 @@ def make_squares(data, layout, pairs, edges, dsubs, dsubsmd):
     squarepuzorient = layout['squarePuzzleOrientation']
 
     squareorder = list(range(num_square_cards))
-    random.shuffle(squareorder)
+    ctx.random.shuffle(squareorder)
 
     squarepuzcard = [[]] * num_square_cards
 
@@ -613,7 +1206,7 @@ def make_squares(data, layout, pairs, edges, dsubs, dsubsmd):
     # rotated by a random amount
     for (i, solcard) in enumerate(squaresolcard):
         j = squareorder[i]
-        rot = random.randint(0, 3) # anticlockwise rotation
+        rot = ctx.random.randint(0, 3) # anticlockwise rotation
         squarepuzcard[j] = [solcard[(4 - rot) % 4],
                             solcard[(5 - rot) % 4],
                             solcard[(6 - rot) % 4],
@@ -632,18 +1225,22 @@ def make_squares(data, layout, pairs, edges, dsubs, dsubsmd):
                         (angle + 180) % 360 - 180])
 
         dsubs['sqsolcard' + str(i + 1)] = (('{%s}' * 6) %
-            (make_entry(solcard[0], solution_size, 'tikz', solution=True)[0],
-             make_entry(solcard[1], solution_size, 'tikz', solution=True)[0],
-             make_entry(solcard[2], solution_size, 'tikz', solution=True)[0],
-             make_entry(solcard[3], solution_size, 'tikz', solution=True)[0],
+            (ctx.make_entry(solcard[0], solution_size, 'tikz',
+                            solution=True)[0],
+             ctx.make_entry(solcard[1], solution_size, 'tikz',
+                            solution=True)[0],
+             ctx.make_entry(solcard[2], solution_size, 'tikz',
+                            solution=True)[0],
+             ctx.make_entry(solcard[3], solution_size, 'tikz',
+                            solution=True)[0],
              ('%s %s' % (sizes[max(solution_size-3, 0)], solcard[4]))
              if numbering_cards else '',
              solcard[5]))
         dsubs['sqpuzcard' + str(j + 1)] = (('{%s}' * 6) %
-            (make_entry(puzcard[0], puzzle_size, 'tikz')[0],
-             make_entry(puzcard[1], puzzle_size, 'tikz')[0],
-             make_entry(puzcard[2], puzzle_size, 'tikz')[0],
-             make_entry(puzcard[3], puzzle_size, 'tikz')[0],
+            (ctx.make_entry(puzcard[0], puzzle_size, 'tikz')[0],
+             ctx.make_entry(puzcard[1], puzzle_size, 'tikz')[0],
+             ctx.make_entry(puzcard[2], puzzle_size, 'tikz')[0],
+             ctx.make_entry(puzcard[3], puzzle_size, 'tikz')[0],
              ('%s %s' % (sizes[max(puzzle_size-3, 0)], puzcard[4]))
              if numbering_cards else '',
              puzcard[5]))
@@ -657,7 +1254,7 @@ def make_squares(data, layout, pairs, edges, dsubs, dsubsmd):
     for t in squarepuzcard:
         row = '|'
         for entry in t[0:4]:
-            row += ' ' + make_entry(entry, 0, 'md')[0] + ' |'
+            row += ' ' + ctx.make_entry(entry, 0, 'md')[0] + ' |'
         dsubsmd['puzcards4'] += row + '\n'
 
     # Testing:
@@ -670,13 +1267,90 @@ def make_squares(data, layout, pairs, edges, dsubs, dsubsmd):
     #            (i, card[0], card[1], card[2], card[3], card[4]))
 
 
-def make_cardsort_cards(data, layout, options,
-                        cards, puztemplate, soltemplate,
-                        puztemplatemd, soltemplatemd, dsubs, dsubsmd):
-    """Handle card sorting cards, making the content for puzzle and solution
+# When the shardpages option is set, these comment lines are written
+# to the LaTeX card documents before each page and after the last
+# page, so that splitshards() can split the documents up
+shard_page_mark = '%%% jigsaw-generate: page\n'
+shard_end_mark = '%%% jigsaw-generate: end of pages\n'
+
+def shardmarks(layout, data, options):
+    """Return the page and end marks to write to the card documents
 
-    The body content is returned via the dictionaries as dsubs['puzbody'],
-    dsubs['solbody'] and similarly for dsubsmd.
+    These are empty unless the shardpages option is set.
+    """
+    if getopt(layout, data, options, 'shardpages', 0):
+        return (shard_page_mark, shard_end_mark)
+    else:
+        return ('', '')
+
+def scancards(ctx, data, layout, cards, checkhidden):
+    """Read through the cards once before any of them are made
+
+    Returns (numcards, numpages, hidden, realcards).  numcards is the
+    number of cards, special cards included, and numpages is the pair
+    (puzzle pages, solution pages): knowing these saves LaTeX from
+    having to work them out with an extra pass.  hidden is True if
+    checkhidden is true and any card is hidden.
+
+    If the cards are shuffled, the puzzle needs them in a different
+    order from the solution, so realcards is then the real cards, as
+    opposed to the special cards, in their original order; it is
+    otherwise None.  The whole deck must be kept for this, in memory
+    unless the cards are streamed, when it is kept in a temporary file
+    (see stream.SpooledItems).
+    """
+
+    rows = getopt(layout, data, {}, 'rows')
+    columns = getopt(layout, data, {}, 'columns')
+    shufflecards = getopt(layout, data, {}, 'shuffleCards', False)
+    if not shufflecards:
+        realcards = None
+    elif isinstance(cards, stream.ItemSource):
+        realcards = stream.SpooledItems()
+    else:
+        realcards = []
+
+    # newpage is ignored in the solution and for shuffled cards
+    numcards = 0
+    numreal = 0
+    puzpages = 0
+    pagecards = 0
+    hidden = False
+    for c in cards:
+        numcards += 1
+        if check_special(c):
+            if 'newpage' in c and not shufflecards:
+                pagecards = 0
+            continue
+        numreal += 1
+        if pagecards == 0:
+            puzpages += 1
+        pagecards = (pagecards + 1) % (rows * columns)
+        if checkhidden and not hidden:
+            hidden = ctx.is_hidden(c)
+        if shufflecards:
+            realcards.append(c)
+
+    return (numcards, (puzpages, -(-numreal // (rows * columns))),
+            hidden, realcards)
+
+@timing.timed()
+def make_cardsort_cards(ctx, data, layout, options,
+                        cards, realcards, numpages,
+                        puztemplate, soltemplate,
+                        puztemplatemd, soltemplatemd, dsubs, dsubsmd,
+                        puzout, solout, puzoutmd, soloutmd):
+    """Handle card sorting cards, writing the puzzle and solution bodies
+
+    The body content is written to puzout, solout, puzoutmd and
+    soloutmd as each page and card is produced; any of these may be
+    None if that output is not wanted.  dsubs and dsubsmd must
+    already contain the document-wide substitutions (title, hidden
+    notes and so on); the card layout substitutions are added here,
+    and numpages, the number of pages in the puzzle and solution
+    documents, are substituted for <: numpages :>.  realcards is as
+    returned by scancards(), and the cards are otherwise read through
+    once in order, so may be streamed.
 
     Special card content does special things:
 
@@ -721,33 +1395,42 @@ def make_cardsort_cards(data, layout, options,
     dsubs['cardseph'] = cardseph
     dsubs['cardsepv'] = cardsepv
 
-    # We do a presift of the cards to identify the real cards as
-    # opposed to the special cards.  It would be more efficient to
-    # only read through the cards once, but that would make the code
-    # more complex than needed, and this part of the code is fairly
-    # fast anyway.
-
-    # When we are done, realcards will contain the indices of all real
-    # cards in the cards list.
-    realcards = []
-    for (i, c) in enumerate(cards):
-        if check_special(c):
-            continue
-        else:
-            realcards.append(i)
-
-    num_cards = len(realcards)
-    cardorder = list(range(num_cards))
+    # If the cards are shuffled, puzzle card i is real card
+    # cardorder[i], and invcardorder is the inverse of this; these are
+    # arrays rather than lists to keep a large deck small in memory
     shufflecards = getopt(layout, data, {}, 'shuffleCards', False)
     if shufflecards:
-        random.shuffle(cardorder)
-    invcardorder = {j: i for (i, j) in enumerate(cardorder)}
-
-    puzbody = puztemplate['begin_document']
-    puzbodymd = puztemplatemd['begin_document']
-    if dosoln:
-        solbody = soltemplate['begin_document']
-        solbodymd = soltemplatemd['begin_document']
+        cardorder = array.array('q', range(len(realcards)))
+        ctx.random.shuffle(cardorder)
+        invcardorder = array.array('q', cardorder)
+        for (i, j) in enumerate(cardorder):
+            invcardorder[j] = i
+
+    puzdsubs = dict(dsubs, numpages=numpages[0])
+    soldsubs = dict(dsubs, numpages=numpages[1])
+
+    if not dosoln:
+        solout = soloutmd = None
+
+    # The templates are compiled once for the whole deck
+    itemnames = ['rownum', 'colnum', 'cardnum', 'text', 'label']
+    docs = [(puzout, puztemplate, puzdsubs),
+            (solout, soltemplate, soldsubs),
+            (puzoutmd, puztemplatemd, dsubsmd),
+            (soloutmd, soltemplatemd, dsubsmd)]
+    docs = [(out, compilesections(template, subs, itemnames), subs)
+            if out else (out, None, subs)
+            for (out, template, subs) in docs]
+    (puztemplate, soltemplate, puztemplatemd, soltemplatemd) = [
+        template for (out, template, subs) in docs]
+    (puzitem, solitem, puzitemmd, solitemmd) = [
+        template['item'] if out else None for (out, template, subs) in docs]
+
+    for (out, template, subs) in docs:
+        if out:
+            out.write(template['begin_document'].render(subs))
+
+    (pagemark, endmark) = shardmarks(layout, data, options)
 
     # We will put solution card i in puzzle position cardorder[i].
     i = 0 
@@ -755,11 +1438,11 @@ def make_cardsort_cards(data, layout, options,
     for c in cards:
         s = check_special(c)
         if s:
-            if 'newlabel' in c:
-                defaultlabel = c['newlabel']
-            if 'newlabelsize' in c:
-                defaultlabelsize = c['newlabelsize']
-            if 'newpage' in c:
+            if 'newlabel' in s:
+                defaultlabel = s['newlabel']
+            if 'newlabelsize' in s:
+                defaultlabelsize = s['newlabelsize']
+            if 'newpage' in s:
                 # this would presumably only occur for non-shuffled cards;
                 # it would make no sense otherwise
                 if shufflecards:
@@ -776,74 +1459,82 @@ def make_cardsort_cards(data, layout, options,
         solsubs = { 'rownum': row, 'colnum': col }
         puzsubsmd = dict(puzsubs)
         solsubsmd = dict(solsubs)
+        solnum = invcardorder[i] + 1 if shufflecards else i + 1
         if numbering_cards:
             puzsubs['cardnum'] = '%s %s' % (sizes[max(size-3, 0)], i + 1)
-            solsubs['cardnum'] = '%s %s' % (sizes[max(size-3, 0)],
-                                            invcardorder[i] + 1)
+            solsubs['cardnum'] = '%s %s' % (sizes[max(size-3, 0)], solnum)
             puzsubsmd['cardnum'] = str(i + 1)
-            solsubsmd['cardnum'] = str(invcardorder[i] + 1)
+            solsubsmd['cardnum'] = str(solnum)
         else:
             puzsubs['cardnum'] = ''
             solsubs['cardnum'] = ''
             puzsubsmd['cardnum'] = ''
             solsubsmd['cardnum'] = ''
 
-        if pagecards == 0:
+        if puzout and pagecards == 0:
             if i > 0:
-                puzbody += puztemplate['end_page']
-            puzbody += puztemplate['begin_page']
-        if dosoln and i % (rows * columns) == 0:
+                puzout.write(puztemplate['end_page'].render(puzdsubs))
+            puzout.write(pagemark)
+            puzout.write(puztemplate['begin_page'].render(puzdsubs))
+        if solout and i % (rows * columns) == 0:
             if i > 0:
-                solbody += soltemplate['end_page']
-            solbody += soltemplate['begin_page']
-        
-        puzsubs['text'], puzsubs['label'] = make_entry(
-            cards[realcards[cardorder[i]]], size, 'tikz',
-            defaultlabel, defaultlabelsize)
-        puzbody += dosub(puztemplate['item'], puzsubs)
-        puzsubsmd['text'], puzsubsmd['label'] = make_entry(
-            cards[realcards[cardorder[i]]], 0, 'md', defaultlabel,
-            blank='&nbsp;')
-        puzbodymd += dosub(puztemplatemd['item'], puzsubsmd)
-        if dosoln:
-            solsubs['text'], solsubs['label'] = make_entry(
-                cards[realcards[i]], size, 'tikz',
-                defaultlabel, defaultlabelsize, solution=True)
-            solbody += dosub(soltemplate['item'], solsubs)
-            solsubsmd['text'], solsubsmd['label'] = make_entry(
-                cards[realcards[i]], 0, 'md', defaultlabel,
-                blank='&nbsp;', solution=True)
-            solbodymd += dosub(soltemplatemd['item'], solsubsmd)
+                solout.write(soltemplate['end_page'].render(soldsubs))
+            solout.write(pagemark)
+            solout.write(soltemplate['begin_page'].render(soldsubs))
+
+        # The card text is itself substituted using the document
+        # substitutions, as it always has been.  generate_cardsort()
+        # has already looked for hidden entries, so we can render the
+        # Entry for each card directly.
+        solentry = ctx.getentry(c)
+        if shufflecards:
+            puzentry = ctx.getentry(realcards[cardorder[i]])
+        else:
+            puzentry = solentry
+        if puzout:
+            puzsubs['text'], puzsubs['label'] = puzentry.render(
+                size, 'tikz', defaultlabel, defaultlabelsize)
+            puzout.write(dosub(puzitem.render(puzsubs), puzdsubs))
+        if puzoutmd:
+            puzsubsmd['text'], puzsubsmd['label'] = puzentry.render(
+                0, 'md', defaultlabel, blank='&nbsp;')
+            puzoutmd.write(dosub(puzitemmd.render(puzsubsmd), dsubsmd))
+        if solout:
+            solsubs['text'], solsubs['label'] = solentry.render(
+                size, 'tikz', defaultlabel, defaultlabelsize, solution=True)
+            solout.write(dosub(solitem.render(solsubs), soldsubs))
+        if soloutmd:
+            solsubsmd['text'], solsubsmd['label'] = solentry.render(
+                0, 'md', defaultlabel, blank='&nbsp;', solution=True)
+            soloutmd.write(dosub(solitemmd.render(solsubsmd), dsubsmd))
 
         i += 1
         pagecards += 1
         if pagecards == rows * columns:
             pagecards = 0
 
-    puzbody += puztemplate['end_page']
-    if dosoln: solbody += soltemplate['end_page']
-
-    puzbody += puztemplate['end_document']
-    puzbodymd += puztemplatemd['end_document']
-    if dosoln:
-        solbody += soltemplate['end_document']
-        solbodymd += soltemplatemd['end_document']
+    if puzout:
+        puzout.write(puztemplate['end_page'].render(puzdsubs))
+        puzout.write(endmark)
+    if solout:
+        solout.write(soltemplate['end_page'].render(soldsubs))
+        solout.write(endmark)
 
-    dsubs['puzbody'] = puzbody
-    dsubsmd['puzbody'] = puzbodymd
-    if dosoln:
-        dsubs['solbody'] = solbody
-        dsubsmd['solbody'] = solbodymd
+    for (out, template, subs) in docs:
+        if out:
+            out.write(template['end_document'].render(subs))
 
-def make_domino_cards(data, layout, options,
+@timing.timed()
+def make_domino_cards(ctx, data, layout, options,
                       pairs, puztemplate, soltemplate,
-                      puztemplatemd, soltemplatemd, dsubs, dsubsmd):
-    """Handle domino cards, making the content for puzzle and solution
-
-    This is very similar to the make_cardsort_cards function.
-
-    The body content is returned via the dictionaries as dsubs['puzbody'],
-    dsubs['solbody'] and similarly for dsubsmd.
+                      puztemplatemd, soltemplatemd, dsubs, dsubsmd,
+                      puzout, solout, puzoutmd, soloutmd):
+    """Handle domino cards, writing the puzzle and solution bodies
+
+    This is very similar to the make_cardsort_cards function, and the
+    body content is written in the same way.  pairs need not be a
+    list, but can be anything which can be indexed, such as a
+    PairView.
     """
 
     numbering_cards = getopt(layout, data, {}, 'numberCards', True)
@@ -875,34 +1566,25 @@ def make_domino_cards(data, layout, options,
     start = getopt(layout, data, {}, 'start', 'Start')
     finish = getopt(layout, data, {}, 'finish', 'Finish')
 
-    # We temporarily append a terminal pair if we're not looping
+    # We append a terminal pair if we're not looping, in the view of
+    # the pairs so as not to modify the puzzle data
     if not loop:
-        pairs.append([finish, start])
-
-    # We do a presift of the domino pairs to identify the real pairs
-    # as opposed to the special ones.  It would be more efficient to
-    # only read through the dominoes once, but that would make the code
-    # more complex than needed, and this part of the code is fairly
-    # fast anyway.
-
-    # At present, there should not be any special domino pairs, but we
-    # leave this code (based on make_cardsort_cards) in case we later
-    # decide to allow this.
-
-    # When we are done, realpairs will contain the indices of all real
-    # pairs in the pairs list.
-    realpairs = []
-    for (i, p) in enumerate(pairs):
-        if check_special(p):
-            continue
-        else:
-            realpairs.append(i)
-
-    num_pairs = len(realpairs)
-    cardorder = list(range(num_pairs))
-    # In dominoes, we must shuffle the printing order!
-    random.shuffle(cardorder)
-    invcardorder = {j: i for (i, j) in enumerate(cardorder)}
+        pairs = PairView(pairs, extra=[[finish, start]])
+
+    # In dominoes, we must shuffle the printing order!  Puzzle card i
+    # is made from solution card cardorder[i], and invcardorder is the
+    # inverse of this; these are arrays rather than lists to keep a
+    # large set small in memory.  The pairs are read from pairs in
+    # this order for the puzzle and in their own order for the
+    # solution, so pairs must allow this: the whole set is held in
+    # memory unless it is streamed, when generate_cardsort() keeps it
+    # in a temporary file instead.
+    num_pairs = len(pairs)
+    cardorder = array.array('q', range(num_pairs))
+    ctx.random.shuffle(cardorder)
+    invcardorder = array.array('q', cardorder)
+    for (i, j) in enumerate(cardorder):
+        invcardorder[j] = i
 
     # This is how the cards will be laid out (where n=num_pairs-1,
     # where num_pairs is the number of pairs if loop == True and one
@@ -917,31 +1599,32 @@ def make_domino_cards(data, layout, options,
     # solution card n-1: A(n-2) - Q(n-1)
     # solution card n: A(n-1) - Qn
 
-    puzbody = puztemplate['begin_document']
-    puzbodymd = puztemplatemd['begin_document']
-    solbody = soltemplate['begin_document']
-    solbodymd = soltemplatemd['begin_document']
-
-    # We will put solution card i in puzzle position cardorder[i].
-    i = 0 
-    for p in pairs:
-        s = check_special(p)
-        if s:
-            print('Special cards are not accepted for dominoes',
-                  file=sys.stderr)
-            continue
-            # the following will never be executed, but it remains in
-            # case we decide to resurrect this behaviour
-            if 'newlabel' in p:
-                defaultlabel = p['newlabel']
-            if 'newlabelsize' in p:
-                defaultlabelsize = p['newlabelsize']
-            if 'newpage' in p:
-                # this does not make sense for dominoes
-                print('newpage makes no sense for dominoes! Ignoring.',
-                      file=sys.stderr)
-            continue
-
+    numdsubs = dict(dsubs, numpages=-(-num_pairs // (rows * columns)))
+
+    # The templates are compiled once for the whole set
+    itemnames = ['rownum', 'colnum', 'cardnum',
+                 'textL', 'labelL', 'textR', 'labelR']
+    docs = [(puzout, puztemplate, numdsubs),
+            (solout, soltemplate, numdsubs),
+            (puzoutmd, puztemplatemd, dsubsmd),
+            (soloutmd, soltemplatemd, dsubsmd)]
+    docs = [(out, compilesections(template, subs, itemnames), subs)
+            if out else (out, None, subs)
+            for (out, template, subs) in docs]
+    (puzitem, solitem, puzitemmd, solitemmd) = [
+        template['item'] if out else None for (out, template, subs) in docs]
+
+    for (out, template, subs) in docs:
+        if out:
+            out.write(template['begin_document'].render(subs))
+
+    (pagemark, endmark) = shardmarks(layout, data, options)
+
+    # There are no special pairs for dominoes, as readpairs() only
+    # accepts lists of two entries.  The previous solution pair is
+    # kept, so that each pair is only read once for the solution.
+    prevpair = pairs[num_pairs - 1]
+    for i in range(num_pairs):
         row = (i % (rows * columns)) // columns + 1
         col = i % columns + 1
         puzsubs = { 'rownum': row, 'colnum': col }
@@ -957,67 +1640,135 @@ def make_domino_cards(data, layout, options,
         solsubsmd = dict(solsubs)
 
         if i % (rows * columns) == 0:
-            if i > 0:
-                puzbody += puztemplate['end_page']
-                solbody += soltemplate['end_page']
-            puzbody += puztemplate['begin_page']
-            solbody += soltemplate['begin_page']
+            for (out, template, subs) in docs[:2]:
+                if out:
+                    if i > 0:
+                        out.write(template['end_page'].render(subs))
+                    out.write(pagemark)
+                    out.write(template['begin_page'].render(subs))
         
         # on ith solution card, textL = A(l-1), textR = Q(l)
         puzi = cardorder[i]
         puzi1 = (cardorder[i] - 1 + num_pairs) % num_pairs
-        soli = i
-        soli1 = (i - 1 + num_pairs) % num_pairs
-
-        puzsubs['textL'], puzsubs['labelL'] = make_entry(
-            pairs[realpairs[puzi1]][1], size, 'tikz',
-            defaultlabel, defaultlabelsize)
-        puzsubs['textR'], puzsubs['labelR'] = make_entry(
-            pairs[realpairs[puzi]][0], size, 'tikz',
-            defaultlabel, defaultlabelsize)
-        puzbody += dosub(puztemplate['item'], puzsubs)
-        puzsubsmd['textL'], puzsubsmd['labelL'] = make_entry(
-            pairs[realpairs[puzi1]][1], 0, 'md', defaultlabel)
-        puzsubsmd['textR'], puzsubsmd['labelR'] = make_entry(
-            pairs[realpairs[puzi]][0], 0, 'md', defaultlabel)
-        puzbodymd += dosub(puztemplatemd['item'], puzsubsmd)
-        solsubs['textL'], solsubs['labelL'] = make_entry(
-            pairs[realpairs[soli1]][1], size, 'tikz',
-            defaultlabel, defaultlabelsize, solution=True)
-        solsubs['textR'], solsubs['labelR'] = make_entry(
-            pairs[realpairs[soli]][0], size, 'tikz',
-            defaultlabel, defaultlabelsize, solution=True)
-        solbody += dosub(soltemplate['item'], solsubs)
-        solsubsmd['textL'], solsubsmd['labelL'] = make_entry(
-            pairs[realpairs[soli1]][1], 0, 'md', defaultlabel, solution=True)
-        solsubsmd['textR'], solsubsmd['labelR'] = make_entry(
-            pairs[realpairs[soli]][0], 0, 'md', defaultlabel, solution=True)
-        solbodymd += dosub(soltemplatemd['item'], solsubsmd)
-
-        i += 1
-
-    puzbody += puztemplate['end_page']
-    solbody += soltemplate['end_page']
-
-    puzbody += puztemplate['end_document']
-    puzbodymd += puztemplatemd['end_document']
-    solbody += soltemplate['end_document']
-    solbodymd += soltemplatemd['end_document']
-
-    dsubs['puzbody'] = puzbody
-    dsubsmd['puzbody'] = puzbodymd
-    dsubs['solbody'] = solbody
-    dsubsmd['solbody'] = solbodymd
-
-    if not loop:
-        # We remove the temporarily appended terminal pair
-        pairs.pop()
-
-
-rerun_regex = re.compile(r'rerun ', re.I)
+        if puzout or puzoutmd:
+            (puzL, puzR) = (pairs[puzi1][1], pairs[puzi][0])
+        pair = pairs[i]
+        (solL, solR) = (prevpair[1], pair[0])
+        prevpair = pair
+
+        # The card text is itself substituted using the document
+        # substitutions, as it always has been
+        if puzout:
+            puzsubs['textL'], puzsubs['labelL'] = ctx.make_entry(
+                puzL, size, 'tikz', defaultlabel, defaultlabelsize)
+            puzsubs['textR'], puzsubs['labelR'] = ctx.make_entry(
+                puzR, size, 'tikz', defaultlabel, defaultlabelsize)
+            puzout.write(dosub(puzitem.render(puzsubs), numdsubs))
+        if puzoutmd:
+            puzsubsmd['textL'], puzsubsmd['labelL'] = ctx.make_entry(
+                puzL, 0, 'md', defaultlabel)
+            puzsubsmd['textR'], puzsubsmd['labelR'] = ctx.make_entry(
+                puzR, 0, 'md', defaultlabel)
+            puzoutmd.write(dosub(puzitemmd.render(puzsubsmd), dsubsmd))
+        if solout:
+            solsubs['textL'], solsubs['labelL'] = ctx.make_entry(
+                solL, size, 'tikz', defaultlabel, defaultlabelsize,
+                solution=True)
+            solsubs['textR'], solsubs['labelR'] = ctx.make_entry(
+                solR, size, 'tikz', defaultlabel, defaultlabelsize,
+                solution=True)
+            solout.write(dosub(solitem.render(solsubs), numdsubs))
+        if soloutmd:
+            solsubsmd['textL'], solsubsmd['labelL'] = ctx.make_entry(
+                solL, 0, 'md', defaultlabel, solution=True)
+            solsubsmd['textR'], solsubsmd['labelR'] = ctx.make_entry(
+                solR, 0, 'md', defaultlabel, solution=True)
+            soloutmd.write(dosub(solitemmd.render(solsubsmd), dsubsmd))
+
+    for (out, template, subs) in docs[:2]:
+        if out:
+            out.write(template['end_page'].render(subs))
+            out.write(endmark)
+
+    for (out, template, subs) in docs:
+        if out:
+            out.write(template['end_document'].render(subs))
+
+
+# Whether the warning that shards cannot be merged has been given
+shard_warned = False
+
+# Whether the warning that pieces cannot be externalized has been given
+externalize_warned = False
+
+# LaTeX has converged once the auxiliary files it reads back in are
+# the same after a pass as they were before it.
+rerun_exts = ['aux', 'out', 'toc']
+
+# Lines written to the aux file which do not affect the typeset output
+# and so should not force another pass
+aux_ignore_re = re.compile(rb'^(\\relax|\\gdef\s*\\@abspage@last\{\d+\})\s*$')
+
+# Lines written to the aux file by the lastpage package, which the
+# card sort header still loads for custom templates using
+# \pageref{LastPage}; these only affect documents which refer to it
+lastpage_aux_re = re.compile(rb'^(\\newlabel\{LastPage\}|'
+                             rb'\\[gx]def\s*\\lastpage@)')
+
+def auxdigest(basename, lastpage=True):
+    """Return a hash of the auxiliary files LaTeX reads for basename
+
+    A missing file is treated in the same way as an empty one.  If
+    lastpage is False, the lines written by the lastpage package are
+    ignored.
+    """
 
-def runlatex(fn, layout, data, options):
-    """Run LaTeX or a variant on fn"""
+    h = hashlib.sha256()
+    for ext in rerun_exts:
+        h.update(b'\0' + ext.encode() + b'\0')
+        try:
+            with open(basename + '.' + ext, 'rb') as f:
+                for line in f:
+                    if aux_ignore_re.match(line):
+                        continue
+                    if not lastpage and lastpage_aux_re.match(line):
+                        continue
+                    h.update(line)
+        except OSError:
+            pass
+    return h.hexdigest()
+
+def useslastpage(fn):
+    """Return True if the LaTeX file fn refers to the LastPage label"""
+    with open(fn, 'rb') as f:
+        return any(b'LastPage' in line for line in f)
+
+def progress(layout, data, options, message):
+    """Print message if the verbose option is set"""
+    if getopt(layout, data, options, 'verbose', False):
+        print(message)
+
+@timing.timed()
+def runlatex(fn, layout, data, options, header=None):
+    """Run LaTeX or a variant on fn
+
+    If header is given, it is the header text which fn begins with;
+    if the precompile option is set, this header is dumped into a
+    LaTeX format file (once) and the rest of fn is run using it.
+
+    LaTeX is rerun until the auxiliary files stop changing, up to the
+    maxpasses option (default 4) times.  If the keepaux option is set,
+    the auxiliary files from the previous run of fn are restored
+    first, so that an unchanged or slightly edited document usually
+    needs only one pass.
+
+    Returns the number of passes run, which is 0 if the PDF came from
+    the build cache, or None if LaTeX failed.
+
+    If fn is in another directory, the output files are written there
+    too; relative image paths are still relative to the current
+    directory.
+    """
 
     texfilter = getopt(layout, data, options, 'texfilter')
     latexprog = getopt(layout, data, options, 'latex', 'pdflatex')
@@ -1035,44 +1786,188 @@ def runlatex(fn, layout, data, options):
         else:
             os.replace(fn, fn + '.filter')
             try:
-                output = subprocess.check_output(filterprog,
-                                                 stdin=open(fn + '.filter'),
-                                                 universal_newlines=True)
+                with timing.stage('texfilter', file=fn):
+                    output = subprocess.check_output(
+                        filterprog, stdin=open(fn + '.filter'),
+                        universal_newlines=True)
                 with open(fn, 'w') as filtered:
                     print(output, file=filtered)
             except subprocess.CalledProcessError as cpe:
-                print('Warning: LaTeX filter failed, return value %s' %
-                      cpe.returncode, file=sys.stderr)
-                print('Continuing with LaTeX run on unfiltered file',
-                      file=sys.stderr)
+                print('Warning: LaTeX filter failed on %s, return value %s\n'
+                      'Continuing with LaTeX run on unfiltered file' %
+                      (fn, cpe.returncode), file=sys.stderr)
                 os.replace(fn + '.filter', fn)
                 error = True
-                
-    for count in range(4):
+
+    # In watch mode, options['built'] records the cache key of the
+    # last PDF built for each file, so that unchanged files are skipped
+    usecache = getopt(layout, data, options, 'cache', True)
+    built = options.get('built')
+    pdffile = os.path.splitext(fn)[0] + '.pdf'
+    if usecache or built is not None:
+        key = buildcache.cachekey(fn, latexprog, filterprog)
+    if built is not None:
+        if built.get(fn) == key and os.path.exists(pdffile):
+            print('%s: unchanged' % fn)
+            cleanlatex(fn, layout, data, options, error)
+            return 0
+    if usecache:
+        if buildcache.fetch(key, pdffile):
+            progress(layout, data, options,
+                     '%s: PDF taken from build cache' % fn)
+            if built is not None:
+                built[fn] = key
+            cleanlatex(fn, layout, data, options, error)
+            return 0
+
+    basename = os.path.splitext(fn)[0]
+    outdir = os.path.dirname(fn)
+    diropts = ['-output-directory=' + outdir] if outdir else []
+    plaincmd = [latexprog, '--interaction=nonstopmode'] + diropts + [fn]
+    latexcmd = plaincmd
+    if header and getopt(layout, data, options, 'precompile', False):
+        fmt = texformat.getformat(header, latexprog)
+        if fmt:
+            bodyfn = texformat.stripheader(fn, header)
+            if bodyfn:
+                latexcmd = ([latexprog, '-fmt=' + fmt,
+                             '-jobname=' + os.path.basename(basename),
+                             '--interaction=nonstopmode'] +
+                            diropts + [bodyfn])
+
+    keepaux = getopt(layout, data, options, 'keepaux', False)
+    if keepaux:
+        buildcache.restoreaux(fn, rerun_exts)
+
+    maxpasses = getopt(layout, data, options, 'maxpasses', 4)
+    lastpage = useslastpage(fn)
+    digest = auxdigest(basename, lastpage)
+    passes = 0
+    while passes < maxpasses:
         try:
-            output = subprocess.check_output([latexprog,
-                                              '--interaction=nonstopmode', fn],
-                                             universal_newlines=True)
+            with timing.stage('latexpass', file=fn, number=passes + 1):
+                subprocess.check_output(latexcmd, universal_newlines=True)
         except subprocess.CalledProcessError as cpe:
-            print('Warning: %s %s failed, return value %s' %
-                  (latexprog, fn, cpe.returncode), file=sys.stderr)
-            print('See the %s log file for more details.' % latexprog,
+            if latexcmd is not plaincmd:
+                # The precompiled format may not suit this document,
+                # so start again the traditional way
+                print('Warning: %s %s failed using the precompiled header '
+                      'format\nRetrying without it' % (latexprog, fn),
+                      file=sys.stderr)
+                latexcmd = plaincmd
+                digest = auxdigest(basename, lastpage)
+                passes = 0
+                continue
+            print('Warning: %s %s failed, return value %s\n'
+                  'See the %s log file for more details.' %
+                  (latexprog, fn, cpe.returncode, latexprog),
                   file=sys.stderr)
             error = True
+            passes = None
             break
 
-        if not rerun_regex.search(output):
+        passes += 1
+        newdigest = auxdigest(basename, lastpage)
+        if newdigest == digest:
             break
+        digest = newdigest
+    else:
+        print('Warning: %s %s had not converged after %s passes' %
+              (latexprog, fn, maxpasses), file=sys.stderr)
+
+    if passes is not None:
+        progress(layout, data, options, '%s: %s %s pass%s' %
+                 (fn, passes, latexprog, '' if passes == 1 else 'es'))
+    if not error:
+        if keepaux:
+            buildcache.saveaux(fn, rerun_exts)
+        if built is not None:
+            built[fn] = key
+
+    if usecache and not error and os.path.exists(pdffile):
+        buildcache.store(key, pdffile,
+                         getopt(layout, data, options, 'cachesize',
+                                buildcache.default_cachesize))
+
+    cleanlatex(fn, layout, data, options, error)
+    return passes
+
+def splitshards(fn, shardpages):
+    """Split the LaTeX card document fn into shards of shardpages pages
+
+    The pages are found from the marks written by make_cardsort_cards()
+    and make_domino_cards() (see shardmarks()).  Each shard is a
+    complete document, named fn-shardN.tex, holding everything before
+    the first page, the pages of the shard and everything after the
+    last page.  The page counter is set at the start of each shard, so
+    the page numbers are the same as in the whole document.
+
+    Returns the list of shard files, or None if the document has no
+    page marks or would only make one shard.
+    """
+
+    pages = 0
+    ended = False
+    with open(fn) as f:
+        for line in f:
+            if line == shard_page_mark:
+                pages += 1
+            elif line == shard_end_mark:
+                ended = True
+    if pages <= shardpages or not ended:
+        return None
+
+    basename = os.path.splitext(fn)[0]
+    shards = []
+    prefix = []
+    suffix = []
+    out = None
+    page = 0
+    with open(fn) as f:
+        for line in f:
+            if line == shard_end_mark:
+                out.close()
+                out = None
+                suffix.append(line)
+            elif line == shard_page_mark:
+                if page % shardpages == 0:
+                    if out:
+                        out.close()
+                    shards.append('%s-shard%d.tex' %
+                                  (basename, len(shards) + 1))
+                    out = open(shards[-1], 'w')
+                    out.writelines(prefix)
+                    out.write(line)
+                    out.write('\\setcounter{page}{%d}\n' % (page + 1))
+                else:
+                    out.write(line)
+                page += 1
+            elif out:
+                out.write(line)
+            elif shards:
+                suffix.append(line)
+            else:
+                prefix.append(line)
+
+    for shard in shards:
+        with open(shard, 'a') as out:
+            out.writelines(suffix)
+    return shards
+
+def cleanlatex(fn, layout, data, options, error):
+    """Remove the LaTeX auxiliary files for fn if requested"""
 
     doclean = getopt(layout, data, options, 'clean', True)
     if not error and doclean:
         basename = os.path.splitext(fn)[0]
-        for junk in ['aux', 'log', 'tex', 'ind', 'idx', 'out', 'tex.filter']:
+        for junk in ['aux', 'log', 'tex', 'ind', 'idx', 'out', 'tex.filter',
+                     'body.tex']:
             try:
                 os.remove(basename + '.' + junk)
             except:
                 pass
 
+@timing.timed()
 def filtermd(fn, layout, data, options):
     """Filter Markdown output if required"""
 
@@ -1091,14 +1986,15 @@ def filtermd(fn, layout, data, options):
         else:
             os.replace(fn, fn + '.filter')
             try:
-                output = subprocess.check_output(filterprog,
-                                                 stdin=open(fn + '.filter'),
-                                                 universal_newlines=True)
+                with timing.stage('mdfilter', file=fn):
+                    output = subprocess.check_output(
+                        filterprog, stdin=open(fn + '.filter'),
+                        universal_newlines=True)
                 with open(fn, 'w') as filtered:
                     print(output, file=filtered)
             except subprocess.CalledProcessError as cpe:
-                print('Warning: Markdown filter failed, return value %s' %
-                      cpe.returncode, file=sys.stderr)
+                print('Warning: Markdown filter failed on %s, return value %s' %
+                      (fn, cpe.returncode), file=sys.stderr)
                 error = True
                 
         doclean = getopt(layout, data, options, 'clean', True)
@@ -1108,14 +2004,55 @@ def filtermd(fn, layout, data, options):
             except:
                 pass
 
+def runjobs(jobs, layout, data, options):
+    """Run the LaTeX and Markdown filter jobs for a puzzle
+
+    jobs is a list of tuples (function, filename, ...), where
+    function is runlatex or filtermd; any further entries in the tuple
+    are passed as extra arguments to the function.  These jobs are
+    independent of each other, so they are run at the same time in a
+    pool of worker threads (the real work happens in subprocesses).
+    The size of the pool is given by the "jobs" option, defaulting to
+    the number of CPU cores; with jobs = 1, they are run one after the
+    other.
+
+    Each job reports its own warnings and errors on stderr.  Returns
+    a list of the return values of the jobs, in the same order.
+    """
+
+    numjobs = getopt(layout, data, options, 'jobs', os.cpu_count() or 1)
+    try:
+        numjobs = max(int(numjobs), 1)
+    except ValueError:
+        print('Warning: invalid value for jobs: %s; using 1' % numjobs,
+              file=sys.stderr)
+        numjobs = 1
+
+    if numjobs == 1 or len(jobs) <= 1:
+        return [func(fn, layout, data, options, *args)
+                for (func, fn, *args) in jobs]
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(numjobs, len(jobs))) as pool:
+        futures = [pool.submit(func, fn, layout, data, options, *args)
+                   for (func, fn, *args) in jobs]
+        # Wait for every job to finish before reporting any failure,
+        # so that one failing job does not leave the others orphaned
+        concurrent.futures.wait(futures)
+        return [future.result() for future in futures]
+
 #####################################################################
 
 def main(pkgdatadir=None, pkgversion=0.0):
     """Process the command line and generate the appropriate output files.
 
     Command line:
-       jigsaw-generate [options] puzzlefile[.yaml]
-    There are no options at present, but this will change later.
+       jigsaw-generate [options] puzzlefile[.yaml] ...
+    Each puzzle file argument may also be a directory (all the .yaml
+    files in it are used) or a glob pattern.  When there is more than
+    one puzzle file, they are generated in a pool of worker processes
+    and a summary is printed at the end; a failure in one puzzle file
+    does not prevent the others from being generated.
 
     We will generate both LaTeX output files and (eventually) a
     markdown file which can be included where needed.
@@ -1165,8 +2102,10 @@ under certain conditions; see the COPYING file for details.''' % pkgversion
     parser.add_argument('-v', '--version', action='version',
                         version=versioninfo)
 
-    parser.add_argument('puzfile', metavar='puzzlefile[.yaml]',
-                        help='yaml file containing puzzle data')
+    parser.add_argument('puzfiles', metavar='puzzlefile[.yaml]', nargs='*',
+                        help=('yaml file containing puzzle data; this may '
+                              'also be a directory of yaml files or a glob '
+                              'pattern, and may be repeated'))
     
     parser.add_argument('-o', '--output',
                         help='basename of output files')
@@ -1184,10 +2123,52 @@ under certain conditions; see the COPYING file for details.''' % pkgversion
                         help=('clean auxiliary files%s' %
                               (' (default)' if doclean else '')),
                         action='store_true')
+
+    groupr = parser.add_mutually_exclusive_group()
+    if 'verbose' in configs:
+        doverbose = configs.getboolean('verbose')
+    else:
+        doverbose = False
+    groupr.add_argument('--verbose',
+                        help=('report on the progress of each output file, '
+                              'such as the number of LaTeX passes%s' %
+                              (' (default)' if doverbose else '')),
+                        action='store_true')
+    groupr.add_argument('--noverbose', '--no-verbose',
+                        help=('only report warnings and errors%s' %
+                              (' (default)' if not doverbose else '')),
+                        action='store_true')
     parser.add_argument('--latex',
                         help=('the LaTeX variant to run (default %s)' %
                               configs['latex'] if 'latex' in configs
                               else 'pdflatex'))
+    parser.add_argument('--maxpasses', type=int,
+                        help=('the maximum number of LaTeX passes to run '
+                              'on each file (default %s)' %
+                              (configs['maxpasses'] if 'maxpasses' in configs
+                               else 4)))
+    parser.add_argument('-j', '--jobs', type=int,
+                        help=('number of LaTeX and filter jobs, or of '
+                              'puzzle files, to process at once (default %s)' %
+                              (configs['jobs'] if 'jobs' in configs
+                               else 'number of CPU cores')))
+    parser.add_argument('--shardpages', type=int,
+                        help=('split card sorts and dominoes with more than '
+                              'this many pages into documents of this many '
+                              'pages, compile them in parallel and merge '
+                              'the PDF files (default %s)' %
+                              (configs['shardpages'] if 'shardpages' in configs
+                               else '0, meaning never split')))
+    parser.add_argument('--variants', type=int,
+                        help=('make this many differently shuffled versions '
+                              'of each puzzle, with their solutions '
+                              '(default %s)' %
+                              (configs['variants'] if 'variants' in configs
+                               else '0, meaning just one puzzle')))
+    parser.add_argument('--seed',
+                        help=('the seed for shuffling the puzzles (default '
+                              '%s)' % (configs['seed'] if 'seed' in configs
+                                       else 'the puzzle title')))
 
     groupp = parser.add_mutually_exclusive_group()
     if 'makepdf' in configs:
@@ -1217,6 +2198,146 @@ under certain conditions; see the COPYING file for details.''' % pkgversion
                               (' (default)' if not domd else '')),
                         action='store_true')
 
+    groupk = parser.add_mutually_exclusive_group()
+    if 'cache' in configs:
+        docache = configs.getboolean('cache')
+    else:
+        docache = True
+    groupk.add_argument('--cache',
+                        help=('reuse PDF files from the build cache when '
+                              'nothing has changed%s' %
+                              (' (default)' if docache else '')),
+                        action='store_true')
+    groupk.add_argument('--nocache', '--no-cache',
+                        help=('always run LaTeX%s' %
+                              (' (default)' if not docache else '')),
+                        action='store_true')
+    parser.add_argument('-w', '--watch',
+                        help=('keep running, and regenerate the output '
+                              'whenever a puzzle file or any template, '
+                              'layout or image it uses changes'),
+                        action='store_true')
+    parser.add_argument('--booklet', metavar='NAME',
+                        help=('combine all of the puzzle files into one '
+                              'booklet of each kind of LaTeX document, '
+                              'named after NAME, and run LaTeX once on '
+                              'each'))
+
+    groupb = parser.add_mutually_exclusive_group()
+    if 'splitbooklet' in configs:
+        dosplit = configs.getboolean('splitbooklet')
+    else:
+        dosplit = False
+    groupb.add_argument('--splitbooklet', '--split-booklet',
+                        help=('also make the PDF files of each puzzle '
+                              'from the booklet%s' %
+                              (' (default)' if dosplit else '')),
+                        action='store_true')
+    groupb.add_argument('--nosplitbooklet', '--no-split-booklet',
+                        help=('only make the PDF files of the booklet%s' %
+                              (' (default)' if not dosplit else '')),
+                        action='store_true')
+    parser.add_argument('--cachestats', '--cache-stats',
+                        help=('report on the build cache; the puzzle file '
+                              'is optional with this option'),
+                        action='store_true')
+
+    groupa = parser.add_mutually_exclusive_group()
+    if 'keepaux' in configs:
+        dokeepaux = configs.getboolean('keepaux')
+    else:
+        dokeepaux = False
+    groupa.add_argument('--keepaux', '--keep-aux',
+                        help=('keep the LaTeX auxiliary files in the user '
+                              'cache directory between runs%s' %
+                              (' (default)' if dokeepaux else '')),
+                        action='store_true')
+    groupa.add_argument('--nokeepaux', '--no-keep-aux',
+                        help=('start each LaTeX run without previous '
+                              'auxiliary files%s' %
+                              (' (default)' if not dokeepaux else '')),
+                        action='store_true')
+
+    groupd = parser.add_mutually_exclusive_group()
+    if 'datacache' in configs:
+        dodatacache = configs.getboolean('datacache')
+    else:
+        dodatacache = False
+    groupd.add_argument('--datacache', '--data-cache',
+                        help=('keep the parsed puzzle data in the user '
+                              'cache directory, to save parsing unchanged '
+                              'puzzle files again%s' %
+                              (' (default)' if dodatacache else '')),
+                        action='store_true')
+    groupd.add_argument('--nodatacache', '--no-data-cache',
+                        help=('always parse the puzzle files%s' %
+                              (' (default)' if not dodatacache else '')),
+                        action='store_true')
+
+    groups = parser.add_mutually_exclusive_group()
+    if 'stream' in configs:
+        dostream = configs.getboolean('stream')
+    else:
+        dostream = False
+    groups.add_argument('--stream',
+                        help=('read the cards and pairs of the puzzle files '
+                              'one at a time rather than loading them all '
+                              'into memory%s' %
+                              (' (default)' if dostream else '')),
+                        action='store_true')
+    groups.add_argument('--nostream', '--no-stream',
+                        help=('load the whole of each puzzle file into '
+                              'memory%s' %
+                              (' (default)' if not dostream else '')),
+                        action='store_true')
+
+    groupv = parser.add_mutually_exclusive_group()
+    if 'combine' in configs:
+        docombine = configs.getboolean('combine')
+    else:
+        docombine = False
+    groupv.add_argument('--combine',
+                        help=('put all the variants of a puzzle into one '
+                              'LaTeX document of each kind%s' %
+                              (' (default)' if docombine else '')),
+                        action='store_true')
+    groupv.add_argument('--nocombine', '--no-combine',
+                        help=('make separate documents for each variant%s' %
+                              (' (default)' if not docombine else '')),
+                        action='store_true')
+
+    groupx = parser.add_mutually_exclusive_group()
+    if 'externalize' in configs:
+        doexternalize = configs.getboolean('externalize')
+    else:
+        doexternalize = False
+    groupx.add_argument('--externalize',
+                        help=('draw each jigsaw piece in a separate, cached '
+                              'LaTeX document%s' %
+                              (' (default)' if doexternalize else '')),
+                        action='store_true')
+    groupx.add_argument('--noexternalize', '--no-externalize',
+                        help=('draw the jigsaw pieces in the puzzle and '
+                              'solution documents%s' %
+                              (' (default)' if not doexternalize else '')),
+                        action='store_true')
+
+    groupf = parser.add_mutually_exclusive_group()
+    if 'precompile' in configs:
+        doprecompile = configs.getboolean('precompile')
+    else:
+        doprecompile = False
+    groupf.add_argument('--precompile',
+                        help=('precompile the LaTeX headers into format '
+                              'files to speed up LaTeX runs%s' %
+                              (' (default)' if doprecompile else '')),
+                        action='store_true')
+    groupf.add_argument('--noprecompile', '--no-precompile',
+                        help=('load the LaTeX headers afresh on every '
+                              'run%s' %
+                              (' (default)' if not doprecompile else '')),
+                        action='store_true')
+
     if 'texfilter' in configs:
         conftexfilter = configs['texfilter']
     else:
@@ -1233,23 +2354,51 @@ under certain conditions; see the COPYING file for details.''' % pkgversion
                         help=('filter to run on Markdown file%s' %
                               (' (default %s)' % confmdfilter if confmdfilter
                                else '')))
+    parser.add_argument('--profile', metavar='FILE',
+                        help=('record the time taken by each stage of the '
+                              'run, write it to FILE as JSON and print a '
+                              'summary'))
     args = parser.parse_args()
 
-    if args.puzfile[-5:] == '.yaml':
-        puzfile = args.puzfile
+    if 'cachesize' in configs:
+        cachesize = configs.getint('cachesize')
     else:
-        puzfile = args.puzfile + '.yaml'
-    puzbase = puzfile[:-5]
+        cachesize = buildcache.default_cachesize
+
+    if not args.puzfiles:
+        if args.cachestats:
+            buildcache.report(cachesize)
+            return
+        parser.error('the following arguments are required: '
+                     'puzzlefile[.yaml]')
+
+    puzfiles = expandpuzfiles(args.puzfiles)
+    if not puzfiles:
+        sys.exit('No puzzle files found')
 
     # We bundle the command-line args into an options dict
     options = dict()
 
     if args.output:
+        if len(puzfiles) > 1:
+            sys.exit('Cannot use --output with more than one puzzle file')
         if os.path.dirname(args.output) not in ['', '.']:
             sys.exit('Cannot currently handle --output not in current '
                      'directory;\nplease change directory first')
         options['output'] = args.output
 
+    if args.booklet:
+        if args.output or args.watch:
+            sys.exit('Cannot use --booklet with --output or --watch')
+        if os.path.dirname(args.booklet) not in ['', '.']:
+            sys.exit('Cannot currently handle --booklet not in current '
+                     'directory;\nplease change directory first')
+
+    if args.splitbooklet:
+        options['splitbooklet'] = True
+    elif args.nosplitbooklet:
+        options['splitbooklet'] = False
+
     if args.makepdf:
         options['makepdf'] = True
     elif args.nomakepdf:
@@ -1263,31 +2412,83 @@ under certain conditions; see the COPYING file for details.''' % pkgversion
     if args.latex:
         options['latex'] = args.latex
 
+    if args.maxpasses != None:
+        if args.maxpasses < 1:
+            sys.exit('--maxpasses must be at least 1')
+        options['maxpasses'] = args.maxpasses
+
+    if args.jobs != None:
+        if args.jobs < 1:
+            sys.exit('--jobs must be at least 1')
+        options['jobs'] = args.jobs
+
+    if args.shardpages != None:
+        if args.shardpages < 0:
+            sys.exit('--shardpages cannot be negative')
+        options['shardpages'] = args.shardpages
+
+    if args.variants != None:
+        if args.variants < 0:
+            sys.exit('--variants cannot be negative')
+        options['variants'] = args.variants
+
+    if args.seed != None:
+        options['seed'] = args.seed
+
     if args.clean:
         options['clean'] = True
     elif args.noclean:
         options['clean'] = False
 
+    if args.verbose:
+        options['verbose'] = True
+    elif args.noverbose:
+        options['verbose'] = False
+
+    if args.cache:
+        options['cache'] = True
+    elif args.nocache:
+        options['cache'] = False
+
+    if args.keepaux:
+        options['keepaux'] = True
+    elif args.nokeepaux:
+        options['keepaux'] = False
+
+    if args.datacache:
+        options['datacache'] = True
+    elif args.nodatacache:
+        options['datacache'] = False
+
+    if args.stream:
+        options['stream'] = True
+    elif args.nostream:
+        options['stream'] = False
+
+    if args.combine:
+        options['combine'] = True
+    elif args.nocombine:
+        options['combine'] = False
+
+    if args.externalize:
+        options['externalize'] = True
+    elif args.noexternalize:
+        options['externalize'] = False
+
+    if args.precompile:
+        options['precompile'] = True
+    elif args.noprecompile:
+        options['precompile'] = False
+
     if args.texfilter != None:
         options['texfilter'] = args.texfilter
 
     if args.mdfilter != None:
         options['mdfilter'] = args.mdfilter
 
-    ### Read the puzzle file
-    try:
-        infile = open(puzfile)
-    except:
-        sys.exit('Cannot open %s for reading' % puzfile)
-
-    try:
-        data = load(infile, Loader=Loader)
-    except yaml.YAMLError as exc:
-        if hasattr(exc, 'problem_mark'):
-            mark = exc.problem_mark
-            sys.exit('Error parsing puzzle data file\n'
-                     'Error position: line %s, column %s' %
-                     (mark.line+1, mark.column+1))
+    if args.profile:
+        options['profile'] = args.profile
+        timing.enable()
 
     # Determine where the templates files live
     # We use user_config_dir as I think this is configuration data,
@@ -1299,45 +2500,558 @@ under certain conditions; see the COPYING file for details.''' % pkgversion
     # be modified by the user; they go with the package.  Users can modify
     # templates by providing their own ones, hence site_data_dir is the
     # appropriate site choice.
-    generate(data, {'puzbase': puzbase, 'templatedirs': templatedirs,
-                    'filterdirs': filterdirs,
-                    'options': options, 'config': configs})
+    genoptions = {'templatedirs': templatedirs,
+                  'filterdirs': filterdirs,
+                  'options': options, 'config': configs}
+
+    error = None
+    failed = False
+    with timing.stage('main'):
+        if args.watch:
+            watch(puzfiles, genoptions)
+        elif args.booklet:
+            failed = generatebooklet(puzfiles, genoptions, args.booklet)
+        elif len(puzfiles) == 1:
+            try:
+                generatefile(puzfiles[0], genoptions)
+            except JigsawError as err:
+                error = str(err)
+        else:
+            failed = generatebatch(puzfiles, genoptions)
+
+    buildcache.savestats()
+    if args.profile:
+        timing.report(args.profile)
+    if error:
+        sys.exit(error)
+    if args.cachestats:
+        buildcache.report(cachesize)
+    if failed:
+        sys.exit(1)
+
+
+def expandpuzfiles(args):
+    """Expand the puzzle file arguments into a list of puzzle files
+
+    Each argument may be a directory, in which case all of the .yaml
+    and .jsonl files within it are used, a glob pattern (of which only
+    the matching .yaml and .jsonl files are used), or a puzzle file
+    name with or without the .yaml extension.
+    """
 
+    puzfiles = []
+    for arg in args:
+        if os.path.isdir(arg):
+            puzfiles.extend(sorted(glob.glob(os.path.join(arg, '*.yaml')) +
+                                   glob.glob(os.path.join(arg, '*.jsonl'))))
+        elif glob.has_magic(arg):
+            matches = sorted(f for f in glob.glob(arg)
+                             if f.endswith(('.yaml', '.jsonl')) and
+                             os.path.isfile(f))
+            if not matches:
+                print('Warning: no files match %s' % arg, file=sys.stderr)
+            puzfiles.extend(matches)
+        elif arg.endswith(('.yaml', '.jsonl')):
+            puzfiles.append(arg)
+        else:
+            puzfiles.append(arg + '.yaml')
+
+    # The same file might be named twice, for example by a directory
+    # and a glob; it should only be generated once
+    unique = []
+    seen = set()
+    for puzfile in puzfiles:
+        norm = os.path.normpath(puzfile)
+        if norm not in seen:
+            seen.add(norm)
+            unique.append(puzfile)
+
+    # The output files are written to the current directory, so
+    # puzzle files with the same name would overwrite each other
+    outbases = {}
+    for puzfile in unique:
+        outbase = os.path.splitext(os.path.basename(puzfile))[0]
+        if outbase in outbases:
+            sys.exit('Puzzle files %s and %s would produce the same '
+                     'output files' % (outbases[outbase], puzfile))
+        outbases[outbase] = puzfile
+
+    return unique
+
+
+def generatefile(puzfile, options):
+    """Read the puzzle file puzfile and generate its output files
+
+    options is as for generate(), except that the 'puzbase' entry is
+    added by this function.  Raises a JigsawError on failure.
+    """
 
-def generate(data, options):
-    """Generate output from data, using options passed to this function.
+    data = loadpuzzle(puzfile, options)
+    generate(data, dict(options, puzbase=os.path.splitext(puzfile)[0]))
 
-    Thus function is presently called from main(), but might well be
-    called from a GUI at some point in the future, which is why it has
-    been separated out.
 
-    When this function is called, data must contain a recognised
-    jigsaw type, and the options dictionary must contain an entry
-    'puzbase' with the file basename for this particular puzzle.
+# Parsed puzzle data: hash of puzzle file -> data
+puzzle_cache = OrderedDict()
+puzzle_cache_size = 64
+puzzle_cache_lock = threading.Lock()
+
+@timing.timed()
+def loadpuzzle(puzfile, options=None):
+    """Read and parse the puzzle file puzfile, returning its data
+
+    Parsed puzzle data is kept in memory, keyed by a hash of the file
+    contents, so that watch and batch runs only parse each version of
+    a file once.  If the datacache option is set, it is also kept as
+    JSON in the user cache directory, which is much faster to load
+    than YAML for a large question bank.  The returned data is shared
+    and must not be modified.
+
+    If the stream option is set, or puzfile is a JSON lines file, the
+    cards and pairs are not loaded at all; they are read one at a time
+    from the file whenever they are used (see stream.py), and neither
+    cache is used.  Raises PuzzleDataError on failure.
     """
 
-    # Open template files and layout file.
+    if (stream.isjsonl(puzfile) or
+            (options and getopt({}, {}, options, 'stream', False))):
+        try:
+            data = stream.load(puzfile, Loader)
+        except OSError:
+            raise PuzzleDataError('Cannot open %s for reading' % puzfile)
+        except stream.StreamError as exc:
+            raise PuzzleDataError(str(exc))
+        if not isinstance(data, dict):
+            raise PuzzleDataError('Puzzle data file %s does not contain '
+                                  'puzzle data' % puzfile)
+        return data
 
-    if 'type' in data:
-        puztype = data['type']
+    try:
+        with open(puzfile, 'rb') as infile:
+            text = infile.read()
+    except OSError:
+        raise PuzzleDataError('Cannot open %s for reading' % puzfile)
+
+    key = hashlib.sha256(text).hexdigest()
+    with puzzle_cache_lock:
+        if key in puzzle_cache:
+            puzzle_cache.move_to_end(key)
+            return puzzle_cache[key]
+
+    datacache = options and getopt({}, {}, options, 'datacache', False)
+    cachefile = os.path.join(appdirs.user_cache_dir('jigsaw-generator'),
+                             'data', key + '.json')
+    data = None
+    if datacache:
         try:
-            layoutf = opentemplate(options['templatedirs'],
-                                   puztype + '-layout.yaml')
-        except:
-            sys.exit('Unrecognised jigsaw type %s' % data['type'])
+            with open(cachefile) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    if not isinstance(data, dict):
+        global cloader_warned
+        if not have_cloader:
+            with puzzle_cache_lock:
+                if not cloader_warned:
+                    print('Warning: the PyYAML C extension (libyaml) is '
+                          'not available, so reading puzzle files will '
+                          'be slow', file=sys.stderr)
+                    cloader_warned = True
+        try:
+            data = load(text, Loader=Loader)
+        except yaml.YAMLError as exc:
+            if hasattr(exc, 'problem_mark'):
+                mark = exc.problem_mark
+                raise PuzzleDataError('Error parsing puzzle data file\n'
+                                      'Error position: line %s, column %s' %
+                                      (mark.line+1, mark.column+1))
+            raise PuzzleDataError('Error parsing puzzle data file')
+
+        if not isinstance(data, dict):
+            raise PuzzleDataError('Puzzle data file %s does not contain '
+                                  'puzzle data' % puzfile)
+        if datacache:
+            savejson(cachefile, data)
+
+    with puzzle_cache_lock:
+        puzzle_cache[key] = data
+        if len(puzzle_cache) > puzzle_cache_size:
+            puzzle_cache.popitem(last=False)
+    return data
+
+
+def generatebatchfile(puzfile, options):
+    """Generate one puzzle file of a batch, catching any failure
+
+    This is run in a worker process.  Returns a triple (ok, message,
+    records), where records are the timing records for the --profile
+    option.
+    """
+
+    timing.startworker(options['options'].get('profile'))
+    try:
+        generatefile(puzfile, options)
+        result = (True, '')
+    except JigsawError as exc:
+        result = (False, str(exc))
+    except SystemExit as exc:
+        result = (False, str(exc.code) if exc.code is not None else '')
+    except Exception as exc:
+        result = (False, '%s: %s' % (type(exc).__name__, exc))
+    finally:
+        buildcache.savestats()
+    return result + (timing.take(),)
+
+
+def generatebatch(puzfiles, options):
+    """Generate many puzzle files in a pool of worker processes
+
+    The number of worker processes is given by the jobs option; each
+    worker runs its LaTeX jobs one at a time, so that the total number
+    of LaTeX processes is bounded by the same number.  Returns True if
+    any of the puzzle files failed.
+    """
+
+    numjobs = getopt({}, {}, options, 'jobs', os.cpu_count() or 1)
+    numjobs = max(min(numjobs, len(puzfiles)), 1)
+    if numjobs > 1:
+        options = dict(options,
+                       options=dict(options['options'], jobs=1))
+
+    results = {}
+    if numjobs == 1:
+        for puzfile in puzfiles:
+            results[puzfile] = generatebatchfile(puzfile, options)
     else:
-        sys.exit('No jigsaw type found in puzzle file')
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=numjobs) as pool:
+            futures = {pool.submit(generatebatchfile, puzfile, options):
+                       puzfile for puzfile in puzfiles}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    results[futures[future]] = future.result()
+                except Exception as exc:
+                    results[futures[future]] = (False, str(exc), [])
+
+    for puzfile in puzfiles:
+        timing.add(results[puzfile][2])
+    failures = [f for f in puzfiles if not results[f][0]]
+    print('\nProcessed %d puzzle files: %d succeeded, %d failed' %
+          (len(puzfiles), len(puzfiles) - len(failures), len(failures)))
+    for puzfile in puzfiles:
+        ok, message, records = results[puzfile]
+        if ok:
+            print('  ok      %s' % puzfile)
+        else:
+            print('  FAILED  %s: %s' %
+                  (puzfile, message.replace('\n', '\n          ')))
+    return bool(failures)
+
+
+# The layout and puzzle options which name template files
+template_options = ['puzzleHeaderTeX', 'puzzleTemplateTeX',
+                    'solutionHeaderTeX', 'solutionTemplateTeX',
+                    'tableHeaderTeX', 'tableTemplateTeX',
+                    'puzzleHeaderMarkdown', 'puzzleTemplateMarkdown',
+                    'solutionHeaderMarkdown', 'solutionTemplateMarkdown']
+
+def dependencies(puzfile, options):
+    """Return the set of files used in generating puzfile
+
+    These are the puzzle file itself, its layout file, the template
+    files named by the layout or puzzle, any filters and any images
+    referenced by the puzzle entries.  If the puzzle file cannot be
+    read, only the puzzle file itself is returned.
+    """
 
+    deps = {puzfile}
     try:
-        layout = load(layoutf, Loader=Loader)
-    except yaml.YAMLError as exc:
-        if hasattr(exc, 'problem_mark'):
-            mark = exc.problem_mark
-            sys.exit('Error parsing puzzle layout file %s.yaml\n'
-                     'Error position: line %s, column %s' %
-                     (puztype, mark.line+1, mark.column+1))
+        data = loadpuzzle(puzfile, options)
+    except JigsawError:
+        return deps
+    if 'type' not in data:
+        return deps
+
+    templatedirs = options['templatedirs']
+    layoutpath = findtemplate(templatedirs, str(data['type']) + '-layout.yaml')
+    if not layoutpath:
+        return deps
+    deps.add(layoutpath)
+    try:
+        layout = loadlayout(templatedirs, data['type'])
+    except JigsawError:
+        return deps
+
+    for opt in template_options:
+        name = getopt(layout, data, {}, opt)
+        if name:
+            path = findtemplate(templatedirs, name)
+            if path:
+                deps.add(path)
+
+    for opt in ['texfilter', 'mdfilter']:
+        name = getopt(layout, data, options, opt)
+        if name:
+            for fdir in options['filterdirs']:
+                if os.access(os.path.join(fdir, name), os.X_OK):
+                    deps.add(os.path.join(fdir, name))
+                    break
+
+    def images(entry):
+        if isinstance(entry, dict):
+            for value in entry.values():
+                yield from images(value)
+        elif isinstance(entry, (list, stream.ItemSource)):
+            for value in entry:
+                yield from images(value)
+        elif isinstance(entry, str):
+            for (caption, img) in img_re.findall(entry):
+                yield img
+
+    for img in images(data):
+        for ext in buildcache.image_extensions:
+            if os.path.isfile(img + ext):
+                deps.add(img + ext)
+                break
+        else:
+            # Watch for it appearing
+            deps.add(img)
+
+    return deps
+
+def filestates(paths):
+    """Return a dict giving the modification state of each path"""
+    states = {}
+    for path in paths:
+        try:
+            st = os.stat(path)
+            states[path] = (st.st_mtime_ns, st.st_size)
+        except OSError:
+            states[path] = None
+    return states
+
+def watch(puzfiles, options, interval=0.5):
+    """Generate puzfiles, then regenerate them whenever they change
+
+    Each puzzle file is regenerated when it or any of the files it
+    depends on (see dependencies()) changes.  Parsed layouts stay in
+    memory between runs, and a LaTeX file is only rerun if its
+    content or images have changed since it was last built, so only
+    the affected outputs are rebuilt.  This runs until interrupted.
+    """
+
+    options = dict(options, built={})
+    deps = {}
+    states = {}
+
+    def rebuild(puzfile):
+        try:
+            generatefile(puzfile, options)
+        except JigsawError as exc:
+            print(exc, file=sys.stderr)
+            print('Failed to generate %s; waiting for changes' % puzfile,
+                  file=sys.stderr)
+        except SystemExit as exc:
+            if exc.code is not None and exc.code != 0:
+                print(exc.code, file=sys.stderr)
+            print('Failed to generate %s; waiting for changes' % puzfile,
+                  file=sys.stderr)
+        except Exception as exc:
+            print('%s: %s' % (type(exc).__name__, exc), file=sys.stderr)
+            print('Failed to generate %s; waiting for changes' % puzfile,
+                  file=sys.stderr)
+        deps[puzfile] = dependencies(puzfile, options)
+        states[puzfile] = filestates(deps[puzfile])
+        buildcache.savestats()
+
+    for puzfile in puzfiles:
+        rebuild(puzfile)
+    print('Watching %d puzzle file%s for changes; press Ctrl-C to stop' %
+          (len(puzfiles), '' if len(puzfiles) == 1 else 's'))
 
-    category = layout['category']
+    try:
+        while True:
+            time.sleep(interval)
+            for puzfile in puzfiles:
+                if filestates(deps[puzfile]) != states[puzfile]:
+                    print('\nChange detected; regenerating %s' % puzfile)
+                    rebuild(puzfile)
+    except KeyboardInterrupt:
+        print()
+
+class RenderResult:
+    """The documents generated for a puzzle
+
+    The attributes are:
+      data     the puzzle data
+      layout   the layout of the puzzle type
+      outbase  the basename of the output files, or None if the
+               documents are to be kept in memory
+      tex      an OrderedDict mapping each output name ('table',
+               'puzzle', 'solution') to the complete LaTeX source
+      headers  an OrderedDict mapping the same names to the LaTeX
+               header of each document
+      md       an OrderedDict mapping output names to Markdown text
+      mdheaders
+               an OrderedDict mapping the same names to the Markdown
+               header of each document
+      pdf      an OrderedDict mapping output names to PDF file
+               contents; this is only filled in by render(..., pdf=True)
+      texfiles, mdfiles
+               OrderedDicts mapping output names to the files written,
+               if outbase is not None; tex and md are then empty
+
+    The LaTeX and Markdown texts are exactly what would be written to
+    the output files, before any filters are run.
+    """
+
+    def __init__(self, data, layout, outbase=None):
+        self.data = data
+        self.layout = layout
+        self.outbase = outbase
+        self.tex = OrderedDict()
+        self.headers = OrderedDict()
+        self.md = OrderedDict()
+        self.mdheaders = OrderedDict()
+        self.pdf = OrderedDict()
+        self.texfiles = OrderedDict()
+        self.mdfiles = OrderedDict()
+
+    @contextlib.contextmanager
+    def opendoc(self, texts, files, name, ext, header):
+        if self.outbase is None:
+            out = io.StringIO()
+        else:
+            files[name] = self.outbase + '-' + name + ext
+            out = open(files[name], 'w')
+        with out:
+            out.write(header + '\n')
+            yield out
+            out.write('\n')
+            if self.outbase is None:
+                texts[name] = out.getvalue()
+
+    def opentex(self, name, header):
+        """Return a context manager for writing the named LaTeX output
+
+        header is written first; the caller writes the body.
+        """
+        self.headers[name] = header
+        return self.opendoc(self.tex, self.texfiles, name, '.tex', header)
+
+    def openmd(self, name, header):
+        """As opentex, for the named Markdown output"""
+        self.mdheaders[name] = header
+        return self.opendoc(self.md, self.mdfiles, name, '.md', header)
+
+    def addtex(self, name, header, body):
+        with self.opentex(name, header) as out:
+            out.write(body)
+
+    def addmd(self, name, header, body):
+        with self.openmd(name, header) as out:
+            out.write(body)
+
+
+def render(data, layout=None, options=None, pdf=False,
+           templatedirs=None, filterdirs=None):
+    """Generate the documents for a puzzle without writing any files
+
+    This is the entry point for using jigsaw-generate as a library.
+    data is the puzzle data, as it would be read from a puzzle file.
+    layout, if given, is used instead of the layout file for the
+    puzzle type.  options is a dict of settings, with the same names
+    as the config file keys (for example {'makemd': False}).
+    templatedirs and filterdirs default to the current directory, the
+    user's configuration directory and the package directories.
+
+    Returns a RenderResult.  If pdf is True, the LaTeX documents are
+    compiled in a temporary directory and the PDF contents are stored
+    in the result; any filters are only applied to the compiled
+    copies.  Raises a JigsawError (or a subclass) on failure.
+    """
+
+    pkgdatadir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    userdatadir = appdirs.user_config_dir('jigsaw-generator')
+    if templatedirs is None:
+        templatedirs = ['.',
+                        os.path.join(userdatadir, 'templates'),
+                        os.path.join(pkgdatadir, 'templates')]
+    if filterdirs is None:
+        filterdirs = ['.',
+                      os.path.join(userdatadir, 'filters'),
+                      os.path.join(pkgdatadir, 'filters')]
+    genoptions = {'templatedirs': templatedirs,
+                  'filterdirs': filterdirs,
+                  'options': dict(options or {}), 'config': {}}
+
+    result = build(data, genoptions, layout)
+    if not pdf:
+        return result
+
+    with tempfile.TemporaryDirectory(prefix='jigsaw-') as tmpdir:
+        pdfoptions = dict(genoptions,
+                          options=dict(genoptions['options'],
+                                       clean=True, keepaux=False))
+        jobs = []
+        for (name, tex) in result.tex.items():
+            fn = os.path.join(tmpdir, name + '.tex')
+            with open(fn, 'w') as f:
+                f.write(tex)
+            jobs.append((runlatex, fn, result.headers[name]))
+        passes = runjobs(jobs, result.layout, data, pdfoptions)
+        for ((func, fn, header), npasses) in zip(jobs, passes):
+            name = os.path.splitext(os.path.basename(fn))[0]
+            try:
+                with open(os.path.splitext(fn)[0] + '.pdf', 'rb') as f:
+                    result.pdf[name] = f.read()
+            except OSError:
+                npasses = None
+            if npasses is None:
+                raise LaTeXError('LaTeX failed to produce the %s PDF' % name)
+
+    return result
+
+
+@timing.timed()
+def build(data, options, layout=None, outbase=None, variant=None):
+    """Generate the documents for data and return a RenderResult
+
+    options is as for generate(), though the 'puzbase' entry is not
+    needed.  If layout is not given, the layout file for the puzzle
+    type is loaded.  If outbase is given, the documents are written
+    to files named after it as they are generated rather than being
+    kept in memory.  If variant is given, the documents are for that
+    numbered variant of the puzzle: "(version N)" is added to the
+    title, and the cards are shuffled differently for each variant
+    (see variantseed()).  Raises PuzzleDataError if data is not a
+    mapping or its pairs, edges or cards are not lists.
+    """
+
+    checkdata(data)
+    templateregistry(options['templatedirs']).refresh()
+    if any(isinstance(data.get(key), stream.ItemSource)
+           for key in stream.stream_keys):
+        entrylimit = entry_cache_stream_size
+    else:
+        entrylimit = None
+    ctx = RunContext(entrylimit=entrylimit,
+                     seed=variantseed(data, options, variant))
+    if variant is not None:
+        if data.get('title'):
+            title = '%s (version %d)' % (data['title'], variant)
+        else:
+            title = 'Version %d' % variant
+        data = dict(data, title=title)
+    if layout is None:
+        if 'type' in data:
+            layout = loadlayout(options['templatedirs'], data['type'])
+        else:
+            raise PuzzleDataError('No jigsaw type found in puzzle file')
+    else:
+        layout = compilelayout(dict(layout), data.get('type'))
+
+    category = layout.get('category')
     try:
         generator = {
             'jigsaw': generate_jigsaw,
@@ -1345,21 +3059,563 @@ def generate(data, options):
             'dominoes': generate_cardsort
             }[category]
     except KeyError:
-        sys.exit('Unrecognised category in %s layout file: %s' %
-                 (puztype, category))
+        raise LayoutError('Unrecognised category in %s layout file: %s' %
+                          (data.get('type'), category))
 
-    generator(data, options, layout)
+    result = RenderResult(data, layout, outbase)
+    try:
+        generator(ctx, data, options, layout, result)
+    except stream.StreamError as exc:
+        raise PuzzleDataError(str(exc))
+    return result
 
 
-def generate_jigsaw(data, options, layout):
-    """Generate output from data for jigsaw-type puzzles."""
+def checkdata(data):
+    """Check that data has the form of puzzle data
 
-    puzbase = options['puzbase']
-    templatedirs = options['templatedirs']
+    Raises PuzzleDataError if it does not.  The pairs themselves are
+    checked by checkpairs() when they are read.
+    """
+
+    if not isinstance(data, dict):
+        raise PuzzleDataError('Puzzle data must be a mapping, not %s' %
+                              type(data).__name__)
+    for key in ('pairs', 'edges', 'cards'):
+        if key not in data:
+            continue
+        value = data[key]
+        if isinstance(value, (list, tuple)):
+            continue
+        if key in stream.stream_keys and isinstance(value, stream.ItemSource):
+            continue
+        raise PuzzleDataError('The %s in the puzzle data must be a list' %
+                              key)
+
+
+def readpairs(source, layout, pairs):
+    """Read the pairs of the puzzle data from source into pairs
+
+    The pairs are appended to pairs, which is returned.  Each pair is
+    checked to be a list of two entries as it is read, and if layout
+    needs a fixed number of pairs, reading stops as soon as there are
+    too many, so that a streamed puzzle file is only read once.
+    Raises PuzzleDataError if the pairs are not right for layout.
+    """
+
+    for (i, p) in enumerate(source):
+        if layout['pairs'] and i == layout['pairs']:
+            raise PuzzleDataError(
+                'Puzzle type %s needs exactly %s pairs' %
+                (layout['typename'], layout['pairs']))
+        if not (isinstance(p, (list, tuple)) and len(p) == 2):
+            raise PuzzleDataError('Pair %s in the puzzle data must be a '
+                                  'list of two entries: %r' % (i + 1, p))
+        pairs.append(p)
+
+    if layout['pairs'] == 0:  # which means any number of pairs
+        if len(pairs) == 0:
+            raise PuzzleDataError(
+                'Puzzle type %s needs at least one pair' %
+                layout['typename'])
+    elif len(pairs) != layout['pairs']:
+        raise PuzzleDataError(
+            'Puzzle type %s needs exactly %s pairs' %
+            (layout['typename'], layout['pairs']))
+    return pairs
+
+
+class PairView:
+    """The pairs of a puzzle in the order in which they are used
+
+    pairs may be a list or a stream.SpooledItems.  Pair k of the view
+    is pair order[k] of pairs, with its question and answer swapped if
+    flips[k] is true, and the pairs in extra follow these; without
+    order or flips, the pairs are taken as they are.  This allows the
+    pairs to be shuffled and flipped without copying them.
+    """
+
+    def __init__(self, pairs, order=None, flips=None, extra=()):
+        self.pairs = pairs
+        self.numpairs = len(pairs)
+        self.order = order
+        self.flips = flips
+        self.extra = list(extra)
+
+    def __len__(self):
+        return self.numpairs + len(self.extra)
+
+    def __getitem__(self, k):
+        if k >= self.numpairs:
+            return self.extra[k - self.numpairs]
+        p = self.pairs[k if self.order is None else self.order[k]]
+        if self.flips is not None and self.flips[k]:
+            return [p[1], p[0]]
+        return p
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self[k]
+
+
+def variantseed(data, options, variant=None):
+    """Return the seed for shuffling a puzzle, or None to use its title
+
+    This is the seed option, if it is set.  Each numbered variant has
+    its own seed, made from the seed option or the title and the
+    variant number, so that the variants are shuffled independently
+    of each other but in the same way on every run.
+    """
+
+    seed = getopt({}, data, options, 'seed')
+    if variant is None:
+        return seed
+    if seed is None:
+        seed = data.get('title', '')
+    return '%s/%d' % (seed, variant)
+
+
+def compileoutputs(results, options):
+    """Run the files written for results through LaTeX and the filters
+
+    results is a list of RenderResults for the same puzzle, such as
+    its variants, whose files are all processed together.  The LaTeX
+    files are run through LaTeX and the Markdown files through their
+    filters.  If the shardpages option is set, card documents with
+    more pages than this are split into shards (see splitshards()),
+    which are compiled in parallel and then merged into the PDF file
+    for the whole document.  If the externalize option is set, the
+    pieces of jigsaw puzzles and solutions are first replaced by
+    separately compiled graphics (see pieces.py).
+    """
+
+    layout = results[0].layout
+    data = results[0].data
+    piecedirs = externalizepieces(results, options)
+    shardpages = getopt(layout, data, options, 'shardpages', 0)
+    if shardpages and not pdftools.canmerge():
+        global shard_warned
+        if not shard_warned:
+            print('Warning: shardpages needs qpdf, pdfunite or the pypdf '
+                  'module to merge the shards; not splitting documents',
+                  file=sys.stderr)
+            shard_warned = True
+        shardpages = 0
+
+    # The LaTeX runs and Markdown filters are independent of each
+    # other, so we collect them and run them together at the end.
+    jobs = []
+    sharded = []
+    for result in results:
+        for (name, fn) in result.texfiles.items():
+            header = result.headers[name]
+            shards = splitshards(fn, int(shardpages)) if shardpages else None
+            if shards:
+                sharded.append((fn, header, len(jobs), shards))
+                jobs.extend((runlatex, shard, header) for shard in shards)
+            else:
+                jobs.append((runlatex, fn, header))
+        for (name, fn) in result.mdfiles.items():
+            jobs.append((filtermd, fn))
+
+    passes = runjobs(jobs, layout, data, options)
+
+    doclean = getopt(layout, data, options, 'clean', True)
+    if doclean:
+        for piecedir in piecedirs:
+            shutil.rmtree(piecedir, ignore_errors=True)
+    for (fn, header, first, shards) in sharded:
+        basename = os.path.splitext(fn)[0]
+        pdfs = [os.path.splitext(shard)[0] + '.pdf' for shard in shards]
+        if all(passes[first + i] is not None and os.path.exists(pdf)
+               for (i, pdf) in enumerate(pdfs)):
+            with timing.stage('pdfmerge', file=fn):
+                merged = pdftools.merge(pdfs, basename + '.pdf')
+        else:
+            merged = False
+        if merged:
+            progress(layout, data, options,
+                     '%s: merged %d shards' % (fn, len(shards)))
+            cleanlatex(fn, layout, data, options, False)
+        else:
+            print('Warning: compiling %s as a whole instead' % fn,
+                  file=sys.stderr)
+            runlatex(fn, layout, data, options, header)
+        if doclean:
+            for pdf in pdfs:
+                try:
+                    os.remove(pdf)
+                except OSError:
+                    pass
+
+
+def externalizepieces(results, options):
+    """Replace the pieces of the jigsaw documents of results by graphics
+
+    This is done for the puzzle and solution documents of jigsaws if
+    the externalize option is set, unless a LaTeX filter is used, as
+    the pieces would not be filtered.  Returns the list of piece
+    directories made.
+    """
+
+    layout = results[0].layout
+    data = results[0].data
+    if (layout.get('category') != 'jigsaw' or
+            not getopt(layout, data, options, 'externalize', False)):
+        return []
+    if getopt(layout, data, options, 'texfilter'):
+        global externalize_warned
+        if not externalize_warned:
+            print('Warning: externalize cannot be used with a texfilter; '
+                  'drawing the jigsaw pieces in place', file=sys.stderr)
+            externalize_warned = True
+        return []
+
+    numjobs = getopt(layout, data, options, 'jobs', os.cpu_count() or 1)
+    piecedirs = []
+    for result in results:
+        for (name, fn) in result.texfiles.items():
+            if name not in ('puzzle', 'solution'):
+                continue
+            with timing.stage('externalize', file=fn):
+                piecedir = pieces.externalize(
+                    fn, result.headers[name],
+                    getopt(layout, data, options, 'latex', 'pdflatex'),
+                    numjobs=int(numjobs),
+                    precompile=getopt(layout, data, options, 'precompile',
+                                      False),
+                    usecache=getopt(layout, data, options, 'cache', True),
+                    cachesize=getopt(layout, data, options, 'cachesize',
+                                     buildcache.default_cachesize),
+                    clean=getopt(layout, data, options, 'clean', True),
+                    verbose=getopt(layout, data, options, 'verbose', False))
+            if piecedir:
+                piecedirs.append(piecedir)
+    return piecedirs
+
+
+@timing.timed()
+def generate(data, options):
+    """Generate output from data, using options passed to this function.
+
+    Thus function is presently called from main(), but might well be
+    called from a GUI at some point in the future, which is why it has
+    been separated out; render() provides the same without writing
+    any files.
+
+    When this function is called, data must contain a recognised
+    jigsaw type, and the options dictionary must contain an entry
+    'puzbase' with the file basename for this particular puzzle.
+    Raises a JigsawError (or a subclass) if the puzzle cannot be
+    generated.
+    """
+
+    # The output files are named after the 'output' option if given,
+    # or otherwise after the puzzle file
     try:
         outbase = options['options']['output']
     except KeyError:
+        outbase = os.path.basename(options['puzbase'])
+
+    variants = getopt({}, data, options, 'variants', 0)
+    if not variants:
+        compileoutputs([build(data, options, outbase=outbase)], options)
+        return
+
+    # The layout and templates are only read once, as they are cached
+    # by loadlayout() and readtemplate()
+    variants = int(variants)
+    if getopt({}, data, options, 'combine', False):
+        results = [build(data, options, variant=variant)
+                   for variant in range(1, variants + 1)]
+        compileoutputs([combineresults(results, outbase)], options)
+    else:
+        compileoutputs([build(data, options,
+                              outbase='%s-v%d' % (outbase, variant),
+                              variant=variant)
+                        for variant in range(1, variants + 1)], options)
+
+
+def combineresults(results, outbase):
+    """Write the documents of several variants of a puzzle together
+
+    results is a list of RenderResults kept in memory.  Each LaTeX
+    document is written to a single file named after outbase, holding
+    that document for every variant in turn (see combinetex()), so
+    that LaTeX is only run once for each.  The Markdown documents are
+    written separately for each variant, to files named as they would
+    be without combining them.  Returns the RenderResult for the files
+    written.
+    """
+
+    combined = RenderResult(results[0].data, results[0].layout, outbase)
+    for (name, header) in results[0].headers.items():
+        combined.addtex(name, header,
+                        combinetex(header,
+                                   [result.tex[name] for result in results]))
+    for (variant, result) in enumerate(results, 1):
+        for (name, header) in result.mdheaders.items():
+            text = result.md[name]
+            combined.addmd('v%d-%s' % (variant, name), header,
+                           text[len(header) + 1:-1])
+    return combined
+
+
+# Preamble statements which define something, and so cannot be made
+# again with the same name in a combined document
+texdefinition_re = re.compile(r'\s*\\(new(command|environment|length|counter|'
+                              r'if|savebox|theorem|toks|dimen|skip|box|'
+                              r'columntype)|DeclareMathOperator|'
+                              r'NewDocument(Command|Environment))'
+                              r'(?![a-zA-Z])')
+
+def texstatements(text):
+    """Split LaTeX source into statements, each of whole lines
+
+    A statement ends at the end of the first line at which all of its
+    braces have been closed, so that a definition spread over several
+    lines is kept together.  Braces in comments are not counted.
+    """
+
+    statement = ''
+    depth = 0
+    for line in text.splitlines(True):
+        code = re.sub(r'(?<!\\)%.*', '', line)
+        depth += (len(re.findall(r'(?<!\\)\{', code)) -
+                  len(re.findall(r'(?<!\\)\}', code)))
+        statement += line
+        if depth <= 0:
+            yield statement
+            statement = ''
+            depth = 0
+    if statement:
+        yield statement
+
+def combinetex(header, texts, partsfile=False):
+    """Join LaTeX documents with the same header into one document
+
+    Each of texts is a complete document beginning with header, as
+    written by RenderResult.opentex().  The combined document has the
+    preamble of the first document.  The \\usepackage and
+    \\usetikzlibrary lines of the later preambles are added to it, as
+    they are not allowed after \\begin{document}; the rest of each
+    later preamble, such as the page headings, is put at the start of
+    its part of the combined document.  A definition, such as a
+    \\newcommand, which has already been made in the same way by an
+    earlier document is left out, as LaTeX does not allow it to be
+    made twice.  Each document starts on a new page, with the page
+    number reset.  The shard marks are removed, as a combined document
+    is compiled as a whole.
+
+    If partsfile is True, LaTeX writes the number of pages of each of
+    the documents, one per line, to the file \\jobname.parts (see
+    readparts()).
+
+    Returns the combined document without the header, as for
+    RenderResult.addtex().
+    """
+
+    preamble = []
+    # The definition statements made so far
+    defined = set()
+    parts = []
+    for tex in texts:
+        rest = tex[len(header) + 1:]
+        begin = rest.find('\\begin{document}')
+        end = rest.rfind('\\end{document}')
+        if begin < 0 or end < begin:
+            raise TemplateError('Cannot combine LaTeX documents without '
+                                '\\begin{document} and \\end{document}')
+        local = []
+        for statement in texstatements(rest[:begin]):
+            if texdefinition_re.match(statement):
+                if statement in defined:
+                    continue
+                defined.add(statement)
+            if not parts:
+                preamble.append(statement)
+            elif statement.lstrip().startswith(('\\usepackage',
+                                                '\\usetikzlibrary')):
+                if statement not in preamble:
+                    preamble.append(statement)
+            else:
+                local.append(statement)
+        body = rest[begin + len('\\begin{document}'):end]
+        parts.append(''.join(local) +
+                     ''.join(line for line in body.splitlines(True)
+                             if line not in (shard_page_mark,
+                                             shard_end_mark)))
+
+    if partsfile:
+        preamble.append('\\newwrite\\jigsawparts\n'
+                        '\\immediate\\openout\\jigsawparts=\\jobname.parts\n')
+        parts = [part + '\\clearpage\n\\immediate\\write\\jigsawparts'
+                 '{\\the\\numexpr\\value{page}-1\\relax}\n'
+                 for part in parts]
+    return (''.join(preamble) + '\\begin{document}' +
+            '\\clearpage\n\\setcounter{page}{1}\n'.join(parts) +
+            '\\end{document}\n')
+
+
+def readparts(fn):
+    """Return the page ranges of the documents combined into fn
+
+    These are read from the parts file written by LaTeX (see
+    combinetex()), and returned as a list of pairs (first, last) of
+    page numbers in the PDF file, counting from 1.  Returns None if
+    the parts file cannot be read.
+    """
+
+    try:
+        with open(os.path.splitext(fn)[0] + '.parts') as f:
+            counts = [int(line) for line in f if line.strip()]
+    except (OSError, ValueError):
+        return None
+    ranges = []
+    first = 1
+    for count in counts:
+        ranges.append((first, first + count - 1))
+        first += count
+    return ranges
+
+
+@timing.timed()
+def generatebooklet(puzfiles, options, bookbase):
+    """Generate the puzzle files together as a booklet
+
+    Each puzzle, or each of its variants if the variants option is
+    set, is built in memory, and its LaTeX documents are combined (see
+    combinetex()) into a puzzle, solution and table document for the
+    whole booklet, named after bookbase; LaTeX is then run once on
+    each.  Puzzles whose LaTeX headers differ cannot be combined, so
+    each different set of headers makes a separate booklet, named
+    bookbase-2, bookbase-3 and so on.  The LaTeX options, such as the
+    LaTeX program, are those of the first puzzle in each booklet.  The
+    Markdown documents are written separately for each puzzle, as
+    without a booklet.
+
+    If the splitbooklet option is set, the PDF file of each puzzle is
+    also taken out of the booklet PDF files afterwards.  The build
+    cache is then not used for the booklet, as LaTeX must be run to
+    find the pages of each puzzle.
+
+    Returns True if any of the puzzle files failed.
+    """
+
+    split = getopt({}, {}, options, 'splitbooklet', False)
+    if split and not pdftools.canextract():
+        print('Warning: splitbooklet needs qpdf, pdfseparate and pdfunite '
+              'or the pypdf module; not splitting the booklet',
+              file=sys.stderr)
+        split = False
+    if split:
+        options = dict(options, options=dict(options['options'],
+                                             cache=False))
+
+    # The booklets, keyed by the LaTeX headers of their puzzles; each
+    # is a list of (outbase, RenderResult) for its puzzles
+    booklets = OrderedDict()
+    mdresults = []
+    failures = {}
+    for puzfile in puzfiles:
+        puzbase = os.path.splitext(puzfile)[0]
         outbase = os.path.basename(puzbase)
+        puzoptions = dict(options, puzbase=puzbase)
+        try:
+            data = loadpuzzle(puzfile, options)
+            variants = int(getopt({}, data, puzoptions, 'variants', 0))
+            if variants:
+                results = [('%s-v%d' % (outbase, variant),
+                            build(data, puzoptions, variant=variant))
+                           for variant in range(1, variants + 1)]
+            else:
+                results = [(outbase, build(data, puzoptions))]
+        except JigsawError as exc:
+            failures[puzfile] = str(exc)
+            continue
+        for (partbase, result) in results:
+            key = tuple(result.headers.items())
+            booklets.setdefault(key, []).append((partbase, result))
+            if result.md:
+                md = RenderResult(result.data, result.layout, partbase)
+                for (name, header) in result.mdheaders.items():
+                    md.addmd(name, header,
+                             result.md[name][len(header) + 1:-1])
+                mdresults.append(md)
+
+    combined = []
+    for (number, parts) in enumerate(booklets.values(), 1):
+        base = bookbase if number == 1 else '%s-%d' % (bookbase, number)
+        first = parts[0][1]
+        booklet = RenderResult(first.data, first.layout, base)
+        for (name, header) in first.headers.items():
+            booklet.addtex(name, header,
+                           combinetex(header,
+                                      [result.tex[name]
+                                       for (partbase, result) in parts],
+                                      split))
+        progress(first.layout, first.data, options, '%s: %d puzzle%s' %
+                 (base, len(parts), '' if len(parts) == 1 else 's'))
+        combined.append((booklet, parts))
+
+    for (booklet, parts) in combined:
+        compileoutputs([booklet], options)
+    if mdresults:
+        compileoutputs(mdresults, options)
+
+    if split:
+        for (booklet, parts) in combined:
+            for (name, fn) in booklet.texfiles.items():
+                splitbooklet(fn, name, [partbase for (partbase, result)
+                                        in parts],
+                             booklet.layout, booklet.data, options)
+
+    print('\nProcessed %d puzzle files: %d succeeded, %d failed' %
+          (len(puzfiles), len(puzfiles) - len(failures), len(failures)))
+    for puzfile in puzfiles:
+        if puzfile in failures:
+            print('  FAILED  %s: %s' %
+                  (puzfile, failures[puzfile].replace('\n', '\n          ')))
+        else:
+            print('  ok      %s' % puzfile)
+    return bool(failures)
+
+
+def splitbooklet(fn, name, partbases, layout, data, options):
+    """Take the PDF file of each puzzle out of the booklet document fn
+
+    name is the output name ('puzzle', 'solution' or 'table'), and
+    partbases the basenames of the puzzles in the booklet, in order.
+    """
+
+    basename = os.path.splitext(fn)[0]
+    pdf = basename + '.pdf'
+    ranges = readparts(fn)
+    if not os.path.exists(pdf) or ranges is None:
+        print('Warning: cannot split %s into puzzles' % fn, file=sys.stderr)
+        return
+    if len(ranges) != len(partbases):
+        print('Warning: %s has %d puzzles but LaTeX found %d; not '
+              'splitting it' % (fn, len(partbases), len(ranges)),
+              file=sys.stderr)
+    else:
+        for (partbase, (first, last)) in zip(partbases, ranges):
+            pdftools.extract(pdf, first, last,
+                             '%s-%s.pdf' % (partbase, name))
+    if getopt(layout, data, options, 'clean', True):
+        try:
+            os.remove(basename + '.parts')
+        except OSError:
+            pass
+
+
+@timing.timed()
+def generate_jigsaw(ctx, data, options, layout, result):
+    """Generate output from data for jigsaw-type puzzles.
+
+    The documents are written to the RenderResult result.
+    """
+
+    templatedirs = options['templatedirs']
 
     bodypuzfile = getopt(layout, data, {}, 'puzzleTemplateTeX')
     makepdf = getopt(layout, data, options, 'makepdf', True)
@@ -1367,11 +3623,8 @@ def generate_jigsaw(data, options, layout):
     if makepdf and bodypuzfile:
         headerfile = getopt(layout, data, {}, 'puzzleHeaderTeX')
         if headerfile:
-            bodypuz = opentemplate(templatedirs, bodypuzfile).read()
-            outpuzfile = outbase + '-puzzle.tex'
-            outpuz = open(outpuzfile, 'w')
-            header = opentemplate(templatedirs, headerfile).read()
-            print(header, file=outpuz)
+            bodypuz = readtemplate(templatedirs, bodypuzfile)
+            puzheader = readtemplate(templatedirs, headerfile)
             puzzletex = True
         else:
             print('puzzleTemplateTeX file specified but not puzzleHeaderTeX',
@@ -1384,11 +3637,8 @@ def generate_jigsaw(data, options, layout):
     if makepdf and bodysolfile:
         headerfile = getopt(layout, data, {}, 'solutionHeaderTeX')
         if headerfile:
-            bodysol = opentemplate(templatedirs, bodysolfile).read()
-            outsolfile = outbase + '-solution.tex'
-            outsol = open(outsolfile, 'w')
-            header = opentemplate(templatedirs, headerfile).read()
-            print(header, file=outsol)
+            bodysol = readtemplate(templatedirs, bodysolfile)
+            solheader = readtemplate(templatedirs, headerfile)
             solutiontex = True
         else:
             print('solutionTemplateTeX file specified '
@@ -1402,11 +3652,8 @@ def generate_jigsaw(data, options, layout):
     if makepdf and bodytablefile:
         headerfile = getopt(layout, data, {}, 'tableHeaderTeX')
         if headerfile:
-            bodytable = opentemplate(templatedirs, bodytablefile).read()
-            outtablefile = outbase + '-table.tex'
-            outtable = open(outtablefile, 'w')
-            header = opentemplate(templatedirs, headerfile).read()
-            print(header, file=outtable)
+            bodytable = readtemplate(templatedirs, bodytablefile)
+            tableheader = readtemplate(templatedirs, headerfile)
             tabletex = True
         else:
             print('tableTemplateTeX file specified but not tableHeaderTeX',
@@ -1419,11 +3666,8 @@ def generate_jigsaw(data, options, layout):
     if makemd and bodypuzmdfile:
         headerfile = getopt(layout, data, {}, 'puzzleHeaderMarkdown')
         if headerfile:
-            bodypuzmd = opentemplate(templatedirs, bodypuzmdfile).read()
-            outpuzmdfile = outbase + '-puzzle.md'
-            outpuzmd = open(outpuzmdfile, 'w')
-            header = opentemplate(templatedirs, headerfile).read()
-            print(header, file=outpuzmd)
+            bodypuzmd = readtemplate(templatedirs, bodypuzmdfile)
+            puzheadermd = readtemplate(templatedirs, headerfile)
             puzzlemd = True
         else:
             print('puzzleTemplateMarkdown file specified '
@@ -1437,11 +3681,8 @@ def generate_jigsaw(data, options, layout):
     if makemd and bodysolmdfile:
         headerfile = getopt(layout, data, {}, 'solutionHeaderMarkdown')
         if headerfile:
-            bodysolmd = opentemplate(templatedirs, bodysolmdfile).read()
-            outsolmdfile = outbase + '-solution.md'
-            outsolmd = open(outsolmdfile, 'w')
-            header = opentemplate(templatedirs, headerfile).read()
-            print(header, file=outsolmd)
+            bodysolmd = readtemplate(templatedirs, bodysolmdfile)
+            solheadermd = readtemplate(templatedirs, headerfile)
             solutionmd = True
         else:
             print('solutionTemplateMarkdown file specified '
@@ -1465,34 +3706,28 @@ def generate_jigsaw(data, options, layout):
         dsubs['title'] = data['title']
     else:
         dsubs['title'] = ''
-    random.seed(dsubs['title'])
+    ctx.seedrandom(dsubs['title'])
 
     # Read the card content
     # Three types of cards: pairs, edges, cards (which are single cards
     # for sorting activities, and do not appear in jigsaw types)
     if 'pairs' in layout:
         if 'pairs' in data:
-            pairs = data['pairs']
-            if layout['pairs'] == 0:  # which means any number of pairs
-                if len(pairs) == 0:
-                    sys.exit('Puzzle type %s needs at least one pair' %
-                             layout['typename'])
-            else:
-                if len(pairs) != layout['pairs']:
-                    sys.exit('Puzzle type %s needs exactly %s pairs' %
-                             (layout['typename'], layout['pairs']))
+            pairs = readpairs(data['pairs'], layout, [])
         else:
-            sys.exit('Puzzle type %s requires pairs in data file' %
-                     layout['typename'])
+            raise PuzzleDataError(
+                'Puzzle type %s requires pairs in data file' %
+                layout['typename'])
     elif 'pairs' in data:
-        sys.exit('Puzzle type %s does not accept pairs in data file' %
-                 layout['typename'])
+        raise PuzzleDataError(
+            'Puzzle type %s does not accept pairs in data file' %
+            layout['typename'])
     else:
         pairs = []  # so that later bits of code don't barf
 
     if 'edges' in layout:
         if 'edges' in data:
-            edges = data['edges']
+            edges = list(data['edges'])
             if len(edges) > layout['edges']:
                 print('Warning: more than %s edges given; '
                       'extra will be ignored' % layout['edges'],
@@ -1506,27 +3741,31 @@ def generate_jigsaw(data, options, layout):
         else:
             edges = [''] * layout['edges']
     elif 'edges' in data:
-        sys.exit('Puzzle type %s does not accept edges in data file' %
-                 layout['typename'])
+        raise PuzzleDataError(
+            'Puzzle type %s does not accept edges in data file' %
+            layout['typename'])
     else:
         edges = []  # so that later bits of code don't barf
 
     if 'cards' in data:
-        sys.exit('Puzzle type %s does not accept cards in data file' %
-                 layout['typename'])
+        raise PuzzleDataError(
+            'Puzzle type %s does not accept cards in data file' %
+            layout['typename'])
     cards = []  # so later call to make_table doesn't break
 
+    # pairs and edges are copies of the lists in the puzzle data, which
+    # may be shared, so we can shuffle them in place
     if getopt(layout, data, {}, 'shufflePairs'):
-        random.shuffle(pairs)
+        ctx.random.shuffle(pairs)
     if getopt(layout, data, {}, 'shuffleEdges'):
-        random.shuffle(edges)
+        ctx.random.shuffle(edges)
 
     # We preserve the original pairs data for the table; we only flip
     # the questions and answers (if requested) for the puzzle cards
     if getopt(layout, data, {}, 'flip'):
         flippedpairs = []
         for p in pairs:
-            if random.choice([True, False]):
+            if ctx.random.choice([True, False]):
                 flippedpairs.append([p[1], p[0]])
             else:
                 flippedpairs.append([p[0], p[1]])
@@ -1535,75 +3774,49 @@ def generate_jigsaw(data, options, layout):
 
     # The following calls will add the appropriate substitution
     # variables to dsubs and dsubsmd
-    global exists_hidden
-    exists_hidden = False
+    ctx.exists_hidden = False
 
     if tabletex or solutionmd:
-        make_table(pairs, edges, cards, dsubs, dsubsmd)
+        make_table(ctx, pairs, edges, cards, dsubs, dsubsmd)
 
     if 'triangleSolutionCards' in layout:
-        make_triangles(data, layout, flippedpairs, edges, dsubs, dsubsmd)
+        make_triangles(ctx, data, layout, flippedpairs, edges, dsubs, dsubsmd)
 
     if 'squareSolutionCards' in layout:
-        make_squares(data, layout, flippedpairs, edges, dsubs, dsubsmd)
+        make_squares(ctx, data, layout, flippedpairs, edges, dsubs, dsubsmd)
 
-    if exists_hidden:
-        hiddennote = getopt(layout, data, {}, 'hiddennote',
-          'Entries that are hidden in the puzzle are highlighted in yellow.')
-        hiddennotemd = getopt(layout, data, {}, 'hiddennotemd',
-          'Entries that are hidden in the puzzle are indicated with (*).')
-        hiddennotetable = getopt(layout, data, {}, 'hiddennotetable',
-                                 hiddennotemd)
-        dsubs['hiddennotesolution'] = hiddennote
-        dsubs['hiddennotetable'] = hiddennotetable
-        dsubsmd['hiddennotemd'] = hiddennotemd
-    else:
-        dsubs['hiddennotesolution'] = ''
-        dsubs['hiddennotetable'] = ''
-        dsubsmd['hiddennotemd'] = ''
-
-    dsubs['puzzlenote'] = getopt(layout, data, {}, 'note', '')
-    dsubsmd['puzzlenote'] = getopt(layout, data, {}, 'note', '')
+    make_notes(data, layout, ctx.exists_hidden, dsubs, dsubsmd)
 
     if tabletex:
-        btext = dosub(bodytable, dsubs)
-        print(btext, file=outtable)
-        outtable.close()
-        runlatex(outtablefile, layout, data, options)
+        with result.opentex('table', tableheader) as out:
+            writesub(out, bodytable, dsubs)
 
     if puzzletex:
-        ptext = dosub(bodypuz, dsubs)
-        print(ptext, file=outpuz)
-        outpuz.close()
-        runlatex(outpuzfile, layout, data, options)
+        with result.opentex('puzzle', puzheader) as out:
+            writesub(out, bodypuz, dsubs)
 
     if solutiontex:
-        stext = dosub(bodysol, dsubs)
-        print(stext, file=outsol)
-        outsol.close()
-        runlatex(outsolfile, layout, data, options)
+        with result.opentex('solution', solheader) as out:
+            writesub(out, bodysol, dsubs)
 
     if puzzlemd:
-        ptextmd = dosub(bodypuzmd, dsubsmd)
-        print(ptextmd, file=outpuzmd)
-        outpuzmd.close()
-        filtermd(outpuzmdfile, layout, data, options)
+        with result.openmd('puzzle', puzheadermd) as out:
+            writesub(out, bodypuzmd, dsubsmd)
 
     if solutionmd:
-        stextmd = dosub(bodysolmd, dsubsmd)
-        print(stextmd, file=outsolmd)
-        outsolmd.close()
-        filtermd(outsolmdfile, layout, data, options)
+        with result.openmd('solution', solheadermd) as out:
+            writesub(out, bodysolmd, dsubsmd)
 
-def generate_cardsort(data, options, layout):
-    """Generate cards for a cardsort or domino activity"""
+@timing.timed()
+def generate_cardsort(ctx, data, options, layout, result):
+    """Generate cards for a cardsort or domino activity
+
+    The documents are written to the RenderResult result as the cards
+    are made, so that even a very large deck is never held in memory
+    as a whole document.
+    """
 
-    puzbase = options['puzbase']
     templatedirs = options['templatedirs']
-    try:
-        outbase = options['options']['output']
-    except KeyError:
-        outbase = os.path.basename(puzbase)
 
     category = layout['category']
     if category == 'cardsort':
@@ -1618,11 +3831,8 @@ def generate_cardsort(data, options, layout):
     if makepdf and bodypuzfile:
         headerfile = getopt(layout, data, {}, 'puzzleHeaderTeX')
         if headerfile:
-            bodypuz = opentemplate(templatedirs, bodypuzfile).read()
-            outpuzfile = outbase + '-puzzle.tex'
-            outpuz = open(outpuzfile, 'w')
-            header = opentemplate(templatedirs, headerfile).read()
-            print(header, file=outpuz)
+            bodypuz = readtemplate(templatedirs, bodypuzfile)
+            puzheader = readtemplate(templatedirs, headerfile)
             puzzletex = True
         else:
             print('puzzleTemplateTeX file specified but not puzzleHeaderTeX',
@@ -1636,11 +3846,8 @@ def generate_cardsort(data, options, layout):
         if makepdf and bodysolfile:
             headerfile = getopt(layout, data, {}, 'solutionHeaderTeX')
             if headerfile:
-                bodysol = opentemplate(templatedirs, bodysolfile).read()
-                outsolfile = outbase + '-solution.tex'
-                outsol = open(outsolfile, 'w')
-                header = opentemplate(templatedirs, headerfile).read()
-                print(header, file=outsol)
+                bodysol = readtemplate(templatedirs, bodysolfile)
+                solheader = readtemplate(templatedirs, headerfile)
                 solutiontex = True
             else:
                 print('solutionTemplateTeX file specified '
@@ -1656,11 +3863,8 @@ def generate_cardsort(data, options, layout):
     if makepdf and bodytablefile:
         headerfile = getopt(layout, data, {}, 'tableHeaderTeX')
         if headerfile:
-            bodytable = opentemplate(templatedirs, bodytablefile).read()
-            outtablefile = outbase + '-table.tex'
-            outtable = open(outtablefile, 'w')
-            header = opentemplate(templatedirs, headerfile).read()
-            print(header, file=outtable)
+            bodytable = readtemplate(templatedirs, bodytablefile)
+            tableheader = readtemplate(templatedirs, headerfile)
             tabletex = True
         else:
             print('tableTemplateTeX file specified but not tableHeaderTeX',
@@ -1673,11 +3877,8 @@ def generate_cardsort(data, options, layout):
     if makemd and bodypuzmdfile:
         headerfile = getopt(layout, data, {}, 'puzzleHeaderMarkdown')
         if headerfile:
-            bodypuzmd = opentemplate(templatedirs, bodypuzmdfile).read()
-            outpuzmdfile = outbase + '-puzzle.md'
-            outpuzmd = open(outpuzmdfile, 'w')
-            header = opentemplate(templatedirs, headerfile).read()
-            print(header, file=outpuzmd)
+            bodypuzmd = readtemplate(templatedirs, bodypuzmdfile)
+            puzheadermd = readtemplate(templatedirs, headerfile)
             puzzlemd = True
         else:
             print('puzzleTemplateMarkdown file specified '
@@ -1692,11 +3893,8 @@ def generate_cardsort(data, options, layout):
         if makemd and bodysolmdfile:
             headerfile = getopt(layout, data, {}, 'solutionHeaderMarkdown')
             if headerfile:
-                bodysolmd = opentemplate(templatedirs, bodysolmdfile).read()
-                outsolmdfile = outbase + '-solution.md'
-                outsolmd = open(outsolmdfile, 'w')
-                header = opentemplate(templatedirs, headerfile).read()
-                print(header, file=outsolmd)
+                bodysolmd = readtemplate(templatedirs, bodysolmdfile)
+                solheadermd = readtemplate(templatedirs, headerfile)
                 solutionmd = True
             else:
                 print('solutionTemplateMarkdown file specified '
@@ -1783,7 +3981,8 @@ def generate_cardsort(data, options, layout):
             puztemplate['end_page'] = templatematch.group(4)
             puztemplate['end_document'] = templatematch.group(5)
         else:
-            sys.exit('TeX puzzle template does not have required structure')
+            raise TemplateError(
+                'TeX puzzle template does not have required structure')
 
         if dosoln:
             templatematch = re.search('^%%% BEGIN DOCUMENT.*?^(.*?)'
@@ -1799,8 +3998,8 @@ def generate_cardsort(data, options, layout):
                 soltemplate['end_page'] = templatematch.group(4)
                 soltemplate['end_document'] = templatematch.group(5)
             else:
-                sys.exit('TeX solution template does not have '
-                         'required structure')
+                raise TemplateError('TeX solution template does not have '
+                                    'required structure')
 
     if puzzlemd:
         templatemdmatch = re.search('^### BEGIN DOCUMENT.*?$(.*?)'
@@ -1812,8 +4011,8 @@ def generate_cardsort(data, options, layout):
             puztemplatemd['item'] = templatemdmatch.group(2)
             puztemplatemd['end_document'] = templatemdmatch.group(3)
         else:
-            sys.exit('Markdown puzzle template does not have '
-                     'required structure')
+            raise TemplateError('Markdown puzzle template does not have '
+                                'required structure')
 
         if dosoln:
             templatemdmatch = re.search('^### BEGIN DOCUMENT.*?$(.*?)'
@@ -1825,8 +4024,8 @@ def generate_cardsort(data, options, layout):
                 soltemplatemd['item'] = templatemdmatch.group(2)
                 soltemplatemd['end_document'] = templatemdmatch.group(3)
             else:
-                sys.exit('Markdown solution template does not have '
-                         'required structure')
+                raise TemplateError('Markdown solution template does not have '
+                                    'required structure')
 
 
     # These dicts will contain the substitutions needed for the
@@ -1845,7 +4044,7 @@ def generate_cardsort(data, options, layout):
         dsubs['title'] = data['title']
     else:
         dsubs['title'] = ''
-    random.seed(dsubs['title'])
+    ctx.seedrandom(dsubs['title'])
 
     # Read the card content
 
@@ -1854,133 +4053,137 @@ def generate_cardsort(data, options, layout):
     # activities); edges do not appear in this sort of activity
     if 'pairs' in layout:
         if 'pairs' in data:
-            pairs = data['pairs']
-            if layout['pairs'] == 0:  # which means any number of pairs
-                if len(pairs) == 0:
-                    sys.exit('Puzzle type %s needs at least one pair' %
-                             layout['typename'])
+            # Dominoes are always printed in a shuffled order, so
+            # streamed pairs are kept in a temporary file rather than
+            # in memory, to be read back in that order
+            if isinstance(data['pairs'], stream.ItemSource):
+                pairs = readpairs(data['pairs'], layout,
+                                  stream.SpooledItems())
             else:
-                if len(pairs) != layout['pairs']:
-                    sys.exit('Puzzle type %s needs exactly %s pairs' %
-                             (layout['typename'], layout['pairs']))
+                pairs = readpairs(data['pairs'], layout, [])
         else:
-            sys.exit('Puzzle type %s requires pairs in data file' %
-                     layout['typename'])
+            raise PuzzleDataError(
+                'Puzzle type %s requires pairs in data file' %
+                layout['typename'])
     elif 'pairs' in data:
-        sys.exit('Puzzle type %s does not accept pairs in data file' %
-                 layout['typename'])
+        raise PuzzleDataError(
+            'Puzzle type %s does not accept pairs in data file' %
+            layout['typename'])
     else:
         pairs = []  # so that later bits of code don't barf
 
     if 'edges' in data:
-        sys.exit('Puzzle type %s does not accept edges in data file' %
-                 layout['typename'])
+        raise PuzzleDataError(
+            'Puzzle type %s does not accept edges in data file' %
+            layout['typename'])
     edges = []  # so that later bits of code don't barf
 
+    # The cards may be streamed from the puzzle file (see stream.py),
+    # so rather than being held in a list, they are counted below as
+    # they are checked for hidden entries
     if 'cards' in layout:
         if 'cards' in data:
             cards = data['cards']
-            if layout['cards'] == 0:  # which means any number of cards
-                if len(cards) == 0:
-                    sys.exit('Puzzle type %s needs at least one card' %
-                             layout['typename'])
-            else:
-                if len(cards) != layout['cards']:
-                    sys.exit('Puzzle type %s needs exactly %s cards' %
-                             (layout['typename'], layout['cards']))
         else:
-            sys.exit('Puzzle type %s requires cards in data file' %
-                     layout['typename'])
+            raise PuzzleDataError(
+                'Puzzle type %s requires cards in data file' %
+                layout['typename'])
     elif 'cards' in data:
-        sys.exit('Puzzle type %s does not accept cards in data file' %
-                 layout['typename'])
+        raise PuzzleDataError(
+            'Puzzle type %s does not accept cards in data file' %
+            layout['typename'])
     else:
         cards = []  # so that later bits of code don't barf
 
     # We don't shuffle the cards yet, as we need the original order
     # for the solution and table.  Shuffling pairs is fine, though, as
     # their original order is immaterial if shufflePairs is requested.
-
+    # Rather than shuffling and flipping the pairs themselves, we keep
+    # the order and the flips, taking the random numbers in the same
+    # order as if the pairs were shuffled and flipped.
+    order = array.array('q', range(len(pairs)))
     if getopt(layout, data, {}, 'shufflePairs'):
-        random.shuffle(pairs)
+        ctx.random.shuffle(order)
     # We preserve the original pairs data for the table; we only flip
     # the questions and answers (if requested) for the puzzle cards
     if getopt(layout, data, {}, 'flip'):
-        flippedpairs = []
-        for p in pairs:
-            if random.choice([True, False]):
-                flippedpairs.append([p[1], p[0]])
-            else:
-                flippedpairs.append([p[0], p[1]])
-    else:
-        flippedpairs = pairs
-
-    # The following calls will add the appropriate substitution
-    # variables to dsubs and dsubsmd
-    global exists_hidden
-    exists_hidden = False
-
-    if tabletex:
-        make_table(pairs, edges, cards, dsubs, dsubsmd)
-
-    if layout['category'] == 'cardsort':
-        make_cardsort_cards(data, layout, options,
-                            cards, puztemplate, soltemplate,
-                            puztemplatemd, soltemplatemd, dsubs, dsubsmd)
+        flips = bytearray(ctx.random.choice([True, False])
+                          for k in range(len(pairs)))
     else:
-        make_domino_cards(data, layout, options,
-                          flippedpairs, puztemplate, soltemplate,
-                          puztemplatemd, soltemplatemd, dsubs, dsubsmd)
+        flips = None
+    flippedpairs = PairView(pairs, order, flips)
+    pairs = PairView(pairs, order)
+
+    # The document substitutions must all be known before the first
+    # page is written, so we find out whether any of the entries which
+    # will be made are hidden before making any of them.  This is done
+    # in a single pass over the cards, which also counts them and
+    # their pages (see scancards()).
+    checkcards = tabletex or layout['category'] == 'cardsort'
+    (numcards, numpages, hidden, realcards) = scancards(
+        ctx, data, layout, cards, checkcards)
 
-    if exists_hidden:
-        hiddennote = getopt(layout, data, {}, 'hiddennote',
-          'Entries that are hidden in the puzzle are highlighted in yellow.')
-        hiddennotemd = getopt(layout, data, {}, 'hiddennotemd',
-          'Entries that are hidden in the puzzle are indicated with (*).')
-        hiddennotetable = getopt(layout, data, {}, 'hiddennotetable',
-                                 hiddennotemd)
-        dsubs['hiddennotesolution'] = hiddennote
-        dsubs['hiddennotetable'] = hiddennotetable
-        dsubsmd['hiddennotemd'] = hiddennotemd
-    else:
-        dsubs['hiddennotesolution'] = ''
-        dsubs['hiddennotetable'] = ''
-        dsubsmd['hiddennotemd'] = ''
-
-    dsubs['puzzlenote'] = getopt(layout, data, {}, 'note', '')
-    dsubsmd['puzzlenote'] = getopt(layout, data, {}, 'note', '')
-
-    dsubs['puzbody'] = dosub(dsubs['puzbody'], dsubs)
-    dsubsmd['puzbody'] = dosub(dsubsmd['puzbody'], dsubsmd)
-    if dosoln:
-        dsubs['solbody'] = dosub(dsubs['solbody'], dsubs)
-        dsubsmd['solbody'] = dosub(dsubsmd['solbody'], dsubsmd)
+    if 'cards' in layout:
+        if layout['cards'] == 0:  # which means any number of cards
+            if numcards == 0:
+                raise PuzzleDataError(
+                    'Puzzle type %s needs at least one card' %
+                    layout['typename'])
+        else:
+            if numcards != layout['cards']:
+                raise PuzzleDataError(
+                    'Puzzle type %s needs exactly %s cards' %
+                    (layout['typename'], layout['cards']))
+
+    # The pair entries are the same whether or not they are flipped
+    entries = []
+    if layout['category'] != 'cardsort':
+        if not getopt(layout, data, {}, 'loop', True):
+            entries += [getopt(layout, data, {}, 'finish', 'Finish'),
+                        getopt(layout, data, {}, 'start', 'Start')]
+    hidden = hidden or any(ctx.is_hidden(e) for e in entries)
+    if not hidden and (tabletex or layout['category'] != 'cardsort'):
+        hidden = any(ctx.is_hidden(e) for p in pairs for e in p)
+    make_notes(data, layout, hidden, dsubs, dsubsmd)
 
     if tabletex:
-        btext = dosub(bodytable, dsubs)
-        print(btext, file=outtable)
-        outtable.close()
-        runlatex(outtablefile, layout, data, options)
-
-    if puzzletex:
-        print(dsubs['puzbody'], file=outpuz)
-        outpuz.close()
-        runlatex(outpuzfile, layout, data, options)
-
-    if solutiontex:
-        print(dsubs['solbody'], file=outsol)
-        outsol.close()
-        runlatex(outsolfile, layout, data, options)
-
-    if puzzlemd:
-        print(dsubsmd['puzbody'], file=outpuzmd)
-        outpuzmd.close()
-        filtermd(outpuzmdfile, layout, data, options)
-
-    if solutionmd:
-        print(dsubsmd['solbody'], file=outsolmd)
-        outsolmd.close()
-        filtermd(outsolmdfile, layout, data, options)
+        make_table(ctx, pairs, edges, cards, dsubs, dsubsmd)
+
+    with contextlib.ExitStack() as stack:
+        outs = {}
+        if tabletex:
+            outs['table'] = stack.enter_context(
+                result.opentex('table', tableheader))
+        if puzzletex:
+            outs['puzzle'] = stack.enter_context(
+                result.opentex('puzzle', puzheader))
+        if solutiontex:
+            outs['solution'] = stack.enter_context(
+                result.opentex('solution', solheader))
+        if puzzlemd:
+            outs['puzzlemd'] = stack.enter_context(
+                result.openmd('puzzle', puzheadermd))
+        if solutionmd:
+            outs['solutionmd'] = stack.enter_context(
+                result.openmd('solution', solheadermd))
+
+        if layout['category'] == 'cardsort':
+            make_cardsort_cards(ctx, data, layout, options,
+                                cards, realcards, numpages,
+                                puztemplate, soltemplate,
+                                puztemplatemd, soltemplatemd, dsubs, dsubsmd,
+                                outs.get('puzzle'), outs.get('solution'),
+                                outs.get('puzzlemd'), outs.get('solutionmd'))
+        else:
+            make_domino_cards(ctx, data, layout, options,
+                              flippedpairs, puztemplate, soltemplate,
+                              puztemplatemd, soltemplatemd, dsubs, dsubsmd,
+                              outs.get('puzzle'), outs.get('solution'),
+                              outs.get('puzzlemd'), outs.get('solutionmd'))
+
+        # The table rows are written straight into the table template
+        if tabletex:
+            writesub(outs['table'], bodytable, dsubs)
 
 
 # This allows this script to be invoked directly and also perhap for
@@ -0,0 +1,154 @@
+"""
+jigsaw-generate PDF tools
+Copyright (C) 2014-2016 Julian Gilbey <jdg@debian.org>
+This program comes with ABSOLUTELY NO WARRANTY.
+This is free software, and you are welcome to redistribute it
+under certain conditions; see the COPYING file for details.
+
+This module joins PDF files together, for documents which are
+compiled in several pieces, and takes ranges of pages out of them,
+for documents which are compiled together.  It uses the first of
+these which is available: the qpdf program, the pdfunite and
+pdfseparate programs, or the pypdf Python module.
+"""
+
+import sys
+import os
+import shutil
+import subprocess
+import tempfile
+
+try:
+    import pypdf
+except ImportError:
+    pypdf = None
+
+
+def merger():
+    """Return the name of the tool merge() will use, or None if none"""
+    for prog in ('qpdf', 'pdfunite'):
+        if shutil.which(prog):
+            return prog
+    if pypdf is not None:
+        return 'pypdf'
+    return None
+
+
+def canmerge():
+    """Return True if PDF files can be merged"""
+    return merger() is not None
+
+
+def extractor():
+    """Return the name of the tool extract() will use, or None if none"""
+    if shutil.which('qpdf'):
+        return 'qpdf'
+    if shutil.which('pdfseparate') and shutil.which('pdfunite'):
+        return 'pdfseparate'
+    if pypdf is not None:
+        return 'pypdf'
+    return None
+
+
+def canextract():
+    """Return True if pages can be taken out of PDF files"""
+    return extractor() is not None
+
+
+def merge(inputs, output):
+    """Join the PDF files inputs, in order, into the file output
+
+    Returns True on success.  On failure, a warning is printed and
+    output is not created.
+    """
+
+    tool = merger()
+    tmpoutput = output + '.merge'
+    try:
+        if tool == 'qpdf':
+            subprocess.check_output(['qpdf', '--empty', '--pages'] +
+                                    inputs + ['--', tmpoutput],
+                                    stderr=subprocess.STDOUT,
+                                    universal_newlines=True)
+        elif tool == 'pdfunite':
+            subprocess.check_output(['pdfunite'] + inputs + [tmpoutput],
+                                    stderr=subprocess.STDOUT,
+                                    universal_newlines=True)
+        elif tool == 'pypdf':
+            writer = pypdf.PdfWriter()
+            for fn in inputs:
+                writer.append(fn)
+            with open(tmpoutput, 'wb') as f:
+                writer.write(f)
+        else:
+            print('Warning: cannot merge PDF files without qpdf, pdfunite '
+                  'or pypdf', file=sys.stderr)
+            return False
+    except Exception as exc:
+        # pypdf can raise many different exceptions for a bad file
+        message = getattr(exc, 'output', None) or str(exc)
+        print('Warning: %s failed to merge PDF files into %s:\n%s' %
+              (tool, output, message), file=sys.stderr)
+        try:
+            os.remove(tmpoutput)
+        except OSError:
+            pass
+        return False
+
+    os.replace(tmpoutput, output)
+    return True
+
+
+def extract(inputfile, first, last, output):
+    """Write pages first to last (counting from 1) of inputfile to output
+
+    Returns True on success.  On failure, a warning is printed and
+    output is not created.
+    """
+
+    tool = extractor()
+    tmpoutput = output + '.extract'
+    try:
+        if tool == 'qpdf':
+            subprocess.check_output(['qpdf', '--empty', '--pages', inputfile,
+                                     '%d-%d' % (first, last), '--',
+                                     tmpoutput],
+                                    stderr=subprocess.STDOUT,
+                                    universal_newlines=True)
+        elif tool == 'pdfseparate':
+            with tempfile.TemporaryDirectory(prefix='jigsaw-') as tmpdir:
+                pattern = os.path.join(tmpdir, 'page-%d.pdf')
+                subprocess.check_output(['pdfseparate', '-f', str(first),
+                                         '-l', str(last), inputfile,
+                                         pattern],
+                                        stderr=subprocess.STDOUT,
+                                        universal_newlines=True)
+                pages = [pattern % page for page in range(first, last + 1)]
+                subprocess.check_output(['pdfunite'] + pages + [tmpoutput],
+                                        stderr=subprocess.STDOUT,
+                                        universal_newlines=True)
+        elif tool == 'pypdf':
+            reader = pypdf.PdfReader(inputfile)
+            writer = pypdf.PdfWriter()
+            for page in range(first - 1, last):
+                writer.add_page(reader.pages[page])
+            with open(tmpoutput, 'wb') as f:
+                writer.write(f)
+        else:
+            print('Warning: cannot take pages out of PDF files without '
+                  'qpdf, pdfseparate and pdfunite or pypdf',
+                  file=sys.stderr)
+            return False
+    except Exception as exc:
+        # pypdf can raise many different exceptions for a bad file
+        message = getattr(exc, 'output', None) or str(exc)
+        print('Warning: %s failed to take pages %d-%d of %s:\n%s' %
+              (tool, first, last, inputfile, message), file=sys.stderr)
+        try:
+            os.remove(tmpoutput)
+        except OSError:
+            pass
+        return False
+
+    os.replace(tmpoutput, output)
+    return True
@@ -0,0 +1,361 @@
+"""
+jigsaw-generate externalised jigsaw pieces
+Copyright (C) 2014-2016 Julian Gilbey <jdg@debian.org>
+This program comes with ABSOLUTELY NO WARRANTY.
+This is free software, and you are welcome to redistribute it
+under certain conditions; see the COPYING file for details.
+
+Drawing the triangle and square pieces of a jigsaw is most of the
+work of a LaTeX run on a jigsaw document, yet an edit to a puzzle
+usually changes only the two or three pieces holding the edited
+entry.  This module draws each piece in a small document of its own,
+using the preview package to crop the page to the piece, and replaces
+the piece in the jigsaw document by the resulting graphic.
+
+The pieces are found by looking for the piece commands of the page
+templates (\\uptriangle, \\downtriangle, \\lefttriangle,
+\\righttriangle, \\upsquare, \\tiltedtriangle and \\tiltedsquare)
+within tikzpicture environments, along
+with the most recent \\setshapesize and the options of the enclosing
+tikzpicture.  Each piece document has the preamble of the jigsaw
+document, so any settings made there apply to the pieces too.
+
+Each piece PDF is kept in the build cache, keyed by the piece document
+in the same way as a whole document (see buildcache.cachekey()), so it
+is only compiled again when the piece itself changes.  The piece files
+are named after their keys, so that the jigsaw document changes, and
+misses the build cache, whenever one of its pieces does.
+"""
+
+import sys
+import os
+import os.path
+import re
+import subprocess
+import concurrent.futures
+
+from . import buildcache
+from . import texformat
+
+# The piece commands: the rotation passed by each to \tiltedtriangle
+# or \tiltedsquare (None for these commands themselves, which take
+# the rotation as their second argument), the number of arguments it
+# takes, the radius of the shape and the angles of its corners
+triangle_corners = (-150, -30, 90)
+square_corners = (-135, -45, 45, 135)
+piece_commands = {
+    'uptriangle': ('0', 6, r'\trad', triangle_corners),
+    'downtriangle': ('180', 6, r'\trad', triangle_corners),
+    'lefttriangle': ('90', 6, r'\trad', triangle_corners),
+    'righttriangle': ('270', 6, r'\trad', triangle_corners),
+    'tiltedtriangle': (None, 7, r'\trad', triangle_corners),
+    'upsquare': ('0', 7, r'\srad', square_corners),
+    'tiltedsquare': (None, 8, r'\srad', square_corners),
+    }
+
+piece_re = re.compile(r'\\(uptriangle|downtriangle|lefttriangle|'
+                      r'righttriangle|tiltedtriangle|upsquare|'
+                      r'tiltedsquare)(?![a-zA-Z])'
+                      r'|\\setshapesize\s*\{([^{}]*)\}'
+                      r'|\\begin\{tikzpicture\}\s*(\[[^\]]*\])?'
+                      r'|\\end\{tikzpicture\}')
+
+# The margin around the circumcircle of each piece included in its
+# graphic, to allow for the width of the border and for entries
+# which overflow the piece
+piece_margin = '1cm'
+
+
+class Piece:
+    """A piece command found in a jigsaw document
+
+    The attributes are:
+      start, end  the position of the command and its arguments
+      command     the name of the command, such as 'uptriangle'
+      args        the arguments of the command, without their braces;
+                  the first is the position of the centre of the piece
+      shapesize   the argument of the last \\setshapesize, or None
+      options     the options of the enclosing tikzpicture, including
+                  the brackets, or ''
+    """
+
+    def __init__(self, start, end, command, args, shapesize, options):
+        self.start = start
+        self.end = end
+        self.command = command
+        self.args = args
+        self.shapesize = shapesize
+        self.options = options
+
+
+def incomment(text, pos):
+    """Return True if text[pos] is within a LaTeX comment"""
+    linestart = text.rfind('\n', 0, pos) + 1
+    i = linestart
+    while i < pos:
+        if text[i] == '\\':
+            i += 2
+            continue
+        if text[i] == '%':
+            return True
+        i += 1
+    return False
+
+
+def bracegroups(text, pos, count):
+    """Read count brace groups from text, starting at pos
+
+    Whitespace is allowed before each group.  Returns the pair (args,
+    end), where args is the list of the contents of the groups and end
+    the position following the last group, or None if there are not
+    count groups at pos.
+    """
+
+    args = []
+    while len(args) < count:
+        while pos < len(text) and text[pos] in ' \t\n':
+            pos += 1
+        if pos >= len(text) or text[pos] != '{':
+            return None
+        depth = 0
+        start = pos + 1
+        while pos < len(text):
+            char = text[pos]
+            if char == '\\':
+                pos += 2
+                continue
+            if char == '{':
+                depth += 1
+            elif char == '}':
+                depth -= 1
+                if depth == 0:
+                    break
+            pos += 1
+        else:
+            return None
+        args.append(text[start:pos])
+        pos += 1
+    return (args, pos)
+
+
+def findpieces(body):
+    """Return the list of Pieces in body, the text of a LaTeX document"""
+
+    pieces = []
+    shapesize = None
+    options = []
+    pos = 0
+    while True:
+        match = piece_re.search(body, pos)
+        if not match:
+            return pieces
+        pos = match.end()
+        if incomment(body, match.start()):
+            continue
+        text = match.group(0)
+        if match.group(1):
+            if not options:
+                continue
+            found = bracegroups(body, match.end(),
+                                piece_commands[match.group(1)][1])
+            if found:
+                (args, pos) = found
+                pieces.append(Piece(match.start(), pos, match.group(1),
+                                    args, shapesize, options[-1]))
+        elif match.group(2) is not None:
+            shapesize = match.group(2)
+        elif text.startswith('\\begin'):
+            options.append(match.group(3) or '')
+        elif options:
+            options.pop()
+
+
+def piecedoc(preamble, piece):
+    """Return the LaTeX document drawing piece on its own
+
+    The piece is drawn at the origin, in a bounding box centred on it,
+    so that the centre of the graphic is the centre of the piece.
+    """
+
+    radius = piece_commands[piece.command][2]
+    low = '-%s-%s' % (radius, piece_margin)
+    high = '%s+%s' % (radius, piece_margin)
+    lines = [preamble.rstrip('\n'),
+             r'\usepackage[active,tightpage]{preview}',
+             r'\begin{document}']
+    if piece.shapesize is not None:
+        lines.append(r'\setshapesize{%s}' % piece.shapesize)
+    lines += [r'\begin{preview}',
+              r'\begin{tikzpicture}' + piece.options,
+              r'\path[use as bounding box] (%s,%s) rectangle (%s,%s);' %
+              (low, low, high, high),
+              '\\%s{(0,0)}%s' % (piece.command,
+                                 ''.join('{%s}' % arg
+                                         for arg in piece.args[1:])),
+              r'\end{tikzpicture}',
+              r'\end{preview}',
+              r'\end{document}']
+    return '\n'.join(lines) + '\n'
+
+
+def placement(piece, graphic):
+    """Return the LaTeX placing graphic where piece was drawn
+
+    The graphic does not affect the size of the tikzpicture; instead,
+    an invisible path through the corners of the piece gives the
+    tikzpicture the same size as it had with the piece itself.
+    """
+
+    (rotation, nargs, radius, angles) = piece_commands[piece.command]
+    if rotation is None:
+        rotation = piece.args[1]
+    pos = piece.args[0]
+    corners = ' -- '.join('($ %s +({%s%+d}:%s) $)' %
+                          (pos, rotation, angle, radius)
+                          for angle in angles)
+    return ('\\path %s;\n'
+            '  \\node[overlay, inner sep=0pt] at ($ %s $) '
+            '{\\includegraphics{%s}};' % (corners, pos, graphic))
+
+
+def compilepiece(texfile, latexprog, fmt=None):
+    """Run LaTeX on the piece document texfile
+
+    If fmt is given, it is the precompiled format for the header of
+    the piece document.  Returns True if the PDF file was made.
+    """
+
+    basename = os.path.splitext(texfile)[0]
+    outdir = os.path.dirname(texfile)
+    diropts = ['-output-directory=' + outdir] if outdir else []
+    cmd = [latexprog, '--interaction=batchmode'] + diropts + [texfile]
+    if fmt:
+        bodyfn = texformat.stripheader(texfile, fmt[1])
+        if bodyfn:
+            cmd = ([latexprog, '-fmt=' + fmt[0],
+                    '-jobname=' + os.path.basename(basename),
+                    '--interaction=batchmode'] + diropts + [bodyfn])
+    try:
+        subprocess.check_output(cmd, universal_newlines=True)
+    except (OSError, subprocess.CalledProcessError):
+        if cmd[1].startswith('-fmt='):
+            return compilepiece(texfile, latexprog)
+        return False
+    return os.path.exists(basename + '.pdf')
+
+
+def externalize(fn, header, latexprog, numjobs=1, precompile=False,
+                usecache=True, cachesize=buildcache.default_cachesize,
+                clean=True, verbose=False):
+    """Replace the jigsaw pieces in the LaTeX document fn by graphics
+
+    header is the LaTeX header of fn.  The piece documents and their
+    PDF files are written to the directory named after fn with
+    -pieces added, and the PDF files taken from the build cache or
+    made by running latexprog, with up to numjobs runs at once.  If
+    precompile is True, the precompiled format of the header is used
+    (see texformat.py).  If usecache is False, the build cache is not
+    used, and every piece is drawn.
+
+    Returns the piece directory, or None if fn has no pieces or any
+    piece could not be drawn; fn is then left unchanged.  In the
+    latter case, if clean is True, only the log files of the failed
+    pieces are left in the piece directory.  If verbose is True, the
+    numbers of pieces found and drawn are reported.
+    """
+
+    with open(fn) as f:
+        text = f.read()
+    begin = text.find('\\begin{document}')
+    if begin < 0:
+        return None
+    pieces = findpieces(text[begin:])
+    if not pieces:
+        return None
+
+    basename = os.path.splitext(fn)[0]
+    piecedir = basename + '-pieces'
+    try:
+        os.makedirs(piecedir, exist_ok=True)
+    except OSError as err:
+        print('Warning: could not create %s: %s' % (piecedir, err),
+              file=sys.stderr)
+        return None
+
+    # The piece file for each piece, and the keys of those to compile
+    graphics = []
+    tocompile = {}
+    for (i, piece) in enumerate(pieces):
+        texfile = os.path.join(piecedir, 'piece%d.tex' % (i + 1))
+        with open(texfile, 'w') as f:
+            f.write(piecedoc(text[:begin], piece))
+        key = buildcache.cachekey(texfile, latexprog)
+        piecebase = os.path.join(piecedir, key[:32])
+        os.replace(texfile, piecebase + '.tex')
+        graphics.append(piecebase)
+        if (key not in tocompile and
+                not (usecache and
+                     (os.path.exists(piecebase + '.pdf') or
+                      buildcache.fetch(key, piecebase + '.pdf')))):
+            tocompile[key] = piecebase + '.tex'
+
+    fmt = None
+    if precompile and tocompile:
+        fmtbase = texformat.getformat(header, latexprog)
+        if fmtbase:
+            fmt = (fmtbase, header)
+
+    failed = []
+    if tocompile:
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(min(numjobs, len(tocompile)), 1)) as pool:
+            futures = dict((key, pool.submit(compilepiece, texfile,
+                                             latexprog, fmt))
+                           for (key, texfile) in tocompile.items())
+        for (key, texfile) in tocompile.items():
+            piecebase = os.path.splitext(texfile)[0]
+            if not futures[key].result():
+                print('Warning: %s failed to draw the jigsaw piece %s; '
+                      'see %s.log' % (latexprog, texfile, piecebase),
+                      file=sys.stderr)
+                failed.append(piecebase + '.log')
+                try:
+                    os.remove(piecebase + '.pdf')
+                except OSError:
+                    pass
+                continue
+            if usecache:
+                buildcache.store(key, piecebase + '.pdf', cachesize)
+            for ext in ('aux', 'log', 'body.tex'):
+                try:
+                    os.remove(piecebase + '.' + ext)
+                except OSError:
+                    pass
+    if failed:
+        if clean:
+            for name in os.listdir(piecedir):
+                path = os.path.join(piecedir, name)
+                if path not in failed:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+            try:
+                os.rmdir(piecedir)
+            except OSError:
+                pass
+        return None
+
+    if verbose:
+        print('%s: %d jigsaw pieces, %d drawn' %
+              (fn, len(pieces), len(tocompile)))
+    out = [text[:begin]]
+    pos = begin
+    for (piece, graphic) in zip(pieces, graphics):
+        out.append(text[pos:begin + piece.start])
+        out.append(placement(piece, graphic.replace(os.sep, '/')))
+        pos = begin + piece.end
+    out.append(text[pos:])
+    with open(fn, 'w') as f:
+        f.write(''.join(out))
+    return piecedir
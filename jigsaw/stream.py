@@ -0,0 +1,325 @@
+"""
+jigsaw-generate streamed puzzle files
+Copyright (C) 2014-2016 Julian Gilbey <jdg@debian.org>
+This program comes with ABSOLUTELY NO WARRANTY.
+This is free software, and you are welcome to redistribute it
+under certain conditions; see the COPYING file for details.
+
+This module reads the cards and pairs of a puzzle file one at a time,
+rather than loading the whole file into memory, for the --stream
+option and for JSON lines puzzle files.
+
+load() returns the puzzle data with each of these lists replaced by
+an ItemSource.  This can be iterated over as many times as needed,
+reading the items afresh from the file each time, so that only one
+item need be in memory at once.
+
+A YAML puzzle file is read as a series of parser events, and each
+item of the list is composed and constructed on its own.  An alias in
+an item may refer to an anchor in an earlier item or elsewhere in the
+file, but not to one inside another streamed list.
+
+A JSON lines (.jsonl) puzzle file has the puzzle data, as a JSON
+object, on its first line.  This names the list the items belong to
+with an empty (or short) list, for example
+
+    {"type": "cardsort", "title": "Question bank", "cards": []}
+
+and every following non-blank line is one JSON item of that list.
+
+A deck which is shuffled has to be read in a different order from the
+file, so its items are kept in a SpooledItems, which writes them to a
+temporary file and holds only their positions in memory.
+"""
+
+import array
+import json
+import pickle
+import tempfile
+
+import yaml
+
+# The lists which are streamed
+stream_keys = ('cards', 'pairs')
+
+
+class StreamError(Exception):
+    """An error in a streamed puzzle file; the message gives its position"""
+
+
+class ItemSource:
+    """A re-iterable source of the items of one list in a puzzle file
+
+    Each iteration reads the file again, so the file should not change
+    during a run.  The items are newly constructed on each iteration,
+    and may be modified by the caller.
+    """
+
+    def __init__(self, puzfile, key, loader=None, header=None):
+        self.puzfile = puzfile
+        self.key = key
+        # The YAML loader class, or for JSON lines files, the items
+        # given in the header line
+        self.loader = loader
+        self.header = header
+
+    def __iter__(self):
+        if self.loader is None:
+            return iterjsonl(self.puzfile, self.header)
+        else:
+            return iteryaml(self.puzfile, self.key, self.loader)
+
+    def __repr__(self):
+        return 'ItemSource(%r, %r)' % (self.puzfile, self.key)
+
+
+class SpooledItems:
+    """A list of items kept in a temporary file rather than in memory
+
+    Items are appended with append() and read back in any order by
+    indexing; each is read afresh from the file, so may be modified by
+    the caller.  Only the position of each item in the file is held in
+    memory, which is 8 bytes an item.  The file is deleted when it is
+    closed with close() or the SpooledItems is no longer used.
+    """
+
+    def __init__(self):
+        # The items are read back one at a time in no particular
+        # order, so the file is unbuffered and each item is read in
+        # one piece
+        self.file = tempfile.TemporaryFile(buffering=0)
+        self.offsets = array.array('q', [0])
+
+    def append(self, item):
+        self.file.seek(self.offsets[-1])
+        self.file.write(pickle.dumps(item, pickle.HIGHEST_PROTOCOL))
+        self.offsets.append(self.file.tell())
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if not 0 <= i < len(self):
+            raise IndexError('SpooledItems index out of range')
+        self.file.seek(self.offsets[i])
+        return pickle.loads(self.file.read(self.offsets[i + 1] -
+                                           self.offsets[i]))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def close(self):
+        self.file.close()
+
+
+def isjsonl(puzfile):
+    """Return True if puzfile is a JSON lines puzzle file"""
+    return puzfile.endswith('.jsonl')
+
+
+def load(puzfile, Loader):
+    """Read the puzzle data of puzfile, streaming its cards and pairs
+
+    Loader is the YAML loader class to use.  Returns None if the file
+    does not contain a mapping.  Raises StreamError if the file cannot
+    be parsed, and OSError if it cannot be read.
+    """
+
+    if isjsonl(puzfile):
+        return loadjsonl(puzfile)
+
+    with open(puzfile, 'rb') as f:
+        loader = Loader(f)
+        try:
+            if not findmapping(loader):
+                return None
+            anchors = {}
+            data = {}
+            while not loader.check_event(yaml.MappingEndEvent):
+                key = construct(loader, composenode(loader, anchors))
+                if (key in stream_keys and
+                        loader.check_event(yaml.SequenceStartEvent)):
+                    skipnode(loader)
+                    data[key] = ItemSource(puzfile, key, loader=Loader)
+                else:
+                    data[key] = construct(loader,
+                                          composenode(loader, anchors))
+            return data
+        except (yaml.YAMLError, TypeError) as exc:
+            raise yamlerror(exc)
+        finally:
+            loader.dispose()
+
+
+def iteryaml(puzfile, key, Loader):
+    """Yield the items of the list key in the YAML file puzfile"""
+
+    with openitems(puzfile, 'rb') as f:
+        loader = Loader(f)
+        try:
+            if not findmapping(loader):
+                return
+            anchors = {}
+            while not loader.check_event(yaml.MappingEndEvent):
+                name = construct(loader, composenode(loader, anchors))
+                if name in stream_keys and name != key:
+                    skipnode(loader)
+                elif name != key:
+                    composenode(loader, anchors)
+                else:
+                    loader.get_event()
+                    while not loader.check_event(yaml.SequenceEndEvent):
+                        yield construct(loader, composenode(loader, anchors))
+                    return
+        except (yaml.YAMLError, TypeError) as exc:
+            raise yamlerror(exc)
+        finally:
+            loader.dispose()
+
+
+def openitems(puzfile, mode, **kwargs):
+    """Open puzfile again to read its items"""
+    try:
+        return open(puzfile, mode, **kwargs)
+    except OSError:
+        raise StreamError('Cannot open %s for reading' % puzfile)
+
+
+def findmapping(loader):
+    """Read up to the start of the top-level mapping of the document
+
+    Returns False if the document is not a mapping.
+    """
+    loader.get_event()  # StreamStartEvent
+    if loader.check_event(yaml.StreamEndEvent):
+        return False
+    loader.get_event()  # DocumentStartEvent
+    if not loader.check_event(yaml.MappingStartEvent):
+        return False
+    loader.get_event()
+    return True
+
+
+def composenode(loader, anchors):
+    """Compose the node starting at the next event
+
+    This does the work of the composer of a YAML loader for a part of
+    the document, as the C loader cannot compose anything less than a
+    whole document.  anchors maps the anchors found so far to their
+    nodes.
+    """
+
+    event = loader.get_event()
+    if isinstance(event, yaml.AliasEvent):
+        if event.anchor not in anchors:
+            raise yaml.composer.ComposerError(
+                None, None, 'found undefined alias %r' % event.anchor,
+                event.start_mark)
+        return anchors[event.anchor]
+
+    if isinstance(event, yaml.ScalarEvent):
+        tag = event.tag
+        if tag is None or tag == '!':
+            tag = loader.resolve(yaml.ScalarNode, event.value,
+                                 event.implicit)
+        node = yaml.ScalarNode(tag, event.value, event.start_mark,
+                               event.end_mark, style=event.style)
+        if event.anchor is not None:
+            anchors[event.anchor] = node
+        return node
+
+    tag = event.tag
+    if isinstance(event, yaml.SequenceStartEvent):
+        if tag is None or tag == '!':
+            tag = loader.resolve(yaml.SequenceNode, None, event.implicit)
+        node = yaml.SequenceNode(tag, [], event.start_mark, None,
+                                 flow_style=event.flow_style)
+        if event.anchor is not None:
+            anchors[event.anchor] = node
+        while not loader.check_event(yaml.SequenceEndEvent):
+            node.value.append(composenode(loader, anchors))
+    else:
+        if tag is None or tag == '!':
+            tag = loader.resolve(yaml.MappingNode, None, event.implicit)
+        node = yaml.MappingNode(tag, [], event.start_mark, None,
+                                flow_style=event.flow_style)
+        if event.anchor is not None:
+            anchors[event.anchor] = node
+        while not loader.check_event(yaml.MappingEndEvent):
+            key = composenode(loader, anchors)
+            node.value.append((key, composenode(loader, anchors)))
+    node.end_mark = loader.get_event().end_mark
+    return node
+
+
+def skipnode(loader):
+    """Skip over the node starting at the next event"""
+    depth = 0
+    while True:
+        event = loader.get_event()
+        if isinstance(event, (yaml.SequenceStartEvent,
+                              yaml.MappingStartEvent)):
+            depth += 1
+        elif isinstance(event, (yaml.SequenceEndEvent,
+                                yaml.MappingEndEvent)):
+            depth -= 1
+        if depth == 0:
+            return
+
+
+def construct(loader, node):
+    """Construct the Python object for node"""
+    return loader.construct_document(node)
+
+
+def yamlerror(exc):
+    """Return a StreamError for a YAML parsing error"""
+    mark = getattr(exc, 'problem_mark', None)
+    if mark is not None:
+        return StreamError('Error parsing puzzle data file\n'
+                           'Error position: line %s, column %s' %
+                           (mark.line+1, mark.column+1))
+    return StreamError('Error parsing puzzle data file')
+
+
+def loadjsonl(puzfile):
+    """Read the puzzle data of the JSON lines file puzfile"""
+
+    with open(puzfile, encoding='utf-8') as f:
+        line = f.readline()
+    try:
+        data = json.loads(line)
+    except ValueError as exc:
+        raise StreamError('Error parsing puzzle data file\n'
+                          'Error position: line 1: %s' % exc)
+    if not isinstance(data, dict):
+        return None
+
+    keys = [key for key in stream_keys if isinstance(data.get(key), list)]
+    if len(keys) != 1:
+        raise StreamError('The first line of a JSON lines puzzle file must '
+                          'name exactly one of %s' % ' or '.join(stream_keys))
+    key = keys[0]
+    data[key] = ItemSource(puzfile, key, header=data[key])
+    return data
+
+
+def iterjsonl(puzfile, header):
+    """Yield the items of the JSON lines file puzfile
+
+    The items in the header line come first.
+    """
+
+    yield from json.loads(json.dumps(header))
+    with openitems(puzfile, 'r', encoding='utf-8') as f:
+        f.readline()
+        for (num, line) in enumerate(f, 2):
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError as exc:
+                raise StreamError('Error parsing puzzle data file\n'
+                                  'Error position: line %s: %s' %
+                                  (num, exc))
@@ -0,0 +1,189 @@
+"""
+jigsaw-generate precompiled LaTeX formats
+Copyright (C) 2014-2016 Julian Gilbey <jdg@debian.org>
+This program comes with ABSOLUTELY NO WARRANTY.
+This is free software, and you are welcome to redistribute it
+under certain conditions; see the COPYING file for details.
+
+Most puzzles share one of a small number of header files, and loading
+the packages in the header (TikZ in particular) is most of the cost of
+each LaTeX pass on a small document.  This module dumps a LaTeX format
+file for each distinct header into the user cache directory, so that
+the header is only ever processed once.
+
+A format is identified by a hash of the header text, the LaTeX program
+and the TeX installation (the program version and the base format it
+is built on), so it is rebuilt automatically whenever any of these
+change.  If LaTeX fails to dump the format, its log file is kept in
+place of the format, and later runs do not try to build it again.
+"""
+
+import sys
+import os
+import os.path
+import hashlib
+import subprocess
+import tempfile
+import threading
+
+from . import appdirs
+from . import buildcache
+
+# The TeX engine underlying each LaTeX program we can dump formats for
+engines = {
+    'pdflatex': 'pdftex',
+    'latex': 'pdftex',
+    'xelatex': 'xetex',
+    }
+
+# Locks so that two jobs needing the same format do not both build it
+format_locks = {}
+format_locks_lock = threading.Lock()
+
+# Keys whose formats failed to build in this run
+failed_formats = set()
+
+installation_ids = {}
+
+
+def formatdir():
+    """Return the directory in which the format files live"""
+    return os.path.join(appdirs.user_cache_dir('jigsaw-generator'), 'formats')
+
+
+def installationid(latexprog):
+    """Return a string which changes whenever the TeX installation does
+
+    This is the version banner of the program together with the path,
+    size and modification time of the base format file it loads.
+    """
+
+    if latexprog not in installation_ids:
+        ident = buildcache.latexversion(latexprog)
+        try:
+            basefmt = subprocess.check_output(
+                ['kpsewhich', '-engine=' + engines[latexprog],
+                 latexprog + '.fmt'],
+                universal_newlines=True, stderr=subprocess.DEVNULL).strip()
+            st = os.stat(basefmt)
+            ident += '\0%s\0%s\0%s' % (basefmt, st.st_size, st.st_mtime)
+        except (OSError, subprocess.CalledProcessError):
+            pass
+        installation_ids[latexprog] = ident
+    return installation_ids[latexprog]
+
+
+def formatkey(header, latexprog):
+    h = hashlib.sha256()
+    h.update(header.encode())
+    h.update(b'\0' + latexprog.encode() + b'\0')
+    h.update(installationid(latexprog).encode())
+    return 'jigsaw-' + h.hexdigest()[:32]
+
+
+def getformat(header, latexprog):
+    """Return the path of the format for header, building it if needed
+
+    The returned path has the .fmt extension removed, as is required
+    for the -fmt option of LaTeX.  None is returned if the format
+    cannot be built or latexprog does not support formats.
+    """
+
+    if latexprog not in engines:
+        return None
+
+    key = formatkey(header, latexprog)
+    fdir = formatdir()
+    fmtbase = os.path.join(fdir, key)
+    if os.path.exists(fmtbase + '.fmt'):
+        return fmtbase
+    if key in failed_formats or os.path.exists(fmtbase + '.log'):
+        return None
+
+    with format_locks_lock:
+        lock = format_locks.setdefault(key, threading.Lock())
+
+    with lock:
+        if os.path.exists(fmtbase + '.fmt'):
+            return fmtbase
+        if key in failed_formats:
+            return None
+        if buildformat(header, latexprog, fdir, key):
+            return fmtbase
+        failed_formats.add(key)
+        return None
+
+
+def buildformat(header, latexprog, fdir, key):
+    """Dump the format for header as fdir/key.fmt
+
+    Returns True on success.  The format is built in a temporary
+    directory and then renamed, so that concurrent runs never see a
+    partly written format file.  If LaTeX fails, its log file is kept
+    as fdir/key.log, which stops getformat() trying again.
+    """
+
+    try:
+        os.makedirs(fdir, exist_ok=True)
+        workdir = tempfile.mkdtemp(dir=fdir, prefix=key + '-')
+    except OSError as err:
+        print('Warning: could not create format directory: %s' % err,
+              file=sys.stderr)
+        return False
+
+    ok = False
+    try:
+        with open(os.path.join(workdir, key + '.ini.tex'), 'w') as f:
+            print(header, file=f)
+            print(r'\dump', file=f)
+        subprocess.check_output([latexprog, '-ini',
+                                 '-jobname=' + key,
+                                 '-interaction=nonstopmode',
+                                 '&' + latexprog, key + '.ini.tex'],
+                                cwd=workdir, universal_newlines=True)
+        os.replace(os.path.join(workdir, key + '.fmt'),
+                   os.path.join(fdir, key + '.fmt'))
+        ok = True
+    except subprocess.CalledProcessError as err:
+        logfile = os.path.join(fdir, key + '.log')
+        try:
+            os.replace(os.path.join(workdir, key + '.log'), logfile)
+        except OSError:
+            logfile = None
+        print('Warning: could not build a precompiled format for '
+              'the LaTeX header (%s)\n'
+              'Continuing without it%s' %
+              (err, '; the log file is ' + logfile if logfile else ''),
+              file=sys.stderr)
+    except OSError as err:
+        print('Warning: could not build a precompiled format for '
+              'the LaTeX header (%s)\n'
+              'Continuing without it' % err, file=sys.stderr)
+
+    for name in os.listdir(workdir):
+        try:
+            os.remove(os.path.join(workdir, name))
+        except OSError:
+            pass
+    try:
+        os.rmdir(workdir)
+    except OSError:
+        pass
+    return ok
+
+
+def stripheader(fn, header):
+    """Write the part of fn following header to a separate body file
+
+    Returns the name of the body file, or None if fn does not begin
+    with the header (for example, because a filter changed it).
+    """
+
+    with open(fn) as f:
+        text = f.read()
+    if not text.startswith(header):
+        return None
+    bodyfn = os.path.splitext(fn)[0] + '.body.tex'
+    with open(bodyfn, 'w') as f:
+        f.write(text[len(header):])
+    return bodyfn
@@ -0,0 +1,178 @@
+"""
+jigsaw-generate timing
+Copyright (C) 2014-2016 Julian Gilbey <jdg@debian.org>
+This program comes with ABSOLUTELY NO WARRANTY.
+This is free software, and you are welcome to redistribute it
+under certain conditions; see the COPYING file for details.
+
+This module records the wall clock and CPU time taken by each stage
+of a run, for the --profile option.  A stage is marked with the
+stage() context manager or the timed() decorator; when profiling is
+not enabled, these do nothing.
+
+The CPU time of a stage is that used by the thread running it, plus
+that of any child processes (such as LaTeX or a filter) which finished
+during it.  When several jobs run at once, a child process can
+therefore also be counted in a stage of another thread.
+"""
+
+import sys
+import os
+import time
+import json
+import threading
+import contextlib
+import functools
+
+# The format of the JSON profile written by report()
+profile_format = 1
+
+enabled = False
+records = []
+records_lock = threading.Lock()
+
+# The wall clock and CPU times at which recording started, and the
+# process which started it
+started = 0.0
+started_cpu = 0.0
+started_pid = None
+
+
+def enable():
+    """Start recording, discarding any earlier records"""
+    global enabled, started, started_cpu, started_pid
+    with records_lock:
+        del records[:]
+    started = time.perf_counter()
+    started_cpu = time.process_time() + childcpu()
+    started_pid = os.getpid()
+    enabled = True
+
+
+def startworker(profile):
+    """Start recording in a worker process if the run is being profiled
+
+    A forked worker inherits the records of its parent, and these are
+    discarded.  The worker's records should be passed back with take()
+    and added to those of the parent with add().
+    """
+    if profile and (not enabled or started_pid != os.getpid()):
+        enable()
+
+
+def childcpu():
+    """Return the CPU time used by the finished child processes"""
+    t = os.times()
+    return t.children_user + t.children_system
+
+
+@contextlib.contextmanager
+def stage(name, **info):
+    """Record the time taken by the body of the with statement
+
+    Any keyword arguments (such as the file being processed) are
+    stored with the record.
+    """
+    if not enabled:
+        yield
+        return
+    wall = time.perf_counter()
+    cpu = time.thread_time()
+    child = childcpu()
+    try:
+        yield
+    finally:
+        record = dict(info, stage=name,
+                      start=round(wall - started, 6),
+                      wall=round(time.perf_counter() - wall, 6),
+                      cpu=round(time.thread_time() - cpu +
+                                childcpu() - child, 6),
+                      thread=threading.current_thread().name,
+                      pid=os.getpid())
+        with records_lock:
+            records.append(record)
+
+
+def timed(name=None):
+    """Decorator recording each call of a function as a stage
+
+    The stage is named after the function unless name is given.
+    """
+    def decorate(func):
+        stagename = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            with stage(stagename):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def take():
+    """Return the records so far, and forget them"""
+    with records_lock:
+        taken = records[:]
+        del records[:]
+    return taken
+
+
+def add(newrecords):
+    """Add records taken in a worker process"""
+    with records_lock:
+        records.extend(newrecords)
+
+
+def summary():
+    """Return the total time in each stage, in order of first use
+
+    This is a list of dicts with keys stage, count, wall and cpu.
+    """
+    totals = {}
+    with records_lock:
+        for record in sorted(records, key=lambda r: r['start']):
+            total = totals.setdefault(record['stage'],
+                                      {'stage': record['stage'], 'count': 0,
+                                       'wall': 0.0, 'cpu': 0.0})
+            total['count'] += 1
+            total['wall'] += record['wall']
+            total['cpu'] += record['cpu']
+    for total in totals.values():
+        total['wall'] = round(total['wall'], 6)
+        total['cpu'] = round(total['cpu'], 6)
+    return list(totals.values())
+
+
+def report(profilefile, file=sys.stderr):
+    """Write the JSON profile to profilefile and a summary to file"""
+
+    wall = time.perf_counter() - started
+    cpu = time.process_time() + childcpu() - started_cpu
+    totals = summary()
+    with records_lock:
+        profile = {'format': profile_format,
+                   'command': sys.argv,
+                   'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                   'wall': round(wall, 6),
+                   'cpu': round(cpu, 6),
+                   'stages': totals,
+                   'records': sorted(records, key=lambda r: r['start'])}
+
+    try:
+        with open(profilefile, 'w') as f:
+            json.dump(profile, f, indent=1)
+            f.write('\n')
+    except OSError as err:
+        print('Warning: could not write profile to %s: %s' %
+              (profilefile, err), file=sys.stderr)
+
+    print('Profile (written to %s):' % profilefile, file=file)
+    print('  %-22s %6s %10s %10s' % ('stage', 'count', 'wall (s)', 'cpu (s)'),
+          file=file)
+    for total in totals:
+        print('  %-22s %6d %10.3f %10.3f' %
+              (total['stage'], total['count'], total['wall'], total['cpu']),
+              file=file)
+    print('  %-22s %6s %10.3f %10.3f' % ('total', '', wall, cpu), file=file)